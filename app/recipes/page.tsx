@@ -4,7 +4,7 @@ import { useState, useEffect, useRef } from "react"
 import { useRouter } from "next/navigation"
 import { useFirestore } from "reactfire"
 import { httpsCallable } from "firebase/functions"
-import { collection, query, where, orderBy, limit, getDocs, doc, getDoc } from "firebase/firestore"
+import { collection, query, where, orderBy, limit, getDocs, doc, getDoc, onSnapshot, Unsubscribe } from "firebase/firestore"
 import { RecipeCard } from "@/components/RecipeCard"
 import { PageLayout } from "@/components/PageLayout"
 import { getFunctions } from "firebase/functions"
@@ -42,10 +42,20 @@ interface StoreRecommendation {
 
 interface RecipeMatchResponse {
   status?: string
+  request_id?: string
   store_recommendations?: Record<string, StoreRecommendation>
   error?: string
 }
 
+// recipe_requests/{request_id}, filled in store by store by the backend
+interface RecipeRequestDocument {
+  status: "pending" | "running" | "complete" | "error"
+  store_recommendations?: Record<string, StoreRecommendation>
+  total_stores?: number
+  completed_stores?: number
+  error?: string
+}
+
 export default function RecipesPage() {
   const router = useRouter()
   const firestore = useFirestore()
@@ -53,8 +63,12 @@ export default function RecipesPage() {
   const [storeRecommendations, setStoreRecommendations] = useState<Record<string, StoreRecommendation>>({})
   const [storeSaleItems, setStoreSaleItems] = useState<Record<string, SaleItem[]>>({})
   const [isLoading, setIsLoading] = useState(true)
+  const [isStreaming, setIsStreaming] = useState(false)
   const [error, setError] = useState<string | null>(null)
 
+  // Listener on the progressive request document, if one is active
+  const requestUnsubscribeRef = useRef<Unsubscribe | null>(null)
+
   // Refs for scroll containers
   const scrollContainersRef = useRef<{ [key: string]: HTMLDivElement | null }>({})
 
@@ -166,11 +180,64 @@ export default function RecipesPage() {
     }
 
     fetchExistingRecipes()
+
+    return () => {
+      requestUnsubscribeRef.current?.()
+    }
   }, [router, firestore])
 
+  // Render each store as soon as the backend writes it to the request document
+  const listenToRecipeRequest = (requestId: string) => {
+    requestUnsubscribeRef.current?.()
+    setIsStreaming(true)
+
+    const fetchedStores = new Set<string>()
+    requestUnsubscribeRef.current = onSnapshot(
+      doc(firestore, "recipe_requests", requestId),
+      async (snapshot) => {
+        const request = snapshot.data() as RecipeRequestDocument | undefined
+        if (!request) return
+        console.log(`📥 Request ${requestId}: ${request.status} (${request.completed_stores ?? 0}/${request.total_stores ?? "?"} stores)`)
+
+        const stores = request.store_recommendations || {}
+        if (Object.keys(stores).length > 0) {
+          setStoreRecommendations(stores)
+          setIsLoading(false)
+        }
+
+        if (request.status === "complete" || request.status === "error") {
+          requestUnsubscribeRef.current?.()
+          requestUnsubscribeRef.current = null
+          setIsStreaming(false)
+          setIsLoading(false)
+          if (request.status === "error") {
+            setError(request.error || "Failed to generate recipes")
+          }
+        }
+
+        // Fetch sale items only for stores that just appeared
+        for (const storeId of Object.keys(stores)) {
+          if (fetchedStores.has(storeId)) continue
+          fetchedStores.add(storeId)
+          const items = await fetchStoreSaleItems(storeId)
+          setStoreSaleItems((previous) => ({ ...previous, [storeId]: items }))
+        }
+      },
+      (err) => {
+        console.error("❌ Error listening to recipe request:", err)
+        setIsStreaming(false)
+        setIsLoading(false)
+        setError(err.message)
+      }
+    )
+  }
+
   const generateNewRecipes = async (userId: string) => {
     try {
       setIsLoading(true)
+      setError(null)
+      setStoreRecommendations({})
+      setStoreSaleItems({})
 
       // Retrieve user preferences from localStorage
       const userPreferencesRaw = localStorage.getItem("userPreferences")
@@ -201,6 +268,8 @@ export default function RecipesPage() {
         food_preferences: {
           preferences: userPreferences,
         },
+        // Return a request id right away; stores are streamed into recipe_requests
+        progressive: true,
       }
 
       console.log("📤 Calling Firebase function with payload:", JSON.stringify(payload, null, 2))
@@ -213,7 +282,10 @@ export default function RecipesPage() {
           const data = result.data as RecipeMatchResponse
           console.log("📥 Parsed response data:", JSON.stringify(data, null, 2))
 
-          if (data?.store_recommendations) {
+          if (data?.request_id) {
+            console.log("📡 Listening for progressive results of request:", data.request_id)
+            listenToRecipeRequest(data.request_id)
+          } else if (data?.store_recommendations) {
             console.log("✅ Found store recommendations, count:", Object.keys(data.store_recommendations).length)
             setStoreRecommendations(data.store_recommendations)
 
@@ -241,7 +313,10 @@ export default function RecipesPage() {
         })
         .finally(() => {
           console.log("🏁 Function call completed")
-          setIsLoading(false)
+          // Progressive requests stop loading once their first store arrives
+          if (!requestUnsubscribeRef.current) {
+            setIsLoading(false)
+          }
         })
     } catch (err: any) {
       console.error("❌ Unexpected error in generateNewRecipes:", err)
@@ -470,6 +545,13 @@ export default function RecipesPage() {
                 ))}
               </div>
 
+              {isStreaming && (
+                <div className="mt-3 text-center text-xs text-gray-500 inline-flex items-center justify-center w-full">
+                  <RefreshCw className="w-3 h-3 mr-1 animate-spin" />
+                  Finding recipes for more stores...
+                </div>
+              )}
+
               <div className="mt-4 mb-2 text-center">
                 <button
                   onClick={handleGenerateRecipesAgain}
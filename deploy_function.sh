@@ -5,6 +5,15 @@
 echo "Deploying Firebase function..."
 echo "Make sure you have Firebase CLI installed and are logged in."
 
+# Shared modules imported by the function (main.py).
+# ngram_matcher.py needs numpy and scipy in the functions requirements.txt
+SHARED_MODULES="scraping/recipe_ranker.py scraping/sale_index.py scraping/ngram_matcher.py scraping/recipe_catalog.py scraping/recipe_tags.py scraping/prompt_builder.py scraping/llm_hedging.py scraping/llm_gateway.py scraping/recommendation_cache.py scraping/precompute_recommendations.py scraping/store_subscribers.py scraping/llm_stream.py scraping/product_price_index.py scraping/recipe_search.py scraping/request_coalescing.py scraping/catalog_cache.py scraping/offer_schema.py"
+
+# Copy the shared modules next to main.py in the functions directory
+for module in $SHARED_MODULES; do
+    cp "$module" ../functions/
+done
+
 # Navigate to the functions directory
 cd ../functions
 
@@ -0,0 +1,95 @@
+import random
+import time
+
+from benchmark_sale_index import BASES, PREFIXES, make_discount_info
+from meal_planner import EXACT_SEARCH_MAX, MealPlanner
+from offer_schema import format_article, typed_offer
+from recipe_ranker import RecipeRanker
+
+
+def make_recipes(size, rng):
+    """Generate a synthetic catalog of `size` recipes with 3-8 main ingredients each"""
+    recipes = []
+    for recipe_idx in range(size):
+        ingredients = [f"{rng.choice(PREFIXES)}{base}".strip().capitalize()
+                       for base in rng.sample(BASES, rng.randint(3, 8))]
+        recipes.append({
+            "recipe_id": f"recipe-{recipe_idx}",
+            "recipe_name": f"Recept {recipe_idx}",
+            "main_ingredients": ingredients,
+        })
+    return {"benchmark": recipes}
+
+
+def make_stores(store_count, offers_per_store, rng):
+    """
+    Generate stores whose offers come from a shared chain assortment, each
+    with its own discounts, formatted like the function reads them (typed)
+    """
+    assortment = list(make_discount_info(offers_per_store * 4, rng))
+    stores = {}
+    for store_idx in range(store_count):
+        stores[f"store-{store_idx}"] = {
+            "store_name": f"Butik {store_idx}",
+            "articles": [
+                format_article(typed_offer({
+                    "name": name,
+                    "price": f"{rng.uniform(10, 150):.2f} kr",
+                    "discount_amount": f"{rng.uniform(1, 40):.2f} kr",
+                    "discount_percentage": f"{rng.randint(5, 50)}%"
+                }))
+                for name in rng.sample(assortment, offers_per_store)
+            ]
+        }
+    return stores
+
+
+def run_benchmark(recipe_count=2000, store_count=30, offers_per_store=500, n_recipes=7, seed=42, repeats=5):
+    rng = random.Random(seed)
+    recipes_data = make_recipes(recipe_count, rng)
+    stores = make_stores(store_count, offers_per_store, rng)
+
+    start = time.perf_counter()
+    planner = MealPlanner(RecipeRanker(recipes_data), stores)
+    build_time = time.perf_counter() - start
+
+    print(f"Recipes: {recipe_count}, stores: {store_count} x {offers_per_store} offers, plan size: {n_recipes}")
+    print(f"Planner build: {build_time * 1000:.1f} ms ({len(planner.scorer.slot_pairs)} ingredient slots)")
+
+    worst_gap = 0.0
+    for max_stores in (1, 2, 3):
+        timings = {}
+        plans = {}
+        for search in ("greedy", "exact"):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                plans[search] = planner.plan(n_recipes=n_recipes, max_stores=max_stores, search=search)
+            timings[search] = (time.perf_counter() - start) / repeats
+
+        if plans["exact"]["search"] != "exact":
+            print(f"max_stores={max_stores}: greedy {timings['greedy'] * 1000:.1f} ms ({plans['greedy']['total_savings']:.2f} kr), "
+                  f"exact search skipped (more than {EXACT_SEARCH_MAX} store combinations)")
+            continue
+        greedy_savings = plans["greedy"]["total_savings"]
+        exact_savings = plans["exact"]["total_savings"]
+        gap = (exact_savings - greedy_savings) / exact_savings * 100 if exact_savings else 0.0
+        worst_gap = max(worst_gap, gap)
+        print(f"max_stores={max_stores}: greedy {timings['greedy'] * 1000:.1f} ms ({greedy_savings:.2f} kr), "
+              f"exact {timings['exact'] * 1000:.1f} ms ({exact_savings:.2f} kr), gap {gap:.2f}%")
+
+    # A typical request: a handful of allowed stores, the planner built for
+    # them (the recipe index is shared) and planned with the default search
+    ranker = RecipeRanker(recipes_data)
+    typical_stores = dict(list(stores.items())[:6])
+    start = time.perf_counter()
+    for _ in range(repeats):
+        plan = MealPlanner(ranker, typical_stores).plan(n_recipes=n_recipes, max_stores=2)
+    typical_time = (time.perf_counter() - start) / repeats
+    print(f"Typical request (6 stores, max 2, build + plan): {typical_time * 1000:.1f} ms with {plan['search']} search, "
+          f"{plan['total_savings']:.2f} kr saved at {[store['store_id'] for store in plan['stores']]}")
+
+    return worst_gap
+
+
+if __name__ == "__main__":
+    run_benchmark()
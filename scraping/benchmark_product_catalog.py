@@ -0,0 +1,89 @@
+import random
+import time
+
+from benchmark_sale_index import BASES, PREFIXES, SUFFIXES
+from product_catalog import ProductCatalog, new_product_id, product_key
+
+BRANDS = ["Arla", "Apetina", "Eldorado", "ICA", "Garant", "Scan", "Findus", "Barilla", "Zeta", "Felix", "Kronfågel", "Skånemejerier"]
+SIZES = ["", "", "200g", "400g", "500g", "1kg", "1l", "1,5l", "3%", "12-pack"]
+
+
+def make_products(count, rng):
+    """Distinct products: prefix, base, suffix, brand and size"""
+    products = set()
+    while len(products) < count:
+        name = f"{rng.choice(PREFIXES)}{rng.choice(BASES)}{rng.choice(SUFFIXES)} {rng.choice(BRANDS)} {rng.choice(SIZES)}"
+        products.add(" ".join(name.split()).capitalize())
+    return sorted(products)
+
+
+def spelling_variant(name, rng):
+    """How another store might list the same product"""
+    variant = rng.random()
+    if variant < 0.6:
+        return name
+    if variant < 0.7:
+        return name.upper()
+    if variant < 0.8:
+        return name + "."
+    if variant < 0.9:
+        return name.replace(" ", "  ", 1)
+    # One dropped letter, as typed into a store's system
+    position = rng.randrange(1, len(name))
+    return name[:position] + name[position + 1:] if name[position].isalpha() else name
+
+
+def run_benchmark(product_count=5000, store_count=300, offers_per_store=400, seed=42):
+    rng = random.Random(seed)
+    products = make_products(product_count, rng)
+
+    offers = []
+    truth = {}
+    for _ in range(store_count):
+        for product in rng.sample(products, offers_per_store):
+            name = spelling_variant(product, rng)
+            offers.append(name)
+            truth.setdefault(name, product)
+
+    start = time.perf_counter()
+    catalog = ProductCatalog.build(offers)
+    build_time = time.perf_counter() - start
+
+    # Pairwise precision/recall of the clustering against the generating products
+    by_product = {}
+    for name, product in truth.items():
+        by_product.setdefault(product, set()).add(catalog.product_id(name))
+    split = sum(len(ids) - 1 for ids in by_product.values())
+    by_id = {}
+    for name, product in truth.items():
+        by_id.setdefault(catalog.product_id(name), set()).add(product)
+    merged = sum(len(products_in_id) - 1 for products_in_id in by_id.values())
+
+    start = time.perf_counter()
+    rebuilt = ProductCatalog.build(offers + [spelling_variant(product, rng) for product in products[:100]], previous=catalog)
+    rebuild_time = time.perf_counter() - start
+    kept = sum(1 for name in truth if rebuilt.product_id(name) == catalog.product_id(name))
+
+    print(f"Offers: {len(offers)} ({store_count} stores x {offers_per_store}), {len(set(offers))} distinct names, {product_count} products")
+    print(f"Build:     {build_time * 1000:.0f} ms -> {len(catalog)} catalog products")
+    print(f"Clusters:  {split} products split over extra ids, {merged} distinct products wrongly merged")
+    print(f"Rebuild:   {rebuild_time * 1000:.0f} ms, {kept}/{len(truth)} names kept their id")
+    print(f"Example:   {[name for name in truth if truth[name] == products[0]]} -> {catalog.product_id(products[0])}")
+
+    # A wrong merge of an earlier catalog is split again on rebuild: the most
+    # offered part keeps the old id (the hash of the other part's name), and
+    # the other part must still get an id of its own
+    first, second = products[0], products[1]
+    merged_id = new_product_id(product_key(second))
+    merged = ProductCatalog.from_documents([(merged_id, {"aliases": [product_key(first), product_key(second)]})])
+    split_catalog = ProductCatalog.build([first] * 5 + [second] * 2, previous=merged)
+    split_ok = (len(split_catalog) == 2 and split_catalog.product_id(first) == merged_id
+                and split_catalog.product_id(second) not in (None, merged_id))
+    print(f"Split:     {first!r} -> {split_catalog.product_id(first)}, {second!r} -> {split_catalog.product_id(second)} "
+          f"({'ok' if split_ok else 'PRODUCT LOST'})")
+
+    return len(catalog)
+
+
+if __name__ == "__main__":
+    run_benchmark()
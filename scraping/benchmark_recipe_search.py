@@ -0,0 +1,98 @@
+import random
+import time
+
+from benchmark_sale_index import BASES, PREFIXES, make_discount_info
+from recipe_search import SearchIndex, recipe_entries, store_group
+
+DISH_WORDS = ["gryta", "soppa", "sallad", "wok", "paj", "lasagne", "gratäng", "curry", "tacos", "biffar", "bullar", "pytt"]
+ADJECTIVES = ["", "", "Krämig ", "Snabb ", "Klassisk ", "Het ", "Vegetarisk ", "Mormors ", "Enkel "]
+
+
+def make_recipes(size, rng):
+    """Generate `size` recipes with Swedish compound names and 3-8 main ingredients"""
+    recipes = []
+    for recipe_idx in range(size):
+        bases = rng.sample(BASES, rng.randint(3, 8))
+        recipes.append({
+            "recipe_id": f"recipe-{recipe_idx}",
+            "recipe_name": f"{rng.choice(ADJECTIVES)}{bases[0]}{rng.choice(DISH_WORDS)} med {bases[1]}".capitalize(),
+            "recipe_url": f"https://example.com/recept/{recipe_idx}",
+            "main_ingredients": [f"{rng.choice(PREFIXES)}{base}".strip() for base in bases],
+        })
+    return recipes
+
+
+def make_store(store_idx, offers_per_store, rng):
+    discount_info = make_discount_info(offers_per_store, rng)
+    return {
+        "store_name": f"Butik {store_idx}",
+        "offer_version": f"v{rng.random():.6f}",
+        "articles": [[name, info["price"], info["discount_amount"], info["discount_percentage"]]
+                     for name, info in discount_info.items()]
+    }
+
+
+def make_queries(count, rng):
+    """Type-ahead sequences: every prefix of a one- or two-word query, as the user types it"""
+    queries = []
+    while len(queries) < count:
+        words = [rng.choice(BASES + DISH_WORDS) for _ in range(rng.randint(1, 2))]
+        text = " ".join(words)
+        queries.extend(text[:length] for length in range(2, len(text) + 1))
+    return queries[:count]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run_benchmark(recipe_count=50000, store_count=30, offers_per_store=500, query_count=2000, seed=42):
+    rng = random.Random(seed)
+    recipes = make_recipes(recipe_count, rng)
+    stores = {f"store-{store_idx}": make_store(store_idx, offers_per_store, rng) for store_idx in range(store_count)}
+
+    groups = {f"recipes/{chunk}": (f"v{chunk}", recipe_entries(recipes[chunk:chunk + 1000]))
+              for chunk in range(0, recipe_count, 1000)}
+    groups.update(store_group(store_id, store_data) for store_id, store_data in stores.items())
+
+    start = time.perf_counter()
+    index = SearchIndex()
+    index.replace_groups(groups)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    snapshot = index.to_bytes()
+    serialize_time = time.perf_counter() - start
+    start = time.perf_counter()
+    index = SearchIndex.from_bytes(snapshot)
+    load_time = time.perf_counter() - start
+
+    latencies = []
+    hits = 0
+    for query in make_queries(query_count, rng):
+        start = time.perf_counter()
+        results = index.search(query, limit=10)
+        latencies.append(time.perf_counter() - start)
+        hits += bool(results)
+
+    # One store uploads new offers
+    start = time.perf_counter()
+    index.replace_groups(dict([store_group("store-0", make_store(0, offers_per_store, rng))]))
+    update_time = time.perf_counter() - start
+
+    print(f"Documents: {len(index)} ({recipe_count} recipes, {store_count} x {offers_per_store} offers), {len(index.postings)} terms")
+    print(f"Build:        {build_time * 1000:.0f} ms")
+    print(f"Snapshot:     {len(snapshot) / 1e6:.1f} MB gzipped, serialize {serialize_time * 1000:.0f} ms, load {load_time * 1000:.0f} ms")
+    print(f"Queries:      {len(latencies)} type-ahead queries, {hits} with results")
+    print(f"Latency:      p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p95 {percentile(latencies, 0.95) * 1000:.2f} ms, "
+          f"max {max(latencies) * 1000:.2f} ms")
+    print(f"Store update: {update_time * 1000:.0f} ms")
+    print(f"Example 'kycklinggr': {[result['title'] for result in index.search('kycklinggr', limit=3)]}")
+    print(f"Example 'tomater' offers: {[result['title'] for result in index.search('tomater', kind='offer', limit=3)]}")
+
+    return percentile(latencies, 0.95)
+
+
+if __name__ == "__main__":
+    run_benchmark()
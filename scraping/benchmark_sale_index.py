@@ -0,0 +1,106 @@
+import random
+import time
+
+from recipe_ranker import normalize_text
+from sale_index import SaleItemIndex
+
+# Building blocks for synthetic Swedish product names
+BASES = [
+    "kyckling", "nötfärs", "fläskfilé", "lax", "torsk", "halloumi", "potatis",
+    "tomater", "lök", "vitlök", "morötter", "paprika", "zucchini", "broccoli",
+    "pasta", "spaghetti", "ris", "bönor", "linser", "grädde", "mjölk", "ost",
+    "smör", "ägg", "bacon", "korv", "skinka", "räkor", "tonfisk", "champinjoner",
+]
+PREFIXES = ["", "", "", "krossade ", "färsk ", "fryst ", "ekologisk ", "körsbärs", "svensk ", "riven "]
+SUFFIXES = ["", "", "", "filé", "bitar", " naturell", " original", " 500g", " 1kg", " apetina", " eldorado", " ica"]
+
+
+def linear_best_match(ingredient, discount_info):
+    """Reference linear scan with the scoring rules of find_matching_sale_item"""
+    normalized_ingredient = normalize_text(ingredient)
+
+    if ingredient in discount_info:
+        return ingredient
+
+    best_match = None
+    best_match_score = 0
+
+    for product_name, info in discount_info.items():
+        normalized_product = info.get("normalized_name", "")
+        if not normalized_product:
+            continue
+
+        if normalized_ingredient in normalized_product:
+            score = len(normalized_ingredient) / len(normalized_product) * 100
+            if score > best_match_score:
+                best_match = product_name
+                best_match_score = score
+        elif normalized_product in normalized_ingredient:
+            score = len(normalized_product) / len(normalized_ingredient) * 100
+            if score > best_match_score:
+                best_match = product_name
+                best_match_score = score
+
+        ingredient_words = set(normalized_ingredient.split())
+        product_words = set(normalized_product.split())
+        common_words = ingredient_words.intersection(product_words)
+        if common_words:
+            score = len(common_words) / max(len(ingredient_words), len(product_words)) * 90
+            if score > best_match_score:
+                best_match = product_name
+                best_match_score = score
+
+    return best_match if best_match_score > 50 else None
+
+
+def make_discount_info(size, rng):
+    """Generate `size` unique synthetic sale items"""
+    discount_info = {}
+    while len(discount_info) < size:
+        name = f"{rng.choice(PREFIXES)}{rng.choice(BASES)}{rng.choice(SUFFIXES)} {rng.randint(1, 999)}".strip().capitalize()
+        discount_info[name] = {
+            "price": f"{rng.uniform(10, 150):.2f}",
+            "discount_amount": f"{rng.uniform(1, 40):.2f}",
+            "discount_percentage": f"{rng.randint(5, 50)}%",
+            "normalized_name": normalize_text(name),
+        }
+    return discount_info
+
+
+def make_ingredients(size, rng):
+    """Generate recipe-style ingredient names"""
+    return [f"{rng.choice(PREFIXES)}{rng.choice(BASES)}".strip().capitalize() for _ in range(size)]
+
+
+def run_benchmark(sale_item_count=5000, ingredient_count=1000, seed=42):
+    rng = random.Random(seed)
+    discount_info = make_discount_info(sale_item_count, rng)
+    ingredients = make_ingredients(ingredient_count, rng)
+
+    start = time.perf_counter()
+    index = SaleItemIndex(discount_info)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    indexed_results = [index.best_match(ingredient) for ingredient in ingredients]
+    indexed_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    linear_results = [linear_best_match(ingredient, discount_info) for ingredient in ingredients]
+    linear_time = time.perf_counter() - start
+
+    mismatches = sum(1 for a, b in zip(indexed_results, linear_results) if a != b)
+    matched = sum(1 for result in indexed_results if result)
+
+    print(f"Sale items: {sale_item_count}, ingredient queries: {ingredient_count}")
+    print(f"Index build:   {build_time * 1000:.1f} ms")
+    print(f"Indexed:       {indexed_time * 1000:.1f} ms ({indexed_time / ingredient_count * 1e6:.0f} us/query)")
+    print(f"Linear scan:   {linear_time * 1000:.1f} ms ({linear_time / ingredient_count * 1e6:.0f} us/query)")
+    print(f"Speedup:       {linear_time / indexed_time:.1f}x")
+    print(f"Matched {matched}/{ingredient_count} ingredients, {mismatches} differences from the linear scan")
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    run_benchmark()
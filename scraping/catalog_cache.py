@@ -0,0 +1,151 @@
+import collections
+import os
+
+from firebase_admin import firestore
+
+from recipe_catalog import RecipeCatalog
+from recipe_ranker import RecipeRanker
+
+# catalog_meta/current: {"recipes_version": n, "store_versions": {store_id: offer_version}}
+CATALOG_META_COLLECTION = "catalog_meta"
+CATALOG_META_DOCUMENT = "current"
+
+# Largest recipe catalog kept in memory (with its ranking index); bigger
+# catalogs are read from Firestore on every call
+CATALOG_MAX_RECIPES = int(os.getenv("RECIPE_CATALOG_MAX_RECIPES", "100000"))
+
+# Offers kept in memory across all cached stores (least recently used stores are evicted)
+CATALOG_MAX_ARTICLES = int(os.getenv("RECIPE_CATALOG_MAX_ARTICLES", "200000"))
+
+# Maximum number of cached stores
+CATALOG_MAX_STORES = int(os.getenv("RECIPE_CATALOG_MAX_STORES", "1000"))
+
+
+def record_store_versions(db, store_versions):
+    """Publish new offer versions of stores to catalog_meta (sync client, for uploads)"""
+    db.collection(CATALOG_META_COLLECTION).document(CATALOG_META_DOCUMENT).set({
+        "store_versions": store_versions,
+        "updated_at": firestore.SERVER_TIMESTAMP
+    }, merge=True)
+
+
+def bump_recipes_version(db):
+    """Invalidate every instance's cached recipe catalog (sync client, for triggers)"""
+    db.collection(CATALOG_META_COLLECTION).document(CATALOG_META_DOCUMENT).set({
+        "recipes_version": firestore.Increment(1),
+        "updated_at": firestore.SERVER_TIMESTAMP
+    }, merge=True)
+
+
+class CatalogCache:
+    """
+    Warm-instance cache of the recipe catalog and the stores' offers.
+
+    Every call reads the single catalog_meta document, which holds the
+    version of the recipes collection and the offer version of every store.
+    The parsed RecipeCatalog and its RecipeRanker are reused while the
+    recipes version is unchanged, and a store's formatted offers while its
+    offer version is unchanged, so a warm instance serves a call with one
+    read instead of streaming the whole recipes collection and rebuilding
+    the index. Catalogs without a recipes version and stores missing from
+    catalog_meta are read from Firestore every time, as before.
+
+    Memory is bounded by CATALOG_MAX_RECIPES for the catalog and by
+    CATALOG_MAX_ARTICLES / CATALOG_MAX_STORES for the offers, evicting the
+    least recently used stores. The cache is only used from the function's
+    event loop thread, so it needs no lock.
+    """
+
+    def __init__(self, max_recipes=CATALOG_MAX_RECIPES, max_articles=CATALOG_MAX_ARTICLES, max_stores=CATALOG_MAX_STORES):
+        self.max_recipes = max_recipes
+        self.max_articles = max_articles
+        self.max_stores = max_stores
+        self._recipes_version = None
+        self._catalog = None
+        self._ranker = None
+        self._stores = collections.OrderedDict()
+        self._article_count = 0
+
+    async def read_meta(self, db):
+        """The current catalog_meta document ({} if there is none yet)"""
+        doc = await db.collection(CATALOG_META_COLLECTION).document(CATALOG_META_DOCUMENT).get()
+        return doc.to_dict() if doc.exists else {}
+
+    async def catalog(self, db, meta, load_recipes):
+        """
+        The recipe catalog, from memory if the recipes version is unchanged.
+
+        Args:
+            db: Async Firestore client
+            meta: The catalog_meta document read for this call
+            load_recipes: Coroutine function reading {category: [recipe, ...]} from Firestore
+        """
+        version = meta.get("recipes_version")
+        if version is not None and self._catalog is not None and version == self._recipes_version:
+            print(f"Using cached recipe catalog version {version} ({len(self._catalog)} recipes)")
+            return self._catalog
+
+        catalog = RecipeCatalog(await load_recipes(db))
+        if version is not None and len(catalog) <= self.max_recipes:
+            self._recipes_version = version
+            self._catalog = catalog
+            self._ranker = None
+        return catalog
+
+    def ranker(self, catalog):
+        """The ranking index of a catalog, built once for the cached catalog"""
+        if catalog is not self._catalog:
+            return RecipeRanker(catalog.recipes_data)
+        if self._ranker is None:
+            self._ranker = RecipeRanker(catalog.recipes_data)
+        return self._ranker
+
+    async def store_articles(self, db, meta, store_ids, load_store_articles):
+        """
+        Formatted offers of the stores, from memory for stores whose offer version is unchanged.
+
+        Args:
+            db: Async Firestore client
+            meta: The catalog_meta document read for this call
+            store_ids: The stores to read
+            load_store_articles: Coroutine function reading {store_id: store_data} of given stores from Firestore
+        """
+        store_versions = meta.get("store_versions", {})
+        articles_by_store = {}
+        missing = []
+        for store_id in store_ids:
+            entry = self._stores.get(store_id)
+            if entry is not None and store_versions.get(store_id) == entry["offer_version"]:
+                self._stores.move_to_end(store_id)
+                articles_by_store[store_id] = entry
+            else:
+                if entry is not None:
+                    self._drop_store(store_id)
+                missing.append(store_id)
+
+        if articles_by_store:
+            print(f"Using cached offers of {len(articles_by_store)} stores")
+        if missing:
+            loaded = await load_store_articles(db, missing)
+            for store_id, store_data in loaded.items():
+                articles_by_store[store_id] = store_data
+                # Only offers catalog_meta can vouch for are kept
+                if store_versions.get(store_id) == store_data["offer_version"]:
+                    self._put_store(store_id, store_data)
+        return articles_by_store
+
+    def _drop_store(self, store_id):
+        previous = self._stores.pop(store_id, None)
+        if previous is not None:
+            self._article_count -= len(previous["articles"])
+
+    def _put_store(self, store_id, store_data):
+        self._drop_store(store_id)
+        if len(store_data["articles"]) > self.max_articles:
+            return
+
+        self._stores[store_id] = store_data
+        self._article_count += len(store_data["articles"])
+        while self._article_count > self.max_articles or len(self._stores) > self.max_stores:
+            _, evicted = self._stores.popitem(last=False)
+            self._article_count -= len(evicted["articles"])
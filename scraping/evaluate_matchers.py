@@ -0,0 +1,252 @@
+"""
+Offline evaluation of the recipe matchers against frozen fixtures.
+
+Every matcher recommends recipes for the users in fixtures/eval/users.json
+from the offers in articles_on_sale.json and the catalog in recipes.json, and
+is compared with the reference recommendations in reference.json on:
+
+- overlap@k: share of the reference recipes the matcher also recommends
+- savings: discounts the recommendations capture (ingredients mapped to sale
+  items as the app maps them), relative to the reference
+- violations: recommendations that break a hard preference (e.g. meat for a
+  vegetarian)
+- latency p50/p95 per user and LLM cost per user
+
+The LLM matchers go through the gateway, so with LLM_GATEWAY_MODE=replay they
+run offline from the cassettes in fixtures/eval/cassettes:
+
+    LLM_GATEWAY_MODE=record python evaluate_matchers.py --record-reference
+    LLM_GATEWAY_MODE=replay python evaluate_matchers.py
+"""
+import argparse
+import json
+import os
+import time
+
+from llm_gateway import gateway_available, ledger
+from ngram_matcher import match_ingredients
+from recipe_catalog import RecipeCatalog
+from recipe_ranker import RecipeRanker, build_discount_info, rerank_with_llm, select_candidate_recipes
+from sale_index import SaleItemIndex
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "eval")
+
+TOP_K = 5
+
+# Local candidates handed to the LLM by the local_rerank matcher
+RERANK_CANDIDATES = 15
+
+
+class EvalData:
+    """The frozen fixtures, with the catalog and ranking index built once"""
+
+    def __init__(self, directory=FIXTURES_DIR):
+        self.directory = directory
+        self.articles_on_sale = self._load("articles_on_sale.json")
+        self.catalog = RecipeCatalog(self._load("recipes.json"))
+        self.ranker = RecipeRanker(self.catalog.recipes_data)
+        self.users = self._load("users.json")
+        reference_path = os.path.join(directory, "reference.json")
+        self.reference = self._load("reference.json") if os.path.exists(reference_path) else {"users": {}}
+
+    def _load(self, name):
+        with open(os.path.join(self.directory, name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def user_articles(self, user):
+        """{store_id: articles} for the user's stores"""
+        return {store_id: self.articles_on_sale[store_id]
+                for store_id in user.get("allowed_stores", []) if store_id in self.articles_on_sale}
+
+
+def merged_articles(user_articles):
+    return [article for articles in user_articles.values() for article in articles]
+
+
+def local_matcher(user, data):
+    """The deterministic local ranking engine ("local" mode)"""
+    articles = merged_articles(data.user_articles(user))
+    allowed_ids = data.catalog.ids_for_preferences(user.get("preferences", []))
+    recommendations = data.ranker.rank(articles, user.get("preferences", []), top_k=TOP_K, allowed_ids=allowed_ids)
+    if not recommendations and user.get("preferences"):
+        recommendations = data.ranker.rank(articles, [], top_k=TOP_K)
+    return [rec["recipe_id"] for rec in recommendations]
+
+
+def candidates_matcher(user, data):
+    """Baseline: the prompt's top-K sale-overlap prefilter on its own, no LLM"""
+    sale_items, _, _ = build_discount_info(merged_articles(data.user_articles(user)))
+    recipes_info = data.catalog.prompt_entries(data.catalog.ids_for_preferences(user.get("preferences", [])))
+    return [recipe["recipe_id"] for recipe in select_candidate_recipes(recipes_info, sale_items, TOP_K)]
+
+
+def llm_matcher(user, data):
+    """The GPT-4o matching prompt, as run by recipe_matcher"""
+    import recipe_matcher
+
+    result, _, _ = recipe_matcher.get_recipe_recommendations(
+        data.user_articles(user), user.get("preferences", []), data.catalog, verbose=False
+    )
+    recipe_ids = []
+    for rec in result.get("recommendations", []):
+        recipe = data.catalog.resolve(rec)
+        if recipe and recipe["recipe_id"] not in recipe_ids:
+            recipe_ids.append(recipe["recipe_id"])
+    return recipe_ids[:TOP_K]
+
+
+def local_rerank_matcher(user, data):
+    """Local candidates re-ranked by the LLM ("local_rerank" mode)"""
+    import recipe_matcher
+
+    allowed_ids = data.catalog.ids_for_preferences(user.get("preferences", []))
+    candidates = data.ranker.rank(merged_articles(data.user_articles(user)), user.get("preferences", []),
+                                  top_k=RERANK_CANDIDATES, allowed_ids=allowed_ids)
+    reranked = rerank_with_llm(candidates, user.get("preferences", []), recipe_matcher.client, top_k=TOP_K)
+    return [rec["recipe_id"] for rec in reranked]
+
+
+# name -> (matcher, whether it calls the LLM)
+MATCHERS = {
+    "llm": (llm_matcher, True),
+    "local_rerank": (local_rerank_matcher, True),
+    "local": (local_matcher, False),
+    "candidates": (candidates_matcher, False),
+}
+
+
+def recommendation_savings(recipe_ids, user_articles, catalog):
+    """Total discount of the sale items the recipes' ingredients map to (each item counted once)"""
+    _, discount_info, _ = build_discount_info(merged_articles(user_articles))
+    sale_index = SaleItemIndex(discount_info)
+
+    ingredients = {ingredient for recipe_id in recipe_ids
+                   for ingredient in (catalog.get(recipe_id) or {}).get("main_ingredients", [])}
+    matches = {ingredient: sale_index.best_match(ingredient) for ingredient in ingredients}
+    # Same n-gram fallback as format_recommendations for the ingredients the scoring rules miss
+    unmatched = [ingredient for ingredient, match in matches.items() if match is None]
+    if unmatched and discount_info:
+        matches.update(match_ingredients(unmatched, list(discount_info)))
+
+    products = {match for match in matches.values() if match}
+    return sum(discount_info[product]["discount_value"] for product in products)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)] if ordered else 0.0
+
+
+def evaluate(name, data, repeats=1):
+    """Run one matcher over every fixture user and compute its metrics"""
+    matcher, _ = MATCHERS[name]
+    reference = data.reference.get("users", {})
+    ledger_start = len(ledger.entries)
+
+    latencies = []
+    overlaps = []
+    savings = 0.0
+    reference_savings = 0.0
+    violations = 0
+    recommended = 0
+    errors = 0
+    per_user = {}
+
+    for user in data.users:
+        user_id = user.get("id") or user.get("name")
+        recipe_ids = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            try:
+                recipe_ids = matcher(user, data)
+            except Exception as e:
+                errors += 1
+                recipe_ids = []
+                print(f"{name} failed for {user_id}: {e}")
+            latencies.append(time.perf_counter() - start)
+        per_user[user_id] = recipe_ids
+
+        user_articles = data.user_articles(user)
+        savings += recommendation_savings(recipe_ids, user_articles, data.catalog)
+        allowed = data.catalog.ids_for_preferences(user.get("preferences", []))
+        violations += sum(1 for recipe_id in recipe_ids if allowed is not None and recipe_id not in allowed)
+        recommended += len(recipe_ids)
+
+        if user_id in reference:
+            expected = reference[user_id]
+            overlaps.append(len(set(recipe_ids[:TOP_K]) & set(expected)) / max(len(expected), 1))
+            reference_savings += recommendation_savings(expected, user_articles, data.catalog)
+
+    cost = sum(entry["cost_usd"] for entry in ledger.entries[ledger_start:])
+    calls = len(data.users) * repeats
+    return {
+        "matcher": name,
+        "users": len(data.users),
+        "overlap_at_k": round(sum(overlaps) / len(overlaps), 3) if overlaps else None,
+        "savings_kr": round(savings, 2),
+        "savings_vs_reference": round(savings / reference_savings, 3) if reference_savings else None,
+        "violations": violations,
+        "recommended": recommended,
+        "errors": errors,
+        "latency_p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "latency_p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "cost_per_user_usd": round(cost / calls, 6) if calls else 0.0,
+        "recommendations": per_user,
+    }
+
+
+def print_report(results):
+    print(f"\n{'matcher':<14}{'overlap@k':>10}{'savings':>10}{'vs ref':>8}{'viol.':>7}{'p50 ms':>10}{'p95 ms':>10}{'$/user':>10}")
+    for result in results:
+        overlap = f"{result['overlap_at_k']:.2f}" if result["overlap_at_k"] is not None else "-"
+        versus = f"{result['savings_vs_reference'] * 100:.0f}%" if result["savings_vs_reference"] is not None else "-"
+        print(f"{result['matcher']:<14}{overlap:>10}{result['savings_kr']:>10.2f}{versus:>8}{result['violations']:>7}"
+              f"{result['latency_p50_ms']:>10.2f}{result['latency_p95_ms']:>10.2f}{result['cost_per_user_usd']:>10.5f}")
+
+
+def record_reference(data, name="llm"):
+    """Freeze a matcher's recommendations (by default the GPT-4o path) as the reference"""
+    matcher, _ = MATCHERS[name]
+    users = {}
+    for user in data.users:
+        users[user.get("id") or user.get("name")] = matcher(user, data)
+    reference = {"source": name, "k": TOP_K, "users": users}
+    with open(os.path.join(data.directory, "reference.json"), 'w', encoding='utf-8') as f:
+        json.dump(reference, f, indent=2, ensure_ascii=False)
+    print(f"Recorded {name} recommendations for {len(users)} users as the reference")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare recipe matchers on frozen fixtures")
+    parser.add_argument("--matchers", nargs="+", choices=sorted(MATCHERS), help="Matchers to run (default: all that can run)")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR, help="Fixture directory")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per user, for steadier latency figures")
+    parser.add_argument("--output", help="Write the full report as JSON to this file")
+    parser.add_argument("--record-reference", action="store_true", help="Freeze the LLM matcher's answers as the reference")
+    args = parser.parse_args()
+
+    # LLM answers are recorded to / replayed from the fixtures, next to the data they were made for
+    os.environ.setdefault("LLM_CASSETTE_DIR", os.path.join(args.fixtures, "cassettes"))
+
+    data = EvalData(args.fixtures)
+    if args.record_reference:
+        record_reference(data)
+        return
+
+    names = args.matchers or list(MATCHERS)
+    skipped = [name for name in names if MATCHERS[name][1] and not gateway_available()]
+    if skipped:
+        print(f"Skipping {skipped}: no OpenAI API key and LLM_GATEWAY_MODE is not replay")
+    results = [evaluate(name, data, args.repeats) for name in names if name not in skipped]
+
+    print(f"\nReference: {data.reference.get('source', 'none')}, {len(data.users)} users, k={TOP_K}")
+    print_report(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\nReport saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+
+from openai import AsyncOpenAI, OpenAI
+
+from recipe_ranker import estimate_tokens
+
+# Gateway modes, chosen with LLM_GATEWAY_MODE:
+#   "live"   - call OpenAI (default)
+#   "record" - call OpenAI and save every response as a cassette in LLM_CASSETTE_DIR
+#   "replay" - serve the cassettes from a local fake server, no network needed
+GATEWAY_MODES = ("live", "record", "replay")
+DEFAULT_CASSETTE_DIR = "llm_cassettes"
+
+# USD per 1M tokens (input, output)
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 10.00),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-3.5-turbo": (0.50, 1.50),
+}
+
+
+def request_key(body):
+    """Hash identifying a chat completion request (its JSON body, minus transport options)"""
+    body = {key: value for key, value in body.items() if key not in ("timeout", "coalesce")}
+    return hashlib.sha256(json.dumps(body, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def gateway_mode():
+    """Configured gateway mode (read at call time so .env files loaded late still apply)"""
+    mode = os.getenv("LLM_GATEWAY_MODE", "live")
+    if mode not in GATEWAY_MODES:
+        raise ValueError(f"Unknown LLM_GATEWAY_MODE '{mode}', expected one of {GATEWAY_MODES}")
+    return mode
+
+
+def cassette_dir():
+    return os.getenv("LLM_CASSETTE_DIR", DEFAULT_CASSETTE_DIR)
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    """Estimated USD cost of a call, 0.0 for unknown models"""
+    for name, (input_price, output_price) in sorted(MODEL_PRICES.items(), key=lambda item: -len(item[0])):
+        if model.startswith(name):
+            return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+    return 0.0
+
+
+class UsageLedger:
+    """Thread-safe record of every LLM call made through the gateway"""
+
+    def __init__(self, path=None):
+        # Optional JSONL file every entry is also appended to (default: LLM_LEDGER_PATH)
+        self.path = path
+        self.entries = []
+        self._lock = threading.Lock()
+
+    def record(self, model, response, latency, coalesced=False, caller="", tokens=None, complete=True):
+        """
+        Record one call.
+
+        tokens, if given, is (prompt_tokens, completion_tokens) to use instead
+        of the response's usage (e.g. estimated for a stream that was cut off
+        before its usage chunk); complete is False for such streams.
+        """
+        usage = getattr(response, "usage", None)
+        if tokens is None:
+            tokens = (getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0)
+        prompt_tokens, completion_tokens = (0, 0) if coalesced else tokens
+        entry = {
+            "timestamp": time.time(),
+            "caller": caller,
+            "model": model,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cost_usd": estimate_cost(model, prompt_tokens, completion_tokens),
+            "latency_sec": round(latency, 3),
+            "coalesced": coalesced,
+            "complete": complete,
+        }
+        path = self.path or os.getenv("LLM_LEDGER_PATH")
+        with self._lock:
+            self.entries.append(entry)
+            if path:
+                with open(path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def summary(self):
+        """Totals over all recorded calls"""
+        with self._lock:
+            entries = list(self.entries)
+        return {
+            "calls": len(entries),
+            "coalesced_calls": sum(1 for entry in entries if entry["coalesced"]),
+            "prompt_tokens": sum(entry["prompt_tokens"] for entry in entries),
+            "completion_tokens": sum(entry["completion_tokens"] for entry in entries),
+            "cost_usd": round(sum(entry["cost_usd"] for entry in entries), 6),
+        }
+
+
+# One ledger per process, shared by the sync and async gateways
+ledger = UsageLedger()
+
+
+def save_cassette(body, response, latency, directory=None):
+    """Store a live response (or the list of chunks of a streamed one) so it can be replayed offline"""
+    directory = directory or cassette_dir()
+    os.makedirs(directory, exist_ok=True)
+    body = {key: value for key, value in body.items() if key not in ("timeout", "coalesce")}
+    path = os.path.join(directory, f"{request_key(body)}.json")
+    if isinstance(response, list):
+        cassette = {"request": body, "chunks": [chunk.model_dump() for chunk in response], "latency": latency}
+    else:
+        cassette = {"request": body, "response": response.model_dump(), "latency": latency}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(cassette, f, ensure_ascii=False, indent=2)
+
+
+class ReplayServer:
+    """
+    Local stand-in for the OpenAI API that serves recorded cassettes.
+
+    POST /v1/chat/completions looks up the cassette for the request body and
+    answers after the recorded latency, so benchmarks and load tests of the
+    matching pipeline behave realistically without network access.
+    """
+
+    def __init__(self, directory=None, host="127.0.0.1", port=0, latency_scale=None):
+        directory = directory or cassette_dir()
+        if latency_scale is None:
+            # Replayed responses sleep for their recorded latency times this factor
+            latency_scale = float(os.getenv("LLM_REPLAY_LATENCY_SCALE", "1.0"))
+
+        cassettes = {}
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if filename.endswith(".json"):
+                    with open(os.path.join(directory, filename), encoding="utf-8") as f:
+                        cassette = json.load(f)
+                    cassettes[request_key(cassette["request"])] = cassette
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                cassette = cassettes.get(request_key(body))
+                if cassette is None:
+                    self._send(404, {"error": {"message": "No recorded response for this request", "type": "replay_miss"}})
+                    return
+                if "chunks" in cassette:
+                    self._send_stream(cassette["chunks"], cassette.get("latency", 0) * latency_scale)
+                    return
+                time.sleep(cassette.get("latency", 0) * latency_scale)
+                self._send(200, cassette["response"])
+
+            def _send_stream(self, chunks, latency):
+                """Replay a streamed response as server-sent events spread over its latency"""
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in chunks:
+                    time.sleep(latency / max(len(chunks), 1))
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def _send(self, status, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.cassette_count = len(cassettes)
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread.start()
+        print(f"Replaying {self.cassette_count} recorded LLM responses from {self.base_url}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+_replay_server = None
+_replay_lock = threading.Lock()
+
+
+def _client_options(mode):
+    """Constructor arguments for the underlying OpenAI client in the given mode"""
+    global _replay_server
+    if mode == "replay":
+        with _replay_lock:
+            if _replay_server is None:
+                _replay_server = ReplayServer().start()
+        return {"api_key": "replay", "base_url": _replay_server.base_url, "max_retries": 0}
+    return {"api_key": os.getenv("OPENAI_API_KEY")}
+
+
+def gateway_available():
+    """Whether calls can be made: an API key is configured or responses are replayed"""
+    return gateway_mode() == "replay" or bool(os.getenv("OPENAI_API_KEY"))
+
+
+def _finish_stream(gateway, chunks, kwargs, latency, complete):
+    """
+    Ledger (and in record mode, cassette) for a streamed response.
+
+    A stream closed early (deadline, error) never gets its usage chunk, so
+    its tokens are estimated from the request and the text received.
+    """
+    model = kwargs.get("model", "")
+    usage_chunk = next((chunk for chunk in reversed(chunks) if getattr(chunk, "usage", None)), None)
+    tokens = None
+    if usage_chunk is None and not complete:
+        prompt_text = "".join(str(message.get("content", "")) for message in kwargs.get("messages", []))
+        completion_text = "".join(chunk.choices[0].delta.content or "" for chunk in chunks if chunk.choices)
+        tokens = (estimate_tokens(prompt_text, model), estimate_tokens(completion_text, model))
+    ledger.record(model, usage_chunk, latency, caller=gateway.caller, tokens=tokens, complete=complete)
+    if gateway.mode == "record" and complete:
+        save_cassette(kwargs, chunks, latency)
+
+
+class _Completions:
+    def __init__(self, create):
+        self.create = create
+
+
+class _Chat:
+    def __init__(self, create):
+        self.completions = _Completions(create)
+
+
+class LLMGateway:
+    """
+    Shared entry point for synchronous OpenAI chat completions.
+
+    Exposes `chat.completions.create(...)` like the OpenAI client, so callers
+    only swap the client object. Identical requests already in flight are
+    coalesced into one API call (single flight), every call is written to the
+    usage ledger, and in record/replay mode responses are saved or served
+    from the local fake server.
+    """
+
+    supports_coalescing = True
+
+    def __init__(self, client=None, caller="", mode=None):
+        self.mode = mode or gateway_mode()
+        self.client = client or OpenAI(**_client_options(self.mode))
+        self.caller = caller
+        self.chat = _Chat(self.create)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def create(self, coalesce=True, **kwargs):
+        # Streams can't be shared between callers, so they are never coalesced
+        if kwargs.get("stream") or not coalesce:
+            return self._call(kwargs)
+
+        key = request_key(kwargs)
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self._inflight[key] = future
+
+        if not leader:
+            start = time.monotonic()
+            response = future.result()
+            ledger.record(kwargs.get("model", ""), response, time.monotonic() - start, coalesced=True, caller=self.caller)
+            return response
+
+        try:
+            response = self._call(kwargs)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _call(self, kwargs):
+        start = time.monotonic()
+        response = self.client.chat.completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._record_stream(response, kwargs, start)
+        latency = time.monotonic() - start
+        ledger.record(kwargs.get("model", ""), response, latency, caller=self.caller)
+        if self.mode == "record":
+            save_cassette(kwargs, response, latency)
+        return response
+
+    def _record_stream(self, stream, kwargs, start):
+        """
+        Pass a streamed response through, recording its usage (stream_options
+        include_usage) at the end; closing the generator early closes the
+        HTTP response and still records the call.
+        """
+        chunks = []
+        complete = False
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+            complete = True
+        finally:
+            stream.close()
+            _finish_stream(self, chunks, kwargs, time.monotonic() - start, complete)
+
+
+class AsyncLLMGateway:
+    """LLMGateway for asyncio callers, wrapping AsyncOpenAI"""
+
+    supports_coalescing = True
+
+    def __init__(self, client=None, caller="", mode=None):
+        self.mode = mode or gateway_mode()
+        self.client = client or AsyncOpenAI(**_client_options(self.mode))
+        self.caller = caller
+        self.chat = _Chat(self.create)
+        self._inflight = {}
+
+    async def create(self, coalesce=True, **kwargs):
+        # Streams can't be shared between callers, so they are never coalesced
+        if kwargs.get("stream") or not coalesce:
+            return await self._call(kwargs)
+
+        key = request_key(kwargs)
+        entry = self._inflight.get(key)
+        if entry is not None:
+            start = time.monotonic()
+            response = await self._wait_shared(key, entry)
+            ledger.record(kwargs.get("model", ""), response, time.monotonic() - start, coalesced=True, caller=self.caller)
+            return response
+
+        # [shared request, callers waiting for it]
+        entry = [asyncio.ensure_future(self._call(kwargs)), 0]
+        self._inflight[key] = entry
+        entry[0].add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await self._wait_shared(key, entry)
+
+    async def _wait_shared(self, key, entry):
+        """
+        Wait for a shared request. A cancelled caller doesn't cancel it while
+        others still wait (shield), but the last one to give up does, so an
+        abandoned HTTP request isn't kept running and paid for.
+        """
+        future = entry[0]
+        entry[1] += 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if entry[1] == 1 and not future.done():
+                # Later duplicates start a new request instead of joining a cancelled one
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+                future.cancel()
+            raise
+        finally:
+            entry[1] -= 1
+
+    async def _call(self, kwargs):
+        start = time.monotonic()
+        response = await self.client.chat.completions.create(**kwargs)
+        if kwargs.get("stream"):
+            return self._record_stream(response, kwargs, start)
+        latency = time.monotonic() - start
+        ledger.record(kwargs.get("model", ""), response, latency, caller=self.caller)
+        if self.mode == "record":
+            save_cassette(kwargs, response, latency)
+        return response
+
+    async def _record_stream(self, stream, kwargs, start):
+        """
+        Pass a streamed response through, recording its usage (stream_options
+        include_usage) at the end; closing the generator early (aclose) closes
+        the HTTP response and still records the call.
+        """
+        chunks = []
+        complete = False
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+            complete = True
+        finally:
+            await stream.close()
+            _finish_stream(self, chunks, kwargs, time.monotonic() - start, complete)
+
+
+if __name__ == "__main__":
+    # Run the replay server on its own, e.g. for load tests:
+    #   python llm_gateway.py [port]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8089
+    server = ReplayServer(port=port).start()
+    print(f"Point OpenAI clients at base_url={server.base_url}")
+    server.thread.join()
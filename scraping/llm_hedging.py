@@ -0,0 +1,164 @@
+import asyncio
+import collections
+import time
+
+# Model used when the primary model can't answer before the deadline
+FALLBACK_MODEL = "gpt-4o-mini"
+
+# Hedge delay used until enough latencies have been observed
+DEFAULT_HEDGE_DELAY_SEC = 8.0
+
+# Latency samples needed before the p95 is trusted
+MIN_SAMPLES = 20
+
+# Time reserved at the end of the deadline for the fallback model
+FALLBACK_RESERVE_SEC = 10.0
+
+
+class LatencyTracker:
+    """Rolling window of successful call latencies per model"""
+
+    def __init__(self, window=200):
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=window))
+
+    def record(self, model, seconds):
+        self.samples[model].append(seconds)
+
+    def percentile(self, model, fraction, default):
+        """Latency percentile for a model, or the default if there are too few samples"""
+        samples = self.samples[model]
+        if len(samples) < MIN_SAMPLES:
+            return default
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+# Shared by every caller on this instance so the p95 reflects recent traffic
+latency_tracker = LatencyTracker()
+
+
+def _discard(task):
+    """
+    Cancel a request that lost the race. If it already finished (or finishes
+    despite the cancel), its response is closed: a stream left open would
+    keep the HTTP response, and the tokens it streams, running.
+    """
+    task.cancel()
+    task.add_done_callback(_close_response)
+
+
+def _close_response(task):
+    if task.cancelled() or task.exception() is not None:
+        return
+    response = task.result()
+    close = getattr(response, "aclose", None) or getattr(response, "close", None)
+    if close is not None:
+        closing = close()
+        if asyncio.iscoroutine(closing):
+            asyncio.ensure_future(closing)
+
+
+class HedgedLLMCaller:
+    """
+    Deadline-aware wrapper around an AsyncOpenAI chat completion call.
+
+    - If the primary request hasn't answered by the model's observed p95
+      latency, a duplicate (hedged) request is sent; the first answer wins and
+      the slower request is cancelled.
+    - When only FALLBACK_RESERVE_SEC is left before the deadline, outstanding
+      requests are cancelled and the faster fallback model is tried.
+    - If that also fails, None is returned so the caller can use the local
+      ranker.
+
+    Every hedge and fallback is appended to `events`, so callers can record them.
+    """
+
+    def __init__(self, client, model="gpt-4o", fallback_model=FALLBACK_MODEL, tracker=latency_tracker):
+        self.client = client
+        self.model = model
+        self.fallback_model = fallback_model
+        self.tracker = tracker
+        self.events = []
+
+    def _record(self, kind, **details):
+        event = dict(kind=kind, **details)
+        self.events.append(event)
+        print(f"LLM {kind}: {details}")
+
+    async def _timed_call(self, model, timeout, hedge=False, **kwargs):
+        """Send one request and record its latency"""
+        if hedge and getattr(self.client, "supports_coalescing", False):
+            # A hedge must be a second request, not joined to the slow one in flight
+            kwargs["coalesce"] = False
+        start = time.monotonic()
+        response = await self.client.chat.completions.create(model=model, timeout=timeout, **kwargs)
+        self.tracker.record(model, time.monotonic() - start)
+        return response
+
+    async def create(self, deadline, **kwargs):
+        """
+        Run a chat completion that must finish before `deadline` (time.monotonic()).
+
+        Returns:
+            The response, or None if neither model answered in time
+        """
+        primary_deadline = deadline - FALLBACK_RESERVE_SEC
+        tasks = []
+
+        if primary_deadline > time.monotonic():
+            tasks.append(asyncio.ensure_future(
+                self._timed_call(self.model, primary_deadline - time.monotonic(), **kwargs)
+            ))
+            hedge_delay = self.tracker.percentile(self.model, 0.95, DEFAULT_HEDGE_DELAY_SEC)
+            response = await self._wait_first(tasks, min(hedge_delay, primary_deadline - time.monotonic()))
+
+            if response is None and time.monotonic() < primary_deadline:
+                self._record("hedge", model=self.model, delay=round(hedge_delay, 2))
+                tasks.append(asyncio.ensure_future(
+                    self._timed_call(self.model, primary_deadline - time.monotonic(), hedge=True, **kwargs)
+                ))
+                response = await self._wait_first(tasks, primary_deadline - time.monotonic())
+
+            if response is not None:
+                return response
+        else:
+            self._record("fallback_model", model=self.fallback_model, reason="no time left for the primary model")
+
+        for task in tasks:
+            _discard(task)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._record("local_ranker", reason="deadline reached")
+            return None
+
+        if tasks:
+            self._record("fallback_model", model=self.fallback_model, reason=f"{self.model} not answered {remaining:.1f}s before the deadline")
+        try:
+            return await asyncio.wait_for(self._timed_call(self.fallback_model, remaining, **kwargs), timeout=remaining)
+        except Exception as e:
+            self._record("local_ranker", reason=f"fallback model failed: {e!r}")
+            return None
+
+    async def _wait_first(self, tasks, timeout):
+        """Wait for the first successful response among tasks, cancelling the rest; None on timeout"""
+        end = time.monotonic() + max(timeout, 0)
+        pending = {task for task in tasks if not task.done()}
+        finished = [task for task in tasks if task.done()]
+
+        while True:
+            for task in finished:
+                if not task.cancelled() and task.exception() is None:
+                    for other in tasks:
+                        if other is not task:
+                            _discard(other)
+                    return task.result()
+                if not task.cancelled():
+                    print(f"LLM request failed: {task.exception()!r}")
+                tasks.remove(task)
+
+            remaining = end - time.monotonic()
+            if not pending or remaining <= 0:
+                return None
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            finished = list(done)
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import time
+
+
+class RecommendationStreamParser:
+    """
+    Incremental JSON parser for a streamed `{"recommendations": [...]}` answer.
+
+    Text is fed in chunks as it arrives; every object of the recommendations
+    array is returned as soon as its closing brace is seen, without waiting
+    for the rest of the document. Only string/escape state and nesting depth
+    are tracked, so each character is looked at once.
+    """
+
+    def __init__(self, key="recommendations"):
+        self.key = key
+        self.text = ""
+        self.items = []
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_key = None
+        self._in_array = False
+        self._object_start = None
+
+    def feed(self, chunk):
+        """Consume a chunk of text and return the recommendation objects it completed"""
+        self.text += chunk
+        completed = []
+        text = self.text
+
+        for pos in range(self._pos, len(text)):
+            char = text[pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._string_start is not None:
+                        self._last_key = json.loads(text[self._string_start:pos + 1])
+                        self._string_start = None
+                continue
+
+            if char == '"':
+                self._in_string = True
+                # Strings directly in the top-level object may be the key we want
+                if self._depth == 1:
+                    self._string_start = pos
+            elif char in "{[":
+                if char == "[" and self._depth == 1 and self._last_key == self.key:
+                    self._in_array = True
+                elif char == "{" and self._in_array and self._depth == 2:
+                    self._object_start = pos
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if char == "}" and self._in_array and self._depth == 2 and self._object_start is not None:
+                    try:
+                        completed.append(json.loads(text[self._object_start:pos + 1]))
+                    except ValueError as e:
+                        print(f"Skipping malformed streamed recommendation: {e}")
+                    self._object_start = None
+                elif char == "]" and self._in_array and self._depth == 1:
+                    self._in_array = False
+
+        self._pos = len(text)
+        self.items.extend(completed)
+        return completed
+
+
+async def read_recommendation_stream(stream, deadline, on_item=None):
+    """
+    Read a streamed chat completion, handing each finished recommendation to on_item.
+
+    Args:
+        stream: Async iterator of chat completion chunks (stream=True)
+        deadline: time.monotonic() by which reading stops
+        on_item: Optional async callback for every completed recommendation
+
+    Returns:
+        Tuple of (items, usage, complete); if the stream is cut off or the
+        deadline passes, complete is False and items holds what was parsed.
+        The stream is closed either way, so an abandoned answer doesn't keep
+        its HTTP response open.
+    """
+    parser = RecommendationStreamParser()
+    usage = None
+
+    async def read():
+        nonlocal usage
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content
+            if content:
+                for item in parser.feed(content):
+                    if on_item:
+                        await on_item(item)
+
+    try:
+        await asyncio.wait_for(read(), timeout=max(deadline - time.monotonic(), 0))
+        return parser.items, usage, True
+    except asyncio.TimeoutError:
+        print(f"LLM stream reached the deadline after {len(parser.items)} recommendations")
+    except Exception as e:
+        print(f"LLM stream interrupted after {len(parser.items)} recommendations: {e!r}")
+    finally:
+        # Gateway streams are async generators (aclose), raw OpenAI streams have close()
+        close = getattr(stream, "aclose", None) or stream.close
+        await close()
+    return parser.items, usage, False
@@ -1,20 +1,107 @@
+from google.cloud.firestore_v1 import FieldPath
 from google.cloud.firestore_v1.base_query import FieldFilter
-from firebase_admin import initialize_app, firestore
+from firebase_admin import initialize_app, firestore, firestore_async
 from firebase_functions import https_fn, options
 from firebase_functions import scheduler_fn
+from firebase_functions import firestore_fn
 from firebase_admin import credentials
 from firebase_admin import storage
 import google.cloud.firestore
+import asyncio
 import json
 import os
 import re
+import threading
+import time
 from typing import Any, Dict, List
-from openai import OpenAI
 from dotenv import load_dotenv
+from recipe_ranker import add_cheapest_offers, rerank_with_llm_async, select_candidate_recipes
+from sale_index import SaleItemIndex
+from ngram_matcher import NgramMatcher
+from prompt_builder import build_matching_prompt, usage_record
+from llm_hedging import HedgedLLMCaller
+from llm_gateway import AsyncLLMGateway, gateway_available
+from llm_stream import read_recommendation_stream
+from recommendation_cache import RecommendationCache, cache_key
+from precompute_recommendations import ARTICLE_FIELDS, PRECOMPUTED_COLLECTION, format_store, precompute_all, profile_key
+from store_subscribers import refresh_store, update_subscriptions
+from product_price_index import PRICE_INDEX_COLLECTION, PREFIX_END, ProductPriceIndex, product_key
+from recipe_search import SEARCH_INDEX_BLOB, apply_queued_updates, load_search_index, queue_recipes_update
+from request_coalescing import RequestCoalescer, idempotency_key
+from catalog_cache import CatalogCache, bump_recipes_version
 
 # Load .env file if it exists (for local development)
 load_dotenv()
 
+# How recipes are matched to sale items:
+#   "llm"          - send the catalog to OpenAI (original behaviour)
+#   "local"        - deterministic local ranking engine, no OpenAI calls
+#   "local_rerank" - local ranking, OpenAI only re-ranks/explains the top candidates
+MATCHING_MODE = os.getenv("RECIPE_MATCHING_MODE", "llm")
+
+# Number of local candidates handed to the LLM in "local_rerank" mode
+RERANK_CANDIDATES = 15
+
+# Number of candidate recipes put in the LLM matching prompt ("llm" mode)
+PROMPT_TOP_K = int(os.getenv("RECIPE_PROMPT_TOP_K", "50"))
+
+# Maximum number of stores matched concurrently per request
+STORE_CONCURRENCY = int(os.getenv("RECIPE_STORE_CONCURRENCY", "4"))
+
+# Overall deadline per request; stores still being matched after it are skipped
+REQUEST_DEADLINE_SEC = float(os.getenv("RECIPE_REQUEST_DEADLINE_SEC", "120"))
+
+# Serve the nightly precomputed results when they are available for the
+# user's stores, current offers and preference profile; they come from the
+# local engine, so only "local" mode serves them
+SERVE_PRECOMPUTED = MATCHING_MODE == "local" and os.getenv("RECIPE_SERVE_PRECOMPUTED", "true").lower() == "true"
+
+# Time kept back from the deadline so a store whose LLM calls ran out of
+# time can still be ranked by the local engine
+LOCAL_RANKER_RESERVE_SEC = 1.0
+
+# Background event loop and OpenAI client, kept for the lifetime of the
+# instance so async Firestore/OpenAI connections are reused between calls
+_event_loop = None
+_event_loop_lock = threading.Lock()
+_openai_client = None
+
+# Store documents read per get_all call; larger store sets are read in parallel chunks
+GET_ALL_CHUNK_SIZE = 100
+
+# Maximum product_prices documents read for one compareProductPrices query
+PRICE_QUERY_MAX_PRODUCTS = 50
+
+# How often a warm instance checks whether the stored search index changed
+SEARCH_REFRESH_SEC = float(os.getenv("RECIPE_SEARCH_REFRESH_SEC", "60"))
+
+# Maximum number of results of one searchCatalog call
+SEARCH_MAX_RESULTS = 50
+
+# How often queued recipes changes are applied to the stored search index
+SEARCH_UPDATE_SCHEDULE = "every 5 minutes"
+
+# Search index of this instance, reloaded in the background when its Cloud
+# Storage generation changes
+_search_index = None
+_search_index_generation = None
+_search_index_checked_at = 0.0
+_search_index_refreshing = False
+_search_index_lock = threading.Lock()
+
+# Per-request documents that stores' results are written to as they finish
+REQUESTS_COLLECTION = "recipe_requests"
+
+# Recommendation results by store set, preferences and offer versions
+_recommendation_cache = RecommendationCache()
+
+# Parsed recipe catalog and store offers, validated against catalog_meta on every call
+_catalog_cache = CatalogCache()
+
+# Single-flight locks, so duplicate calls for the same user, stores and
+# preferences share one run instead of each calling the LLM
+_request_coalescer = RequestCoalescer()
+
 # Initialize Firebase app - ONLY when running locally, not in Cloud Functions
 if os.getenv('FUNCTION_TARGET') is None:
     cred = credentials.Certificate("/Users/buyn/Desktop/agnes_och_axel/serviceAccountKey.json")
@@ -35,33 +122,301 @@ def generateRecipeMatches(request: https_fn.CallableRequest) -> Dict:
     based on user preferences and sale items at allowed stores.
     
     Args:
-        request: Contains user_ref (user ID) and food_preferences (dict)
+        request: Contains user_ref (user ID) and food_preferences (dict), and
+            optionally progressive=True to return a request id right away
     
     Returns:
-        Dictionary with recommended recipes grouped by store
+        Dictionary with recommended recipes grouped by store, or with the
+        request_id of the recipe_requests document that each store's
+        recommendations are written to as soon as they are ready
     """
-    # Get Firestore client
-    db = firestore.client()
-    
     # Extract request data
     data = request.data
     user_ref = data.get("user_ref")
     food_preferences = data.get("food_preferences", {})
     
-    # Get OpenAI API key directly from environment variables
-    api_key = os.getenv('OPENAI_API_KEY')
-    if api_key:
-        print("Using OpenAI API key from environment variable")
+    if data.get("progressive"):
+        return run_async(start_progressive_request(user_ref, food_preferences))
+    
+    return run_async(coalesced_recipe_matches(user_ref, food_preferences))
+
+@firestore_fn.on_document_created(document="recipe_requests/{request_id}", timeout_sec=600, memory=options.MemoryOption.GB_2)
+def processRecipeRequest(event: firestore_fn.Event[firestore_fn.DocumentSnapshot | None]) -> None:
+    """Generate the recommendations for a progressive generateRecipeMatches request"""
+    request_data = event.data.to_dict() if event.data else {}
+    if request_data.get("status") != "pending":
+        return
+    
+    request_id = event.params["request_id"]
+    request_ref = firestore.client().collection(REQUESTS_COLLECTION).document(request_id)
+    try:
+        result = run_async(generate_recipe_matches(
+            request_data.get("user_id"), request_data.get("food_preferences", {}), request_id
+        ))
+    except Exception as e:
+        result = {"error": str(e)}
+    
+    if "error" in result:
+        request_ref.update({"status": "error", "error": result["error"], "finished_at": firestore.SERVER_TIMESTAMP})
     else:
+        request_ref.update({
+            "status": "complete",
+            "store_recommendations": result["store_recommendations"],
+            "finished_at": firestore.SERVER_TIMESTAMP
+        })
+    
+    # Duplicates get this request id until the lock expires; after an error the next call starts over
+    key = request_data.get("idempotency_key")
+    if key:
+        if "error" in result:
+            run_async(_request_coalescer.release(firestore_async.client(), key))
+        else:
+            run_async(_request_coalescer.complete(firestore_async.client(), key))
+
+@scheduler_fn.on_schedule(schedule="every day 03:00", timeout_sec=540, memory=options.MemoryOption.GB_2)
+def precomputeRecommendations(event: scheduler_fn.ScheduledEvent) -> None:
+    """Nightly batch scoring of every store x preference profile into precomputed_recommendations"""
+    precompute_all(firestore.client())
+
+@firestore_fn.on_document_written(document="users/{user_id}")
+def syncStoreSubscribers(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """Maintain the store_subscribers reverse index when users register or change stores/preferences"""
+    before = event.data.before.to_dict() if event.data.before and event.data.before.exists else {}
+    after = event.data.after.to_dict() if event.data.after and event.data.after.exists else {}
+    update_subscriptions(firestore.client(), event.params["user_id"], before, after)
+
+@firestore_fn.on_document_written(document="articles/{store_id}", timeout_sec=300, memory=options.MemoryOption.GB_1)
+def refreshStoreRecommendations(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """Recompute one store and its subscribers' views when the store's offers change"""
+    before = event.data.before.to_dict() if event.data.before and event.data.before.exists else {}
+    after = event.data.after.to_dict() if event.data.after and event.data.after.exists else {}
+    if after and before.get("offer_version") and before.get("offer_version") == after.get("offer_version"):
+        print(f"Offers of store {event.params['store_id']} unchanged, nothing to refresh")
+        return
+    refresh_store(firestore.client(), event.params["store_id"], after)
+
+@https_fn.on_call(timeout_sec=60, memory=options.MemoryOption.MB_512)
+def compareProductPrices(request: https_fn.CallableRequest) -> Dict:
+    """
+    Where a product is cheapest this week.
+    
+    Args:
+        request: Contains product (name or name prefix), optionally store_ids
+            to compare (defaults to every store) and limit
+    
+    Returns:
+        Dictionary with the cheapest offers by unit price, one per product
+    """
+    data = request.data
+    limit = parse_limit(data.get("limit", 5))
+    if limit is None:
+        return {"error": "limit must be a positive number"}
+    return run_async(compare_product_prices(data.get("product", ""), data.get("store_ids"), limit))
+
+@https_fn.on_call(timeout_sec=30, memory=options.MemoryOption.GB_1)
+def searchCatalog(request: https_fn.CallableRequest) -> Dict:
+    """
+    Full-text search over recipes and current offers, for search and type-ahead.
+    
+    Args:
+        request: Contains query, optionally kind ("recipe" or "offer"),
+            store_ids to restrict offers to, limit and prefix (default True:
+            the last word is matched as a prefix)
+    
+    Returns:
+        Dictionary with the results, best first
+    """
+    data = request.data
+    limit = parse_limit(data.get("limit", 10))
+    if limit is None:
+        return {"error": "limit must be a positive number"}
+    start = time.perf_counter()
+    results = get_search_index().search(
+        data.get("query", ""),
+        kind=data.get("kind"),
+        store_ids=data.get("store_ids"),
+        limit=min(limit, SEARCH_MAX_RESULTS),
+        prefix=data.get("prefix", True)
+    )
+    return {"status": "success", "results": results, "elapsed_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+@firestore_fn.on_document_written(document="recipes/{doc_id}")
+def indexRecipes(event: firestore_fn.Event[firestore_fn.Change[firestore_fn.DocumentSnapshot | None]]) -> None:
+    """Queue one recipes document for re-indexing and invalidate cached catalogs when it changes"""
+    db = firestore.client()
+    # Invalidate the cached catalogs first, so a failing search update can't leave them stale
+    bump_recipes_version(db)
+    queue_recipes_update(db, event.params["doc_id"])
+
+@scheduler_fn.on_schedule(schedule=SEARCH_UPDATE_SCHEDULE, timeout_sec=300, memory=options.MemoryOption.GB_1)
+def applySearchIndexUpdates(event: scheduler_fn.ScheduledEvent) -> None:
+    """Re-index the queued recipes documents with one search index snapshot update"""
+    apply_queued_updates(firestore.client(), storage.bucket())
+
+def get_search_index():
+    """
+    The instance's search index.
+    
+    Only the first call waits for the snapshot to load. Afterwards at most
+    every SEARCH_REFRESH_SEC a background thread checks whether the stored
+    snapshot changed and swaps in the new one, while calls keep being served
+    from the index already loaded.
+    """
+    global _search_index, _search_index_generation, _search_index_checked_at, _search_index_refreshing
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index, _search_index_generation = load_search_index(storage.bucket())
+            _search_index_checked_at = time.monotonic()
+            print(f"Loaded search index generation {_search_index_generation} with {len(_search_index)} documents")
+        elif not _search_index_refreshing and time.monotonic() - _search_index_checked_at >= SEARCH_REFRESH_SEC:
+            _search_index_checked_at = time.monotonic()
+            _search_index_refreshing = True
+            threading.Thread(target=refresh_search_index, daemon=True).start()
+        return _search_index
+
+def refresh_search_index():
+    """Load the stored search index if its generation changed (runs outside the lock)"""
+    global _search_index, _search_index_generation, _search_index_refreshing
+    try:
+        blob = storage.bucket().get_blob(SEARCH_INDEX_BLOB)
+        if (blob.generation if blob else 0) != _search_index_generation:
+            index, generation = load_search_index(storage.bucket())
+            with _search_index_lock:
+                _search_index, _search_index_generation = index, generation
+            print(f"Loaded search index generation {generation} with {len(index)} documents")
+    except Exception as e:
+        print(f"Error refreshing search index: {e}")
+    finally:
+        _search_index_refreshing = False
+
+def parse_limit(value):
+    """A request's result limit as a positive int, or None if it isn't one"""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return None
+    return limit if limit > 0 else None
+
+def run_async(coro):
+    """Run a coroutine on this instance's background event loop and wait for its result"""
+    global _event_loop
+    with _event_loop_lock:
+        if _event_loop is None:
+            _event_loop = asyncio.new_event_loop()
+            threading.Thread(target=_event_loop.run_forever, daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop).result()
+
+def get_openai_client():
+    """
+    Return the instance's async LLM gateway, or None if no API key is configured.
+
+    The gateway coalesces identical in-flight requests (users with the same
+    stores and preferences share one OpenAI call) and records token usage.
+    """
+    global _openai_client
+    if _openai_client is None:
+        if gateway_available():
+            print("Using OpenAI API key from environment variable")
+            _openai_client = AsyncLLMGateway(caller="generateRecipeMatches")
+            print("OpenAI client initialized successfully")
+    return _openai_client
+
+async def request_idempotency_key(db, user_ref, food_preferences, progressive=False):
+    """
+    Idempotency key of a generateRecipeMatches call, from the user, their
+    stores and preferences (one read of the user document, far cheaper than
+    the matching it can save)
+    """
+    user_doc = await db.collection("users").document(user_ref).get()
+    allowed_stores = user_doc.to_dict().get("allowed_stores", []) if user_doc.exists else []
+    mode = f"{MATCHING_MODE}:progressive" if progressive else MATCHING_MODE
+    return idempotency_key(user_ref, allowed_stores, food_preferences.get("preferences", []), mode)
+
+async def coalesced_recipe_matches(user_ref, food_preferences):
+    """generate_recipe_matches, run once for concurrent duplicates of the same call"""
+    db = firestore_async.client()
+    
+    async def compute():
+        result = await generate_recipe_matches(user_ref, food_preferences)
+        return result, result.get("match_id")
+    
+    return await _request_coalescer.run(
+        db, await request_idempotency_key(db, user_ref, food_preferences), compute,
+        lambda match_id: load_recipe_matches(db, match_id)
+    )
+
+async def load_recipe_matches(db, match_id):
+    """The generateRecipeMatches result saved as recipe_matches/{match_id}, or None if it is gone"""
+    match_doc = await db.collection("recipe_matches").document(match_id).get()
+    if not match_doc.exists:
+        return None
+    return {
+        "status": "success",
+        "store_recommendations": match_doc.to_dict().get("store_recommendations", {}),
+        "match_id": match_id
+    }
+
+async def start_progressive_request(user_ref, food_preferences):
+    """
+    Create the recipe_requests document of a progressive call, or hand out the
+    one a duplicate call already created.
+    """
+    db = firestore_async.client()
+    key = await request_idempotency_key(db, user_ref, food_preferences, progressive=True)
+    request_ref = db.collection(REQUESTS_COLLECTION).document()
+    owned, lock = await _request_coalescer.claim(db, key, {"request_id": request_ref.id})
+    if not owned:
+        print(f"Duplicate call, reusing request {lock['request_id']}")
+        return {"status": "pending", "request_id": lock["request_id"]}
+    
+    # processRecipeRequest picks the document up and fills it in store by store
+    await request_ref.set({
+        "user_id": user_ref,
+        "food_preferences": food_preferences,
+        "status": "pending",
+        "store_recommendations": {},
+        "idempotency_key": key,
+        "created_at": firestore.SERVER_TIMESTAMP
+    })
+    return {"status": "pending", "request_id": request_ref.id}
+
+async def generate_recipe_matches(user_ref, food_preferences, request_id=None):
+    """
+    Async pipeline behind generateRecipeMatches.
+    
+    Firestore reads that don't depend on each other run concurrently, and the
+    per-store matching (LLM calls) fans out in parallel, capped at
+    STORE_CONCURRENCY and bounded by REQUEST_DEADLINE_SEC. With a request_id,
+    each store is written to recipe_requests/{request_id} as soon as it is done.
+    """
+    deadline = time.monotonic() + REQUEST_DEADLINE_SEC
+    
+    # Get Firestore client
+    db = firestore_async.client()
+    
+    print(f"Recipe matching mode: {MATCHING_MODE}")
+    
+    # Get OpenAI client (API key from environment variables)
+    client = get_openai_client()
+    if client is None and MATCHING_MODE != "local":
         print("ERROR: OpenAI API key not found")
         return {"error": "OpenAI API key not found in environment variables"}
     
-    client = OpenAI(api_key=api_key)
-    print("OpenAI client initialized successfully")
+    # Versions of the recipes and every store's offers, for the instance's catalog cache
+    catalog_meta = asyncio.ensure_future(_catalog_cache.read_meta(db))
+    
+    async def read_catalog():
+        return await _catalog_cache.catalog(db, await catalog_meta, load_recipes)
+    
+    # The recipe catalog is only needed on a cache miss, but start reading it
+    # right away so a miss doesn't wait for it
+    recipes_task = asyncio.ensure_future(read_catalog())
+    
+    user_doc = await db.collection("users").document(user_ref).get()
     
-    # Get user data from Firestore
-    user_doc = db.collection("users").document(user_ref).get()
     if not user_doc.exists:
+        recipes_task.cancel()
+        catalog_meta.cancel()
         print(f"ERROR: User {user_ref} not found")
         return {"error": f"User {user_ref} not found"}
     
@@ -74,70 +429,7 @@ def generateRecipeMatches(request: https_fn.CallableRequest) -> Dict:
     print(f"Allowed stores: {allowed_stores}")
     
     # Get articles on sale from Firestore - grouped by store
-    articles_by_store = {}
-    store_names = {}  # Store store_id -> store_name mapping
-    articles_ref = db.collection("articles")
-    
-    # First, print all available stores for debugging
-    all_articles_query = articles_ref.stream()
-    all_stores = []
-    for article_doc in all_articles_query:
-        article_data = article_doc.to_dict()
-        store_id = article_data.get("store_id", "unknown")
-        if store_id not in all_stores:
-            all_stores.append(store_id)
-    
-    print(f"Available stores in database: {all_stores}")
-    
-    # Then try to find the matching stores
-    if allowed_stores:
-        try:
-            # Query the articles collection where store_id matches any of the allowed stores
-            articles_query = articles_ref.where(filter=FieldFilter("store_id", "in", allowed_stores)).stream()
-            
-            store_count = 0
-            processed_stores = set()
-            
-            for article_doc in articles_query:
-                article_data = article_doc.to_dict()
-                store_id = article_data.get("store_id")
-                store_name = article_data.get("store_name", store_id)  # Use store_id as fallback
-                
-                if store_id not in processed_stores:
-                    store_count += 1
-                    processed_stores.add(store_id)
-                    store_names[store_id] = store_name
-                
-                article_items = article_data.get("articles", [])
-                print(f"Store {store_id} ({store_name}) has {len(article_items)} articles")
-                
-                # Format the article data to match the expected format for processing
-                if store_id and article_items:
-                    formatted_articles = []
-                    for item in article_items:
-                        # Format: [name, price, discount_amount, discount_percentage]
-                        formatted_article = [
-                            item.get("name", "Unknown Item"),
-                            item.get("price", "0 kr").replace(" kr", ""),
-                            item.get("discount_amount", "0 kr").replace(" kr", ""),
-                            item.get("discount_percentage", "0%")
-                        ]
-                        formatted_articles.append(formatted_article)
-                    
-                    # Add to articles_by_store
-                    articles_by_store[store_id] = {
-                        "store_name": store_name,
-                        "articles": formatted_articles
-                    }
-            
-            print(f"Found {store_count} matching stores with articles on sale")
-            for store_id, store_data in articles_by_store.items():
-                print(f"  - Store {store_id} ({store_data['store_name']}): {len(store_data['articles'])} formatted article items")
-                
-        except Exception as e:
-            print(f"Error querying articles: {e}")
-    else:
-        print("Warning: No allowed stores specified for the user")
+    articles_by_store = await _catalog_cache.store_articles(db, await catalog_meta, allowed_stores, load_store_articles)
     
     # If no articles found, use sample data for testing
     if not articles_by_store:
@@ -158,16 +450,216 @@ def generateRecipeMatches(request: https_fn.CallableRequest) -> Dict:
             }
         }
     
-    # Get recipes from Firestore
-    recipes_data = {}
-    recipes_ref = db.collection("recipes")
-    recipes_query = recipes_ref.stream()
+    # Results can be reused while every store's offers and the recipe catalog are unchanged
+    store_versions = {store_id: store_data["offer_version"] for store_id, store_data in articles_by_store.items() if store_data.get("offer_version")}
+    cacheable = len(store_versions) == len(articles_by_store)
+    recipes_version = (await catalog_meta).get("recipes_version")
+    result_key = cache_key(store_versions, user_preferences, MATCHING_MODE, recipes_version) if cacheable else None
+    
+    # Serve the nightly precomputed results if they cover this request
+    if cacheable and SERVE_PRECOMPUTED:
+        precomputed_recommendations = await load_precomputed_recommendations(db, store_versions, user_preferences)
+        if precomputed_recommendations is not None:
+            recipes_task.cancel()
+            print(f"Serving precomputed recommendations for {len(store_versions)} stores")
+            _, match_ref = await db.collection("recipe_matches").add({
+                "user_id": user_ref,
+                "store_recommendations": precomputed_recommendations,
+                "matching_mode": MATCHING_MODE,
+                "timestamp": firestore.SERVER_TIMESTAMP
+            })
+            return {
+                "status": "success",
+                "store_recommendations": precomputed_recommendations,
+                "match_id": match_ref.id
+            }
+    
+    # Otherwise serve from the cache if these stores' current offers were
+    # already matched for the same preferences
+    if result_key:
+        cached_recommendations = await _recommendation_cache.get(db, result_key)
+        if cached_recommendations is not None:
+            recipes_task.cancel()
+            print(f"Serving cached recommendations for {len(store_versions)} stores")
+            _, match_ref = await db.collection("recipe_matches").add({
+                "user_id": user_ref,
+                "store_recommendations": cached_recommendations,
+                "matching_mode": MATCHING_MODE,
+                "timestamp": firestore.SERVER_TIMESTAMP
+            })
+            return {
+                "status": "success",
+                "store_recommendations": cached_recommendations,
+                "match_id": match_ref.id
+            }
+    
+    # Indexed by id, name and URL for resolving recommendations
+    catalog = await recipes_task
+    
+    recipe_count = len(catalog)
+    print(f"Found {recipe_count} recipes across {len(catalog.recipes_data)} categories")
+    print(f"Recipe categories: {list(catalog.recipes_data.keys())}")
+    
+    # If we have no recipes, return error
+    if recipe_count == 0:
+        print("ERROR: No recipes found in the database")
+        return {"error": "No recipes found in the database"}
+    
+    # The local ranking index is built once per catalog version and reused for every
+    # store; in "llm" mode it is the last-resort fallback when OpenAI misses the deadline
+    ranker = _catalog_cache.ranker(catalog)
+    
+    # Cheapest offer of every matched product across the user's stores, from the
+    # precomputed product_prices index (documents shared between the stores)
+    price_documents = {}
+    
+    # Process all stores concurrently, at most STORE_CONCURRENCY at a time
+    semaphore = asyncio.Semaphore(STORE_CONCURRENCY)
+    request_ref = db.collection(REQUESTS_COLLECTION).document(request_id) if request_id else None
+    if request_ref:
+        await request_ref.update({"status": "running", "total_stores": len(articles_by_store), "completed_stores": 0})
+    
+    async def process_and_publish(store_id, store_data):
+        async def publish_partial(partial_result):
+            await publish_store_result(request_ref, store_id, partial_result, completed=False)
+        
+        store_result = await process_store(
+            store_id, store_data, user_preferences, catalog, ranker, client, semaphore,
+            deadline - LOCAL_RANKER_RESERVE_SEC,
+            on_partial=publish_partial if request_ref else None
+        )
+        if store_result:
+            price_index = await load_price_index(db, store_result["recommendations"], price_documents)
+            add_cheapest_offers(store_result["recommendations"], price_index, list(articles_by_store))
+        if request_ref:
+            await publish_store_result(request_ref, store_id, store_result)
+        return store_result
+    
+    tasks = {
+        store_id: asyncio.ensure_future(process_and_publish(store_id, store_data))
+        for store_id, store_data in articles_by_store.items()
+    }
+    
+    done, pending = await asyncio.wait(tasks.values(), timeout=max(deadline - time.monotonic(), 0))
+    for task in pending:
+        task.cancel()
     
-    recipe_count = 0
-    total_recipes = 0
+    store_recommendations = {}
+    for store_id, task in tasks.items():
+        if task in pending:
+            result_key = None
+            print(f"Skipping store {store_id}: not finished before the {REQUEST_DEADLINE_SEC:.0f}s deadline")
+        elif task.exception():
+            result_key = None
+            print(f"Error processing store {store_id}: {task.exception()}")
+        elif task.result():
+            store_recommendations[store_id] = task.result()
+            if task.result().get("fallbacks"):
+                # Degraded (deadline/fallback model) results are not worth keeping
+                result_key = None
+    
+    if result_key:
+        await _recommendation_cache.put(db, result_key, store_recommendations, store_versions, user_preferences)
+        print("Cached recommendations")
+    
+    # Prepare the combined results
+    result_data = {
+        "user_id": user_ref,
+        "store_recommendations": store_recommendations,
+        "matching_mode": MATCHING_MODE,
+        "timestamp": firestore.SERVER_TIMESTAMP
+    }
+    
+    # Save results to Firestore
+    _, match_ref = await db.collection("recipe_matches").add(result_data)
+    print("Saved recommendations to Firestore")
+    
+    return {
+        "status": "success", 
+        "store_recommendations": store_recommendations,
+        "match_id": match_ref.id
+    }
+
+async def compare_product_prices(product, store_ids=None, limit=5):
+    """Cheapest offers for a product name prefix from the product_prices index"""
+    db = firestore_async.client()
+    normalized_prefix = normalize_text(product)
+    if not normalized_prefix:
+        return {"error": "No product given"}
+    
+    query = (
+        db.collection(PRICE_INDEX_COLLECTION)
+        .where(filter=FieldFilter("normalized_name", ">=", normalized_prefix))
+        .where(filter=FieldFilter("normalized_name", "<", normalized_prefix + PREFIX_END))
+        .limit(PRICE_QUERY_MAX_PRODUCTS)
+    )
+    documents = [doc.to_dict() async for doc in query.stream()]
+    offers = ProductPriceIndex.from_documents(documents).search(normalized_prefix, store_ids, limit)
+    print(f"Found {len(offers)} offers for '{product}' in {len(documents)} indexed products")
+    return {"status": "success", "offers": offers}
+
+async def load_price_index(db, recommendations, documents):
+    """
+    ProductPriceIndex over the product_prices documents of the recommended products.
+    
+    Only the documents not in documents ({document id: document or None}) yet
+    are read, in one get_all call, and added to it.
+    """
+    keys = {
+        product_key(normalize_text(savings["ingredient"]))
+        for recommendation in recommendations for savings in recommendation["savings_info"]
+    }
+    refs = [db.collection(PRICE_INDEX_COLLECTION).document(key) for key in keys if key not in documents]
+    if refs:
+        async for doc in db.get_all(refs):
+            documents[doc.id] = doc.to_dict() if doc.exists else None
+    return ProductPriceIndex.from_documents(documents[key] for key in keys if documents.get(key))
+
+async def publish_store_result(request_ref, store_id, store_result, completed=True):
+    """Write a store's (possibly still partial) result to the progressive request document"""
+    update = {"completed_stores": firestore.Increment(1)} if completed else {}
+    if store_result:
+        update[FieldPath("store_recommendations", store_id).to_api_repr()] = store_result
+    try:
+        await request_ref.update(update)
+    except Exception as e:
+        # The final status update still carries every store
+        print(f"Error publishing store {store_id} to request {request_ref.id}: {e}")
+
+async def load_precomputed_recommendations(db, store_versions, user_preferences):
+    """
+    Read the precomputed recommendations for the user's stores.
+    
+    Returns:
+        store_recommendations, or None unless every store has results for
+        its current offers and this preference profile
+    """
+    key = profile_key(user_preferences)
+    docs = await asyncio.gather(*[
+        db.collection(PRECOMPUTED_COLLECTION).document(store_id).get()
+        for store_id in store_versions
+    ])
+    
+    store_recommendations = {}
+    for store_id, doc in zip(store_versions, docs):
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        if data.get("offer_version") != store_versions[store_id] or key not in data.get("profiles", {}):
+            return None
+        if data["profiles"][key]:
+            store_recommendations[store_id] = {
+                "store_name": data.get("store_name", store_id),
+                "recommendations": data["profiles"][key]
+            }
+    return store_recommendations
+
+async def load_recipes(db):
+    """Read the recipes collection into a {category: [recipe, ...]} dict"""
+    recipes_data = {}
     
     # Process each document in the recipes collection
-    for recipe_doc in recipes_query:
+    async for recipe_doc in db.collection("recipes").stream():
         recipe_data = recipe_doc.to_dict()
         category = recipe_data.get("category", "uncategorized")
         
@@ -180,53 +672,126 @@ def generateRecipeMatches(request: https_fn.CallableRequest) -> Dict:
                 
             # Add each recipe from the array to our recipes_data structure
             for recipe_item in recipes_array:
-                recipe_count += 1
                 recipes_data[category].append({
+                    "recipe_id": recipe_item.get("recipe_id", ""),
                     "recipe_name": recipe_item.get("recipe_name", ""),
                     "recipe_url": recipe_item.get("recipe_url", ""),
                     "recipe_img": recipe_item.get("recipe_img", ""),
                     "main_ingredients": recipe_item.get("main_ingredients", []),
+                    "tags": recipe_item.get("tags", []),
                     "category": category
                 })
-                
-        total_recipes += len(recipes_array)
     
-    print(f"Found {recipe_count} recipes across {len(recipes_data)} categories")
-    print(f"Recipe categories: {list(recipes_data.keys())}")
+    return recipes_data
+
+async def load_store_articles(db, allowed_stores):
+    """
+    Read the articles on sale for the allowed stores, formatted for matching.
     
-    # If we have no recipes, return error
-    if recipe_count == 0:
-        print("ERROR: No recipes found in the database")
-        return {"error": "No recipes found in the database"}
+    articles documents are keyed by store id, so the stores are read by
+    document reference with batched get_all calls of at most GET_ALL_CHUNK_SIZE
+    documents, run in parallel, transferring only the fields used for matching:
+    one read per store, however many stores there are.
+    """
+    articles_by_store = {}
     
-    # Process each store separately and get recommendations
-    store_recommendations = {}
+    if not allowed_stores:
+        print("Warning: No allowed stores specified for the user")
+        return articles_by_store
+    
+    refs = [db.collection("articles").document(store_id) for store_id in dict.fromkeys(allowed_stores)]
+    
+    async def read_chunk(chunk):
+        return [article_doc async for article_doc in db.get_all(chunk, field_paths=ARTICLE_FIELDS)]
+    
+    try:
+        chunks = await asyncio.gather(*[
+            read_chunk(refs[start:start + GET_ALL_CHUNK_SIZE])
+            for start in range(0, len(refs), GET_ALL_CHUNK_SIZE)
+        ])
+    except Exception as e:
+        print(f"Error reading articles: {e}")
+        return articles_by_store
+    
+    for article_doc in (article_doc for chunk in chunks for article_doc in chunk):
+        if not article_doc.exists:
+            print(f"Store {article_doc.id} has no articles document")
+            continue
+        store_data = format_store(article_doc.id, article_doc.to_dict())
+        if store_data:
+            articles_by_store[article_doc.id] = store_data
     
+    print(f"Found {len(articles_by_store)} matching stores with articles on sale")
     for store_id, store_data in articles_by_store.items():
+        print(f"  - Store {store_id} ({store_data['store_name']}): {len(store_data['articles'])} formatted article items")
+    
+    return articles_by_store
+
+async def process_store(store_id, store_data, user_preferences, catalog, ranker, client, semaphore, llm_deadline, on_partial=None):
+    """
+    Generate the recommendations for one store, or None if there are none.
+    
+    on_partial, if given, is awaited with the store's result so far every
+    time another streamed LLM recommendation has been formatted.
+    """
+    async with semaphore:
         store_name = store_data["store_name"]
         store_articles = store_data["articles"]
         
+        partial_recommendations = []
+        async def publish_recommendation(formatted_recommendation):
+            partial_recommendations.append(formatted_recommendation)
+            if on_partial and len(partial_recommendations) <= 5:
+                await on_partial({"store_name": store_name, "recommendations": list(partial_recommendations)})
+        
         print(f"\nProcessing recommendations for store: {store_id} ({store_name})")
         print(f"Store has {len(store_articles)} articles on sale")
         
+        # Recipes allowed by the hard preferences, from the catalog's tag index
+        allowed_ids = catalog.ids_for_preferences(user_preferences)
+        
+        if MATCHING_MODE != "llm":
+            formatted_recommendations = await rank_store_locally(ranker, store_articles, user_preferences, allowed_ids, client)
+            print(f"Generated {len(formatted_recommendations)} local recommendations for {store_name}")
+            
+            if len(formatted_recommendations) > 0:
+                return {
+                    "store_name": store_name,
+                    "recommendations": formatted_recommendations
+                }
+            return None
+        
         # Create a store-specific articles_on_sale structure
         store_articles_on_sale = {store_id: store_articles}
         
         # Generate recommendations for this store
-        recommendations, discount_info, normalized_to_original = get_recipe_recommendations(
+        recommendations, discount_info, normalized_to_original = await get_recipe_recommendations(
             store_articles_on_sale,
             user_preferences,
-            recipes_data,
-            client
+            catalog,
+            client,
+            llm_deadline,
+            on_recommendation=publish_recommendation if on_partial else None
         )
+        fallbacks = recommendations.get("fallbacks", [])
         
-        # Process and format recommendations
-        formatted_recommendations = format_recommendations(
-            recommendations,
-            discount_info,
-            normalized_to_original,
-            recipes_data
-        )
+        def local_fallback():
+            # OpenAI didn't answer before the deadline: serve the local ranking instead
+            formatted_recommendations = ranker.rank(store_articles, user_preferences, top_k=5, allowed_ids=allowed_ids)
+            print(f"Generated {len(formatted_recommendations)} local fallback recommendations for {store_name}")
+            if len(formatted_recommendations) > 0:
+                return {
+                    "store_name": store_name,
+                    "recommendations": formatted_recommendations,
+                    "fallbacks": fallbacks
+                }
+            return None
+        
+        if recommendations.get("llm_unavailable"):
+            return local_fallback()
+        
+        # Recommendations were formatted one by one while the answer streamed in
+        formatted_recommendations = recommendations["formatted_recommendations"]
         
         print(f"Generated {len(formatted_recommendations)} formatted recommendations for {store_name}")
         
@@ -234,19 +799,20 @@ def generateRecipeMatches(request: https_fn.CallableRequest) -> Dict:
         if len(formatted_recommendations) == 0:
             print(f"No recommendations with user preferences for {store_name}, trying with default preferences")
             default_preferences = ["Easy", "Budget-friendly"]
-            recommendations, discount_info, normalized_to_original = get_recipe_recommendations(
+            recommendations, discount_info, normalized_to_original = await get_recipe_recommendations(
                 store_articles_on_sale,
                 default_preferences,
-                recipes_data,
-                client
+                catalog,
+                client,
+                llm_deadline,
+                on_recommendation=publish_recommendation if on_partial else None
             )
+            fallbacks += recommendations.get("fallbacks", [])
             
-            formatted_recommendations = format_recommendations(
-                recommendations,
-                discount_info,
-                normalized_to_original,
-                recipes_data
-            )
+            if recommendations.get("llm_unavailable"):
+                return local_fallback()
+            
+            formatted_recommendations = recommendations["formatted_recommendations"]
             print(f"Generated {len(formatted_recommendations)} recommendations with default preferences for {store_name}")
         
         # Limit to 5 recommendations per store
@@ -254,28 +820,29 @@ def generateRecipeMatches(request: https_fn.CallableRequest) -> Dict:
             formatted_recommendations = formatted_recommendations[:5]
             print(f"Limited to 5 recommendations for {store_name}")
         
-        # Store the recommendations for this store
         if len(formatted_recommendations) > 0:
-            store_recommendations[store_id] = {
+            return {
                 "store_name": store_name,
-                "recommendations": formatted_recommendations
+                "recommendations": formatted_recommendations,
+                "usage": recommendations.get("usage"),
+                "fallbacks": fallbacks
             }
+        return None
+
+async def rank_store_locally(ranker, store_articles, user_preferences, allowed_ids, client):
+    """Rank recipes for one store with the local engine, optionally re-ranked by OpenAI"""
+    top_k = RERANK_CANDIDATES if MATCHING_MODE == "local_rerank" else 5
+    recommendations = ranker.rank(store_articles, user_preferences, top_k=top_k, allowed_ids=allowed_ids)
     
-    # Prepare the combined results
-    result_data = {
-        "user_id": user_ref,
-        "store_recommendations": store_recommendations,
-        "timestamp": firestore.SERVER_TIMESTAMP
-    }
+    # Same fallback as the LLM path: drop the user preferences if nothing matched
+    if len(recommendations) == 0 and user_preferences:
+        print("No local recommendations with user preferences, trying without preferences")
+        recommendations = ranker.rank(store_articles, [], top_k=top_k)
     
-    # Save results to Firestore
-    db.collection("recipe_matches").add(result_data)
-    print("Saved recommendations to Firestore")
+    if MATCHING_MODE == "local_rerank" and client:
+        recommendations = await rerank_with_llm_async(recommendations, user_preferences, client, top_k=5)
     
-    return {
-        "status": "success", 
-        "store_recommendations": store_recommendations
-    }
+    return recommendations[:5]
 
 def normalize_text(text):
     """Normalize text for better matching (lowercase, remove special chars)"""
@@ -285,8 +852,16 @@ def normalize_text(text):
     text = re.sub(r'[^\w\s]', '', text)  # Remove special characters
     return text.strip()
 
-def get_recipe_recommendations(user_articles_on_sale, user_preferences, recipes_data, client):
-    """Use OpenAI to recommend recipes based on user preferences and sale items"""
+async def get_recipe_recommendations(user_articles_on_sale, user_preferences, catalog, client, deadline, top_k=PROMPT_TOP_K, on_recommendation=None):
+    """
+    Use OpenAI to recommend recipes based on user preferences and sale items, answering before deadline.
+    
+    With on_recommendation (progressive requests) the answer is streamed:
+    every recommendation is formatted (mapped to its savings_info) as soon as
+    its JSON object is complete and handed to on_recommendation, and a
+    cut-off stream keeps what was already parsed. Without it the call is not
+    streamed, so identical in-flight calls share one answer.
+    """
     # Extract article names and their discount information
     sale_items = []
     discount_info = {}
@@ -330,161 +905,134 @@ def get_recipe_recommendations(user_articles_on_sale, user_preferences, recipes_
     print(f"Found {len(sale_items)} unique items on sale")
     
     # Prepare the recipes data for the OpenAI prompt
-    recipes_info = []
-    recipe_count = 0
-    
-    for category, recipe_list in recipes_data.items():
-        print(f"Category '{category}' has {len(recipe_list)} recipes")
-        for recipe in recipe_list:
-            recipe_name = recipe.get("recipe_name", "")
-            main_ingredients = recipe.get("main_ingredients", [])
-            
-            recipes_info.append({
-                "recipe_name": recipe_name,
-                "main_ingredients": main_ingredients
-            })
-            recipe_count += 1
-            
-            # Limit to 100 recipes to prevent token limit issues with OpenAI
+    # Hard preferences (vegetarian, gluten-free, ...) are applied with the tag
+    # index before ranking, instead of asking the LLM to filter the catalog
+    allowed_ids = catalog.ids_for_preferences(user_preferences)
+    if allowed_ids is not None and not allowed_ids:
+        # No recipe satisfies every hard preference: skip the LLM call, the
+        # caller retries with the default preferences
+        print(f"No recipes match the preferences {user_preferences}, not calling OpenAI")
+        return {"recommendations": [], "formatted_recommendations": [], "fallbacks": []}, discount_info, normalized_to_original
+    recipes_info = catalog.prompt_entries(allowed_ids)
     
-    print(f"Sending {len(recipes_info)} recipes to OpenAI for matching")
+    # Only the top-K recipes by sale item overlap go into the prompt
+    candidate_recipes = select_candidate_recipes(recipes_info, sale_items, top_k)
+    
+    # Compact tabular prompt with short ids, trimmed to the per-call token budget
+    prompt = build_matching_prompt(sale_items, candidate_recipes, user_preferences)
+    sent_recipes = len(prompt.recipe_ids)
+    tokens_per_recipe = prompt.recipe_tokens / max(sent_recipes, 1)
+    print(f"Top-K filter kept {len(candidate_recipes)} of {len(recipes_info)} recipes, "
+          f"saving ~{int(tokens_per_recipe * (len(recipes_info) - len(candidate_recipes)))} prompt tokens")
+    if prompt.dropped_recipes:
+        print(f"Token budget dropped the {prompt.dropped_recipes} lowest-ranked candidates")
+    if prompt.dropped_sale_items:
+        print(f"Token budget dropped the {prompt.dropped_sale_items} sale items least related to the candidates")
+    
+    print(f"Sending {sent_recipes} recipes to OpenAI for matching ({prompt.prompt_tokens} prompt tokens)")
     
-    # Create the prompt for OpenAI with discount information
-    prompt = f"""
-Given the following information, recommend exactly 5 recipes that best match the user's preferences 
-and utilize ingredients that are on sale in the store.
-
-User Preferences: {user_preferences}
-
-Items on Sale with Discount Information:
-{json.dumps(sale_items, indent=2, ensure_ascii=False)}
-
-Available Recipes:
-{json.dumps(recipes_info, indent=2, ensure_ascii=False)}
-
-Important: For matching ingredients to sale items, look for common words and partial matches. For example:
-- "Ground Beef" should match "Beef", "Minced Beef", etc.
-- "Tomato Sauce" should match "Tomato", "Krossade Tomater", etc.
-- "Pasta" should match "Spaghetti", "Penne", etc.
-
-Make sure to be flexible when matching ingredient names to sale items.
-
-Return your answer as a JSON object containing exactly 5 recipe names with a list of discounted ingredients:
-{{
-  "recommendations": [
-    {{
-      "recipe_name": "Recipe Name 1",
-      "discounted_ingredients": ["Item 1 from sale items", "Item 2 from sale items", ...]
-    }},
-    // ... repeat for all 5 recipes
-  ]
-}}
-
-"""
-
     print("Calling OpenAI API...")
-    response = client.chat.completions.create(
-        model="gpt-4o",  # Using a more widely available model
+    # Hedged request that falls back to a faster model as the deadline nears.
+    # Progressive requests stream the answer (hedging then applies to the time
+    # until the stream starts answering); the others make a plain call, which
+    # the gateway coalesces with identical calls already in flight
+    streaming = on_recommendation is not None
+    stream_options = {"stream": True, "stream_options": {"include_usage": True}} if streaming else {}
+    caller = HedgedLLMCaller(client, model="gpt-4o")
+    response = await caller.create(
+        deadline,
         response_format={"type": "json_object"},
-        messages=[
-            {"role": "system", "content": "You are a culinary expert that recommends recipes based on user preferences and available ingredients. Return results in JSON format."},
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0
+        messages=prompt.messages(),
+        temperature=0,
+        **stream_options
     )
+    if response is None:
+        return {"recommendations": [], "formatted_recommendations": [], "llm_unavailable": True, "fallbacks": caller.events}, discount_info, normalized_to_original
     
-    # Parse the JSON response
-    try:
-        result = json.loads(response.choices[0].message.content)
-        recommendations = result.get("recommendations", [])
-        print(f"OpenAI returned {len(recommendations)} recommendations")
-        for i, rec in enumerate(recommendations):
-            print(f"Recipe {i+1}: {rec.get('recipe_name')} with {len(rec.get('discounted_ingredients', []))} discounted ingredients")
-        
-        return result, discount_info, normalized_to_original
-    except Exception as e:
-        print(f"Error parsing OpenAI response: {e}")
-        print("Raw response content:", response.choices[0].message.content)
-        return {"recommendations": []}, discount_info, normalized_to_original
-
-def find_recipe_details(recipe_name, recipes_data):
-    """Find full recipe details by name"""
-    for category, recipe_list in recipes_data.items():
-        for recipe in recipe_list:
-            if recipe.get("recipe_name", "") == recipe_name:
-                return recipe
-    return None
-
-def find_matching_sale_item(ingredient, discount_info, normalized_to_original):
-    """Find best matching sale item for an ingredient using fuzzy matching"""
-    normalized_ingredient = normalize_text(ingredient)
+    # Sale item indexes built once for all of this store's recommendations
+    sale_index = SaleItemIndex(discount_info)
+    ngram_matcher = NgramMatcher(list(discount_info))
+    formatted_recommendations = []
     
-    print(f"Finding matches for ingredient: '{ingredient}' (normalized: '{normalized_ingredient}')")
+    async def format_streamed(item):
+        recommendation = prompt.decode({"recommendations": [item]})["recommendations"]
+        for formatted_recommendation in format_recommendations({"recommendations": recommendation}, discount_info, normalized_to_original, catalog, sale_index, ngram_matcher):
+            formatted_recommendations.append(formatted_recommendation)
+            print(f"Recipe {len(formatted_recommendations)}: {formatted_recommendation['recipe_name']} ({formatted_recommendation['recipe_id']}) "
+                  f"with {len(formatted_recommendation['discounted_ingredients'])} discounted ingredients")
+            await on_recommendation(formatted_recommendation)
     
-    # Try exact match first
-    if ingredient in discount_info:
-        print(f"  - Exact match found: '{ingredient}'")
-        return ingredient
+    if streaming:
+        # Format each recommendation as soon as its JSON object has streamed in
+        items, usage, complete = await read_recommendation_stream(response, deadline, format_streamed)
+    else:
+        usage, complete = response.usage, True
+        try:
+            items = json.loads(response.choices[0].message.content).get("recommendations", [])
+        except Exception as e:
+            print(f"Error parsing OpenAI response: {e}")
+            print("Raw response content:", response.choices[0].message.content)
+            items = []
+        formatted_recommendations = format_recommendations(prompt.decode({"recommendations": items}), discount_info, normalized_to_original, catalog, sale_index, ngram_matcher)
+        for i, formatted_recommendation in enumerate(formatted_recommendations):
+            print(f"Recipe {i+1}: {formatted_recommendation['recipe_name']} ({formatted_recommendation['recipe_id']}) "
+                  f"with {len(formatted_recommendation['discounted_ingredients'])} discounted ingredients")
     
-    best_match = None
-    best_match_score = 0
-        
-    # Try normalized matches with different strategies
-    for product_name, info in discount_info.items():
-        normalized_product = info.get("normalized_name", "")
-        
-        # Skip empty product names
-        if not normalized_product:
-            continue
-            
-        # Strategy 1: Direct containment
-        # Check if one string contains the other
-        if normalized_ingredient in normalized_product:
-            score = len(normalized_ingredient) / len(normalized_product) * 100
-            print(f"  - Potential match (containment): '{product_name}' with score {score:.1f}")
-            if score > best_match_score:
-                best_match = product_name
-                best_match_score = score
-                
-        elif normalized_product in normalized_ingredient:
-            score = len(normalized_product) / len(normalized_ingredient) * 100
-            print(f"  - Potential match (contained in): '{product_name}' with score {score:.1f}")
-            if score > best_match_score:
-                best_match = product_name
-                best_match_score = score
-        
-        # Strategy 2: Word-level matching
-        # Check if individual words match
-        ingredient_words = set(normalized_ingredient.split())
-        product_words = set(normalized_product.split())
-        common_words = ingredient_words.intersection(product_words)
-        
-        if common_words:
-            # Calculate score based on shared words
-            score = len(common_words) / max(len(ingredient_words), len(product_words)) * 90
-            print(f"  - Potential match (word overlap): '{product_name}' with score {score:.1f}")
-            if score > best_match_score:
-                best_match = product_name
-                best_match_score = score
-    
-    # Only return match if score is good enough
-    if best_match_score > 50:
-        print(f"  => Best match: '{best_match}' with score {best_match_score:.1f}")
-        return best_match
+    result = prompt.decode({"recommendations": items})
+    result["formatted_recommendations"] = formatted_recommendations
+    result["usage"] = usage_record(prompt, usage)
+    result["fallbacks"] = caller.events
+    if not complete:
+        result["fallbacks"].append({"kind": "truncated_stream", "recommendations": len(items)})
+    print(f"OpenAI returned {len(items)} recommendations using {result['usage']}")
+    
+    return result, discount_info, normalized_to_original
+
+def find_matching_sale_item(ingredient, discount_info, normalized_to_original, sale_index=None):
+    """Find best matching sale item for an ingredient using fuzzy matching"""
+    # Build the index on the fly for one-off lookups; callers matching many
+    # ingredients against the same store should build it once and pass it in
+    if sale_index is None:
+        sale_index = SaleItemIndex(discount_info)
+    
+    best_match, best_match_score = sale_index.best_match_with_score(ingredient)
+    
+    if best_match:
+        print(f"  => Best match for '{ingredient}': '{best_match}' with score {best_match_score:.1f}")
     else:
-        print("  => No good match found")
-        return None
+        print(f"  => No good match found for '{ingredient}'")
+    return best_match
 
-def format_recommendations(recommendations, discount_info, normalized_to_original, recipes_data):
+def format_recommendations(recommendations, discount_info, normalized_to_original, catalog, sale_index=None, ngram_matcher=None):
     """Process recommendations into a structured format"""
     formatted_recommendations = []
     
+    # Index the store's sale items once for all ingredient lookups; callers
+    # formatting a store's recommendations one by one pass both indexes in
+    if sale_index is None:
+        sale_index = SaleItemIndex(discount_info)
+    
+    # Match every ingredient up front: scoring rules first, then one vectorized
+    # n-gram pass for the leftovers (Swedish inflections and compounds)
+    ingredient_matches = {}
+    for rec in recommendations.get("recommendations", []):
+        for ingredient in rec.get("discounted_ingredients", []):
+            if ingredient not in ingredient_matches:
+                ingredient_matches[ingredient] = find_matching_sale_item(ingredient, discount_info, normalized_to_original, sale_index)
+    
+    unmatched = [ingredient for ingredient, match in ingredient_matches.items() if match is None]
+    if unmatched and discount_info:
+        if ngram_matcher is None:
+            ngram_matcher = NgramMatcher(list(discount_info))
+        ngram_matches = ngram_matcher.match(unmatched)
+        print(f"N-gram matcher placed {sum(1 for match in ngram_matches.values() if match)} of {len(unmatched)} unmatched ingredients")
+        ingredient_matches.update(ngram_matches)
+    
     for rec in recommendations.get("recommendations", []):
-        recipe_name = rec.get("recipe_name", "")
         discounted_ingredients = rec.get("discounted_ingredients", [])
         
-        # Find full recipe details
-        recipe_details = find_recipe_details(recipe_name, recipes_data)
+        # Find full recipe details by id (falls back to URL and name)
+        recipe_details = catalog.resolve(rec)
         
         if recipe_details:
             # Map ingredients to their actual sale items
@@ -492,7 +1040,7 @@ def format_recommendations(recommendations, discount_info, normalized_to_origina
             savings_info = []
             
             for ingredient in discounted_ingredients:
-                matching_item = find_matching_sale_item(ingredient, discount_info, normalized_to_original)
+                matching_item = ingredient_matches.get(ingredient)
                 if matching_item:
                     mapped_ingredients.append(matching_item)
                     
@@ -510,7 +1058,8 @@ def format_recommendations(recommendations, discount_info, normalized_to_origina
             
             # Create formatted recommendation
             formatted_recommendation = {
-                "recipe_name": recipe_name,
+                "recipe_id": recipe_details["recipe_id"],
+                "recipe_name": recipe_details.get("recipe_name", ""),
                 "recipe_url": recipe_details.get("recipe_url", ""),
                 "recipe_img": recipe_details.get("recipe_img", ""),
                 "discounted_ingredients": mapped_ingredients,
@@ -0,0 +1,342 @@
+import collections
+import itertools
+import math
+import time
+
+import numpy as np
+
+from precompute_recommendations import BatchScorer
+from recipe_ranker import build_discount_info
+
+DEFAULT_RECIPE_COUNT = 5
+DEFAULT_MAX_STORES = 2
+
+# Store combinations up to this count are searched exhaustively; above it the
+# greedy search with swap improvement is used
+EXACT_SEARCH_LIMIT = 64
+
+# Even when asked for, the exhaustive search falls back to the greedy one
+# above this many combinations (~1 ms each, so it stays within ~150 ms)
+EXACT_SEARCH_MAX = 150
+
+# Recipes considered per plan slot: the ones with the largest per-slot sums,
+# before products shared between recipes are counted once
+CANDIDATE_POOL_FACTOR = 5
+
+# Savings differences below this are treated as ties (float summation noise)
+EPSILON = 1e-9
+
+
+class MealPlanner:
+    """
+    Weekly basket optimizer across a user's stores.
+
+    Every main ingredient of every recipe (a slot) can be bought at any of the
+    visited stores, saving the largest discount among that store's matching
+    offers there. Using the BatchScorer's slots x products match matrix this
+    is computed once as a dense slots x stores savings matrix.
+
+    For a fixed set of stores each slot is bought where it saves most, and
+    the N recipes are picked greedily by the savings of the products they add
+    to the basket (a product is bought once per store, however many
+    ingredients or recipes it covers). Only the store set has to be searched:
+    exhaustively when there are few combinations, otherwise by greedily
+    adding the store with the largest gain and then swapping single stores in
+    and out until no swap improves the plan. On ties the plan with fewer
+    stores wins.
+    """
+
+    def __init__(self, ranker, stores):
+        """
+        Args:
+            ranker: RecipeRanker over the recipe catalog
+            stores: {store_id: {"store_name": ..., "articles": [[name, price, discount_amount, discount_percentage], ...]}}
+        """
+        self.ranker = ranker
+        self.store_ids = list(stores)
+        self.store_names = [stores[store_id].get("store_name", store_id) for store_id in self.store_ids]
+
+        # Each store's offers are parsed once, for the match matrix and the savings
+        store_offers = [build_discount_info(stores[store_id]["articles"])[:2] for store_id in self.store_ids]
+        self.scorer = BatchScorer(ranker, profiles=[[]])
+        self.scorer.index_products(
+            info["normalized_name"] for _, discount_info in store_offers for info in discount_info.values()
+        )
+
+        # Per store: product row -> (saving, product_name, discount info) of its best offer
+        self._row_offers = []
+        self._product_savings = np.zeros((len(self.scorer.rows), len(self.store_ids)))
+        for store_idx, (sale_items, discount_info) in enumerate(store_offers):
+            row_offers = {}
+            for product_name in sale_items:
+                info = discount_info[product_name]
+                row = self.scorer.rows[info["normalized_name"]]
+                saving = info["discount_value"]
+                if row not in row_offers or saving > row_offers[row][0]:
+                    row_offers[row] = (saving, product_name, info)
+            self._row_offers.append(row_offers)
+            for row, (saving, _, _) in row_offers.items():
+                self._product_savings[row, store_idx] = saving
+
+        # Largest saving per slot and store: a max over each slot's products
+        slot_product = self.scorer.slot_product
+        starts = slot_product.indptr[:-1]
+        matched = np.flatnonzero(slot_product.indptr[1:] > starts)
+        self.savings = np.zeros((len(self.scorer.slot_pairs), len(self.store_ids)), order="F")
+        for store_idx in range(len(self.store_ids)):
+            if len(matched):
+                self.savings[matched, store_idx] = np.maximum.reduceat(
+                    self._product_savings[slot_product.indices, store_idx], starts[matched]
+                )
+        # (slot, store) -> product row of the store's best offer for the slot
+        self._slot_offers = {}
+        self._recipe_slot = self.scorer.slot_recipe.T.tocsr()
+        # Slot ids of every recipe's main ingredients (numbered consecutively per recipe)
+        self._recipe_slots = [
+            list(range(first_slot, first_slot + len(tokens)))
+            for first_slot, tokens in zip(itertools.accumulate((len(tokens) for tokens in ranker.ingredient_tokens), initial=0),
+                                          ranker.ingredient_tokens)
+        ]
+
+    def plan(self, n_recipes=DEFAULT_RECIPE_COUNT, max_stores=DEFAULT_MAX_STORES, user_preferences=None,
+             recipe_ids=None, search="auto"):
+        """
+        Choose the recipes and stores that save the most for a week.
+
+        Args:
+            n_recipes: Number of recipes in the plan
+            max_stores: Maximum number of stores to visit
+            user_preferences: Free-text preferences; excluded recipes are never chosen
+            recipe_ids: Optional set of recipe ids to choose from
+            search: "exact", "greedy" or "auto" (exact when the combinations are few);
+                "exact" falls back to greedy above EXACT_SEARCH_MAX combinations
+
+        Returns:
+            Plan dict with the chosen stores, recipes with one store per
+            ingredient, a shopping list per store and the total savings
+        """
+        start = time.perf_counter()
+        eligible = np.array([
+            self.ranker._preference_adjustment(recipe_idx, user_preferences) is not None
+            and (recipe_ids is None or recipe.get("recipe_id") in recipe_ids)
+            for recipe_idx, recipe in enumerate(self.ranker.recipes)
+        ], dtype=bool)
+
+        max_stores = max(min(max_stores, len(self.store_ids)), 0)
+        combinations = sum(math.comb(len(self.store_ids), size) for size in range(1, max_stores + 1))
+        if search == "auto":
+            search = "exact" if combinations <= EXACT_SEARCH_LIMIT else "greedy"
+        elif search == "exact" and combinations > EXACT_SEARCH_MAX:
+            print(f"{combinations} store combinations are too many for the exact search, using greedy search")
+            search = "greedy"
+
+        if search == "exact":
+            stores, value = self._exact_search(eligible, n_recipes, max_stores)
+        else:
+            stores, value = self._greedy_search(eligible, n_recipes, max_stores)
+
+        plan = self._build_plan(stores, eligible, n_recipes)
+        plan["search"] = search
+        plan["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        return plan
+
+    def _evaluate(self, stores, eligible, n_recipes):
+        """
+        Total savings of the best n_recipes when shopping at these stores, and those recipes.
+
+        Every slot is bought at the store where it saves most. The recipes are
+        then picked one at a time by the savings of the products they add to
+        the basket, so a product shared by several ingredients or recipes
+        counts once. Only the CANDIDATE_POOL_FACTOR x n_recipes recipes with
+        the largest per-slot sums (an upper bound) are considered.
+        """
+        if not stores:
+            return 0.0, []
+        # Ties go to the lowest store index, so the result doesn't depend on the order
+        stores = sorted(stores)
+        store_savings = self.savings[:, stores]
+        upper_bounds = np.where(eligible, self._recipe_slot.dot(store_savings.max(axis=1)), 0.0)
+        candidates = np.flatnonzero(upper_bounds > EPSILON)
+        pool = n_recipes * CANDIDATE_POOL_FACTOR
+        if len(candidates) > pool:
+            candidates = np.sort(candidates[np.argpartition(-upper_bounds[candidates], pool - 1)[:pool]])
+
+        candidate_slots = [self._recipe_slots[recipe_idx] for recipe_idx in candidates.tolist()]
+        slots = np.array([slot for recipe_slots in candidate_slots for slot in recipe_slots], dtype=np.int64)
+        slot_stores = dict(zip(slots.tolist(), store_savings[slots].argmax(axis=1).tolist()))
+        slot_savings = dict(zip(slots.tolist(), store_savings[slots].max(axis=1).tolist()))
+
+        # Per candidate recipe: (store, product row) -> saving of the products it needs
+        recipe_products = {}
+        product_recipes = collections.defaultdict(list)
+        for recipe_idx, recipe_slots in zip(candidates.tolist(), candidate_slots):
+            products = {}
+            for slot in recipe_slots:
+                if slot_savings[slot] > EPSILON:
+                    store = stores[slot_stores[slot]]
+                    products[(store, self._slot_offer(slot, store))] = slot_savings[slot]
+            recipe_products[recipe_idx] = products
+            for product in products:
+                product_recipes[product].append(recipe_idx)
+
+        # Savings of the products a recipe would add, lowered as the basket fills
+        gains = {recipe_idx: sum(products.values()) for recipe_idx, products in recipe_products.items()}
+        chosen, bought, total = [], set(), 0.0
+        while len(chosen) < n_recipes and gains:
+            # Largest gain first, the lowest recipe index on ties
+            recipe_idx = min(gains, key=lambda recipe_idx: (-round(gains[recipe_idx], 9), recipe_idx))
+            if gains[recipe_idx] <= EPSILON:
+                break
+            chosen.append(recipe_idx)
+            total += gains.pop(recipe_idx)
+            for product, saving in recipe_products[recipe_idx].items():
+                if product not in bought:
+                    bought.add(product)
+                    for other_idx in product_recipes[product]:
+                        if other_idx in gains:
+                            gains[other_idx] -= saving
+        return total, chosen
+
+    def _slot_offer(self, slot, store):
+        """Product row of the store's best offer for a slot (the first product on ties)"""
+        key = (slot, store)
+        if key not in self._slot_offers:
+            slot_product = self.scorer.slot_product
+            rows = slot_product.indices[slot_product.indptr[slot]:slot_product.indptr[slot + 1]]
+            self._slot_offers[key] = int(rows[np.argmax(self._product_savings[rows, store])])
+        return self._slot_offers[key]
+
+    def _exact_search(self, eligible, n_recipes, max_stores):
+        """Try every store set of up to max_stores stores, smallest sets first"""
+        best_stores, best_value = [], 0.0
+        for size in range(1, max_stores + 1):
+            for stores in itertools.combinations(range(len(self.store_ids)), size):
+                value, _ = self._evaluate(list(stores), eligible, n_recipes)
+                if value > best_value + EPSILON:
+                    best_stores, best_value = list(stores), value
+        return best_stores, best_value
+
+    def _greedy_search(self, eligible, n_recipes, max_stores):
+        """Add the store with the largest gain until max_stores, then improve by single-store swaps"""
+        chosen, best_value = [], 0.0
+        while len(chosen) < max_stores:
+            value, store = max(
+                (self._evaluate(chosen + [store], eligible, n_recipes)[0], -store)
+                for store in range(len(self.store_ids)) if store not in chosen
+            )
+            if value <= best_value + EPSILON:
+                # No store adds savings; visiting fewer stores is better
+                break
+            chosen.append(-store)
+            best_value = value
+
+        improved = True
+        while improved:
+            improved = False
+            for position in range(len(chosen)):
+                for store in range(len(self.store_ids)):
+                    if store in chosen:
+                        continue
+                    trial = chosen[:position] + [store] + chosen[position + 1:]
+                    value, _ = self._evaluate(trial, eligible, n_recipes)
+                    if value > best_value + EPSILON:
+                        chosen, best_value = trial, value
+                        improved = True
+        return sorted(chosen), best_value
+
+    def _build_plan(self, stores, eligible, n_recipes):
+        """
+        Assign every ingredient of the chosen recipes to the store where it saves most.
+
+        A product is bought once per store however many ingredients it
+        covers, so the basket cost and total savings count it once (and a
+        recipe's savings count it once within the recipe).
+        """
+        _, top = self._evaluate(stores, eligible, n_recipes)
+        slot_savings = self.savings[:, stores] if stores else None
+        shopping_lists = {self.store_ids[store]: [] for store in stores}
+        recipes = []
+        basket_cost = 0.0
+        total_savings = 0.0
+
+        for recipe_idx in top:
+            recipe = self.ranker.recipes[recipe_idx]
+            ingredient_names = recipe.get("main_ingredients", []) or []
+            ingredients = []
+            recipe_savings = 0.0
+            recipe_products = set()
+            for ingredient, slot in zip(ingredient_names, self._recipe_slots[recipe_idx]):
+                if slot_savings[slot].max() <= EPSILON:
+                    ingredients.append({"ingredient": ingredient, "store_id": None})
+                    continue
+
+                store = stores[slot_savings[slot].argmax()]
+                saving, product_name, info = self._row_offers[store][self._slot_offer(slot, store)]
+                store_id = self.store_ids[store]
+                if (store_id, product_name) not in recipe_products:
+                    recipe_products.add((store_id, product_name))
+                    recipe_savings += saving
+                if product_name not in shopping_lists[store_id]:
+                    shopping_lists[store_id].append(product_name)
+                    basket_cost += info["price_value"] or 0.0
+                    total_savings += saving
+                ingredients.append({
+                    "ingredient": ingredient,
+                    "store_id": store_id,
+                    "product": product_name,
+                    "price": info["price"],
+                    "discount_amount": info["discount_amount"],
+                })
+
+            recipes.append({
+                "recipe_id": recipe.get("recipe_id", ""),
+                "recipe_name": recipe.get("recipe_name", ""),
+                "recipe_url": recipe.get("recipe_url", ""),
+                "recipe_img": recipe.get("recipe_img", ""),
+                "savings": round(recipe_savings, 2),
+                "ingredients": ingredients,
+            })
+
+        return {
+            "stores": [{"store_id": self.store_ids[store], "store_name": self.store_names[store]} for store in stores],
+            "recipes": recipes,
+            "shopping_lists": shopping_lists,
+            "total_savings": round(total_savings, 2),
+            "basket_cost": round(basket_cost, 2),
+        }
+
+
+if __name__ == "__main__":
+    # Print the weekly plan for one user: python meal_planner.py <user_id> [n_recipes] [max_stores]
+    import json
+    import sys
+
+    from firebase_admin import credentials, firestore, initialize_app
+
+    from precompute_recommendations import ARTICLE_FIELDS, format_store, load_recipes
+    from recipe_catalog import RecipeCatalog
+    from recipe_ranker import RecipeRanker
+
+    cred = credentials.Certificate("/Users/buyn/Desktop/agnes_och_axel/serviceAccountKey.json")
+    try:
+        initialize_app(cred, {'storageBucket': 'hellopoor-16c13.appspot.com'})
+    except ValueError:
+        # App already initialized
+        pass
+
+    db = firestore.client()
+    user = db.collection("users").document(sys.argv[1]).get().to_dict() or {}
+    stores = {}
+    refs = [db.collection("articles").document(store_id) for store_id in user.get("allowed_stores", [])]
+    for article_doc in db.get_all(refs, field_paths=ARTICLE_FIELDS):
+        store_data = format_store(article_doc.id, article_doc.to_dict()) if article_doc.exists else None
+        if store_data:
+            stores[article_doc.id] = store_data
+
+    planner = MealPlanner(RecipeRanker(RecipeCatalog(load_recipes(db)).recipes_data), stores)
+    plan = planner.plan(
+        n_recipes=int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_RECIPE_COUNT,
+        max_stores=int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_MAX_STORES,
+        user_preferences=user.get("preferences", []),
+    )
+    print(json.dumps(plan, indent=2, ensure_ascii=False))
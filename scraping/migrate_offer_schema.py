@@ -0,0 +1,71 @@
+from firebase_admin import initialize_app, firestore, storage
+from firebase_admin import credentials
+from recommendation_cache import offer_version
+from offer_schema import is_typed, typed_offer
+from catalog_cache import record_store_versions
+from precompute_recommendations import format_store
+from product_price_index import rebuild_price_index
+from recipe_search import store_group, update_search_index
+
+def migrate_articles_in_firebase():
+    """
+    Add the numeric offer fields (price_value, quantity, unit, unit_price_value,
+    discount_value, discount_percent) to every article uploaded before they
+    existed. The display strings are kept; documents that are already typed
+    are left alone, so the migration can be run again safely.
+    """
+    # Initialize Firebase
+    cred = credentials.Certificate("/Users/buyn/Desktop/agnes_och_axel/serviceAccountKey.json")
+    try:
+        initialize_app(cred, {'storageBucket': 'hellopoor-16c13.appspot.com'})
+    except ValueError:
+        # App already initialized
+        pass
+
+    # Get Firestore client
+    db = firestore.client()
+
+    total_documents = 0
+    total_items_migrated = 0
+    store_versions = {}
+    search_groups = {}
+
+    print("Scanning articles collection for untyped offers...")
+
+    articles_ref = db.collection("articles")
+    for doc in articles_ref.stream():
+        total_documents += 1
+        articles = doc.to_dict().get("articles")
+        if not isinstance(articles, list):
+            continue
+
+        untyped = sum(1 for article in articles if not is_typed(article))
+        if not untyped:
+            continue
+
+        typed_articles = [article if is_typed(article) else typed_offer(article) for article in articles]
+        store_versions[doc.id] = offer_version(typed_articles)
+        # One write per store: a store's articles are ~100 KB, so a batch of
+        # a few hundred stores would exceed Firestore's 10 MiB commit limit
+        update = {"articles": typed_articles, "offer_version": store_versions[doc.id]}
+        articles_ref.document(doc.id).update(update)
+        group, value = store_group(doc.id, format_store(doc.id, {**doc.to_dict(), **update}))
+        search_groups[group] = value
+        total_items_migrated += untyped
+        print(f"Migrating store {doc.id}: {untyped} of {len(articles)} articles")
+
+    if store_versions:
+        # Warm function instances re-read the migrated stores, and the price
+        # and search indexes pick up their new offer versions
+        record_store_versions(db, store_versions)
+        rebuild_price_index(db)
+        update_search_index(storage.bucket(), search_groups)
+
+    # Print summary
+    print("\nMigration Summary:")
+    print(f"Total documents scanned: {total_documents}")
+    print(f"Documents migrated: {len(store_versions)}")
+    print(f"Total articles migrated: {total_items_migrated}")
+
+if __name__ == "__main__":
+    migrate_articles_in_firebase()
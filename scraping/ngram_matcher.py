@@ -0,0 +1,129 @@
+import functools
+import re
+
+import numpy as np
+from scipy import sparse
+
+from recipe_ranker import normalize_text
+
+NGRAM_SIZE = 3
+
+# Minimum cosine similarity for an ingredient to be matched to a sale item
+DEFAULT_THRESHOLD = 0.5
+
+
+@functools.lru_cache(maxsize=100000)
+def normalize_name(text):
+    """Normalize an ingredient or product name, dropping amounts like "500g" or "1,5 kg" (memoized)"""
+    text = normalize_text(text)
+    text = re.sub(r'\b\d+\s*(?:g|kg|ml|cl|dl|l|st|p|pack)?\b', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+@functools.lru_cache(maxsize=100000)
+def char_ngrams(text, n=NGRAM_SIZE):
+    """Character n-grams of each word, padded so word starts and ends count ("tomater" -> " to", ...)"""
+    grams = []
+    for word in normalize_name(text).split():
+        padded = f" {word} "
+        grams.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+    return tuple(grams)
+
+
+class NgramMatcher:
+    """
+    Match recipe ingredients to sale items by character n-gram similarity.
+
+    Every sale item becomes a sparse TF-IDF vector of character trigrams, so
+    Swedish inflections and compounds still overlap ("tomater" / "krossade
+    tomater", "kyckling" / "kycklingfilé"). A whole batch of ingredients is
+    scored against all sale items with a single sparse matrix product.
+    """
+
+    def __init__(self, product_names, n=NGRAM_SIZE):
+        self.n = n
+        self.products = list(product_names)
+        self.vocabulary = {}
+
+        rows, cols = [], []
+        for row, name in enumerate(self.products):
+            for gram in char_ngrams(name, n):
+                rows.append(row)
+                cols.append(self.vocabulary.setdefault(gram, len(self.vocabulary)))
+
+        counts = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(self.products), len(self.vocabulary))
+        )
+
+        # Smoothed IDF so grams shared by many products ("ing", "er ") weigh less
+        document_frequency = np.bincount(counts.indices, minlength=len(self.vocabulary))
+        self.idf = np.log((1 + len(self.products)) / (1 + document_frequency)).astype(np.float32) + 1
+        self.unknown_idf = np.float32(np.log(1 + len(self.products)) + 1)
+
+        self.product_vectors = self._normalize_rows(counts.multiply(self.idf).tocsr())
+
+    @staticmethod
+    def _normalize_rows(matrix, extra_norm_sq=None):
+        """L2-normalize the rows of a sparse matrix"""
+        norm_sq = np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+        if extra_norm_sq is not None:
+            norm_sq = norm_sq + extra_norm_sq
+        norms = np.sqrt(norm_sq)
+        norms[norms == 0] = 1
+        return sparse.diags(1 / norms).dot(matrix).tocsr()
+
+    def _vectorize(self, names):
+        """Build normalized TF-IDF vectors for query names over the product vocabulary"""
+        rows, cols = [], []
+        unknown_norm_sq = np.zeros(len(names), dtype=np.float32)
+        for row, name in enumerate(names):
+            for gram in char_ngrams(name, self.n):
+                col = self.vocabulary.get(gram)
+                if col is None:
+                    # Grams no sale item has still count towards the query's norm
+                    unknown_norm_sq[row] += self.unknown_idf ** 2
+                else:
+                    rows.append(row)
+                    cols.append(col)
+
+        counts = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.float32), (rows, cols)),
+            shape=(len(names), len(self.vocabulary))
+        )
+        return self._normalize_rows(counts.multiply(self.idf).tocsr(), unknown_norm_sq)
+
+    def similarity_matrix(self, ingredients):
+        """Cosine similarity of every ingredient (rows) against every sale item (columns)"""
+        return self._vectorize(ingredients).dot(self.product_vectors.T).tocsr()
+
+    def best_matches(self, ingredients, threshold=DEFAULT_THRESHOLD):
+        """
+        Find the best sale item for each ingredient.
+
+        Returns:
+            List of (product_name, score) per ingredient; product_name is None
+            if nothing reaches the threshold
+        """
+        if not ingredients or not self.products:
+            return [(None, 0.0) for _ in ingredients]
+
+        similarity = self.similarity_matrix(ingredients)
+        best_columns = np.asarray(similarity.argmax(axis=1)).ravel()
+        best_scores = similarity.max(axis=1).toarray().ravel()
+
+        return [
+            (self.products[col], float(score)) if score >= threshold else (None, float(score))
+            for col, score in zip(best_columns, best_scores)
+        ]
+
+    def match(self, ingredients, threshold=DEFAULT_THRESHOLD):
+        """Map each ingredient to its best matching sale item (or None) in one vectorized pass"""
+        unique_ingredients = list(dict.fromkeys(ingredients))
+        matches = self.best_matches(unique_ingredients, threshold)
+        return {ingredient: product for ingredient, (product, _) in zip(unique_ingredients, matches)}
+
+
+def match_ingredients(ingredients, product_names, threshold=DEFAULT_THRESHOLD):
+    """Map each ingredient to its best matching sale item (or None); builds the matcher for one batch"""
+    return NgramMatcher(product_names).match(ingredients, threshold)
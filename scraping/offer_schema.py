@@ -0,0 +1,93 @@
+import re
+
+# Numeric fields stored with every article next to its display strings:
+#   price_value       - price paid for the offer ("2 för 59 kr" -> 59.0), None if unknown
+#   quantity          - items the price is for (2 for "2 för 59 kr", otherwise 1)
+#   unit              - unit of unit_price_value ("st", "kg", "l", ...), None if unknown
+#   unit_price_value  - price per unit ("2 för 59 kr" -> 29.5, "119 kr/kg" -> 119.0)
+#   discount_value    - amount saved in kr (0.0 if unknown)
+#   discount_percent  - percentage saved (0.0 if unknown)
+OFFER_NUMBER_FIELDS = ["price_value", "quantity", "unit", "unit_price_value", "discount_value", "discount_percent"]
+
+
+def parse_amount(value):
+    """Parse a price string such as "59.00 kr" or "59,00" into a float (0.0 if unknown)"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not value:
+        return 0.0
+    match = re.search(r'\d+(?:[\.,]\d+)?', str(value))
+    if not match:
+        return 0.0
+    return float(match.group(0).replace(',', '.'))
+
+
+def parse_price(price):
+    """
+    Numbers of an offer price string.
+
+    "2 för 59 kr" -> (59.0, 2, "st", 29.5), "119 kr/kg" -> (119.0, 1, "kg", 119.0),
+    "99 kr" -> (99.0, 1, "st", 99.0); (None, 1, None, None) if the price has
+    no number.
+
+    Returns:
+        Tuple of (price_value, quantity, unit, unit_price_value)
+    """
+    text = str(price or "").lower()
+    multi_buy = re.search(r'(\d+)\s*för\s*(\d+(?:[\.,]\d+)?)', text)
+    if multi_buy:
+        quantity = max(int(multi_buy.group(1)), 1)
+        total = float(multi_buy.group(2).replace(',', '.'))
+        return total, quantity, "st", total / quantity
+    if not re.search(r'\d', text):
+        return None, 1, None, None
+    value = parse_amount(text)
+    unit = re.search(r'/\s*(kg|st|l|liter|förp)\b', text)
+    return value, 1, unit.group(1) if unit else "st", value
+
+
+def offer_values(price, discount_amount, discount_percentage):
+    """The OFFER_NUMBER_FIELDS of an offer, parsed from its display strings"""
+    price_value, quantity, unit, unit_price_value = parse_price(price)
+    return {
+        "price_value": price_value,
+        "quantity": quantity,
+        "unit": unit,
+        "unit_price_value": unit_price_value,
+        "discount_value": parse_amount(discount_amount),
+        "discount_percent": parse_amount(discount_percentage)
+    }
+
+
+def typed_offer(item):
+    """An article ({"name", "price", "discount_amount", "discount_percentage"}) with its numeric fields added"""
+    return {**item, **offer_values(item.get("price"), item.get("discount_amount"), item.get("discount_percentage"))}
+
+
+def is_typed(item):
+    """Whether a stored article already carries the numeric fields"""
+    return all(field in item for field in OFFER_NUMBER_FIELDS)
+
+
+def format_article(item):
+    """
+    A stored article formatted for matching.
+
+    Returns:
+        [name, price, discount_amount, discount_percentage, numbers], where
+        numbers holds the OFFER_NUMBER_FIELDS and the product_id of the
+        product catalog (if assigned); articles stored before the numeric
+        fields existed are parsed
+    """
+    if not is_typed(item):
+        item = typed_offer(item)
+    numbers = {field: item[field] for field in OFFER_NUMBER_FIELDS}
+    if item.get("product_id"):
+        numbers["product_id"] = item["product_id"]
+    return [
+        item.get("name", "Unknown Item"),
+        item.get("price", "0 kr"),
+        item.get("discount_amount", "0 kr"),
+        item.get("discount_percentage", "0%"),
+        numbers
+    ]
@@ -0,0 +1,274 @@
+import time
+
+import numpy as np
+from firebase_admin import firestore
+from scipy import sparse
+
+from offer_schema import format_article
+from recipe_catalog import RecipeCatalog
+from recipe_ranker import RecipeRanker, build_discount_info
+from recommendation_cache import normalize_preferences, offer_version
+
+PRECOMPUTED_COLLECTION = "precomputed_recommendations"
+
+# Preference profiles scored for every store: no preference plus each
+# preference offered in the app
+PREFERENCE_PROFILES = [
+    [],
+    ["High Protein"],
+    ["Vegetarian"],
+    ["Swedish"],
+    ["Italian"],
+    ["Chicken"],
+    ["Asian"],
+    ["Gluten-free"],
+]
+
+TOP_K = 5
+
+# Firestore batches hold at most 500 writes
+WRITE_BATCH_SIZE = 400
+
+# Fields of an articles/{store_id} document that format_store reads (field mask for reads)
+ARTICLE_FIELDS = ["store_name", "offer_version", "articles"]
+
+
+def profile_key(preferences):
+    """Key of a preference profile in the precomputed documents"""
+    return "+".join(normalize_preferences(preferences)) or "default"
+
+
+def _binary_rows(columns_per_row, column_count):
+    """Sparse 0/1 matrix with a row per list of column indices"""
+    indptr = np.zeros(len(columns_per_row) + 1, dtype=np.int64)
+    np.cumsum([len(columns) for columns in columns_per_row], out=indptr[1:])
+    indices = np.fromiter((column for columns in columns_per_row for column in columns), dtype=np.int64, count=indptr[-1])
+    return sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(columns_per_row), column_count))
+
+
+class BatchScorer:
+    """
+    Score every store against every preference profile in bulk.
+
+    Gives the same ranking as RecipeRanker.rank, but the sale-item lookups
+    are done once per distinct product name across all stores, producing a
+    sparse products x ingredient-slots match matrix (a slot is one main
+    ingredient of one recipe). A store is then scored with two sparse
+    operations: the best discount weight per slot (max over the store's
+    products) and the per-recipe sum (slots x recipes product). All
+    profiles are applied at once as a recipes x profiles multiplier matrix,
+    restricted per profile to the catalog's ids_for_preferences when a
+    catalog is given.
+    """
+
+    def __init__(self, ranker, profiles=PREFERENCE_PROFILES, catalog=None):
+        self.ranker = ranker
+        self.profiles = profiles
+
+        slot_recipes = []
+        self.slot_ids = {}
+        for recipe_idx, tokens_per_ingredient in enumerate(ranker.ingredient_tokens):
+            for ingredient_idx in range(len(tokens_per_ingredient)):
+                self.slot_ids[(recipe_idx, ingredient_idx)] = len(slot_recipes)
+                slot_recipes.append(recipe_idx)
+        self.slot_pairs = list(self.slot_ids)
+
+        recipe_count = len(ranker.recipes)
+        self.slot_recipe = sparse.csr_matrix(
+            (np.ones(len(slot_recipes), dtype=np.float64), (np.arange(len(slot_recipes)), slot_recipes)),
+            shape=(len(slot_recipes), recipe_count)
+        )
+        self.ingredient_counts = np.array([max(len(tokens), 1) for tokens in ranker.ingredient_tokens], dtype=np.float64)
+
+        # Preference multipliers per recipe and profile; NaN marks excluded recipes
+        self.multipliers = np.full((recipe_count, len(profiles)), np.nan)
+        for profile_idx, preferences in enumerate(profiles):
+            allowed_ids = catalog.ids_for_preferences(preferences) if catalog is not None else None
+            for recipe_idx in range(recipe_count):
+                multiplier = ranker._preference_adjustment(recipe_idx, preferences, allowed_ids)
+                if multiplier is not None:
+                    self.multipliers[recipe_idx, profile_idx] = multiplier
+
+        self.rows = {}
+        # Token ids of every indexed product name, and the slots of every token
+        self._name_tokens = []
+        self._token_ids = {}
+        self._token_slots = []
+
+    def build_product_matrix(self, stores):
+        """Look up the ingredient slots of every distinct product name once"""
+        normalized_names = []
+        for store_data in stores.values():
+            _, discount_info, _ = build_discount_info(store_data["articles"])
+            normalized_names.extend(info["normalized_name"] for info in discount_info.values())
+        self.index_products(normalized_names)
+
+    def index_products(self, normalized_names):
+        """
+        Add the product names not indexed yet and rebuild the slots x products matrix.
+
+        A token's slots are looked up once, however many product names share
+        it; the matrix is the (binarized) product of the products x tokens
+        and tokens x slots matrices.
+        """
+        for normalized_name in normalized_names:
+            if normalized_name in self.rows:
+                continue
+            token_ids = []
+            for token in set(normalized_name.split()):
+                if token not in self._token_ids:
+                    self._token_ids[token] = len(self._token_slots)
+                    self._token_slots.append([self.slot_ids[pair] for pair in self.ranker._lookup_token(token)])
+                token_ids.append(self._token_ids[token])
+            self.rows[normalized_name] = len(self._name_tokens)
+            self._name_tokens.append(token_ids)
+
+        token_slot = _binary_rows(self._token_slots, len(self.slot_pairs))
+        product_slot = _binary_rows(self._name_tokens, len(self._token_slots)).dot(token_slot).tocsr()
+        product_slot.data[:] = 1.0
+        # slots x products, so one store's weights scale the columns
+        self.slot_product = product_slot.T.tocsr()
+
+    def score_store(self, articles, top_k=TOP_K):
+        """
+        Rank the recipes for one store under every profile.
+
+        Returns:
+            {profile_key: [recommendation, ...]} in RecipeRanker.rank format
+        """
+        sale_items, discount_info, _ = build_discount_info(articles)
+
+        # Best weight per product row, keeping the first product on ties like the ranker
+        weights = np.zeros(len(self._name_tokens))
+        row_products = {}
+        for position, product_name in enumerate(sale_items):
+            info = discount_info[product_name]
+            row = self.rows[info["normalized_name"]]
+            weight = 1.0 + info["discount_percent"] / 100
+            row_products.setdefault(row, []).append((weight, -position, product_name))
+            weights[row] = max(weights[row], weight)
+
+        slot_weights = self.slot_product.multiply(weights).tocsr().max(axis=1).toarray().ravel()
+        base_scores = self.slot_recipe.T.dot(slot_weights)
+        coverage = self.slot_recipe.T.dot((slot_weights > 0).astype(np.float64)) / self.ingredient_counts
+        scores = base_scores[:, None] * self.multipliers
+
+        results = {}
+        for profile_idx, preferences in enumerate(self.profiles):
+            top = self._top_recipes(scores[:, profile_idx], coverage, top_k)
+            results[profile_key(preferences)] = [
+                self._format(recipe_idx, scores[recipe_idx, profile_idx], slot_weights, row_products, discount_info)
+                for recipe_idx in top
+            ]
+
+        # Same fallback as the request path: drop the preferences if nothing matched
+        default_key = profile_key([])
+        for key, recommendations in results.items():
+            if not recommendations:
+                results[key] = results[default_key]
+        return results
+
+    @staticmethod
+    def _top_recipes(scores, coverage, top_k):
+        """Recipe indexes by score, then coverage, then catalog order"""
+        candidates = np.flatnonzero(np.nan_to_num(scores) > 0)
+        # Rounded so summation order noise doesn't decide ties
+        order = np.lexsort((candidates, -np.round(coverage[candidates], 9), -np.round(scores[candidates], 9)))
+        return candidates[order[:top_k]]
+
+    def _format(self, recipe_idx, score, slot_weights, row_products, discount_info):
+        """Build the recommendation, picking the matched product per ingredient like the ranker"""
+        matches = {}
+        for ingredient_idx in range(len(self.ranker.ingredient_tokens[recipe_idx])):
+            slot = self.slot_ids[(recipe_idx, ingredient_idx)]
+            if slot_weights[slot] <= 0:
+                continue
+            rows = self.slot_product.indices[self.slot_product.indptr[slot]:self.slot_product.indptr[slot + 1]]
+            weight, _, product_name = max(product for row in rows for product in row_products.get(row, ()))
+            matches[ingredient_idx] = (weight, product_name)
+        return self.ranker._format(recipe_idx, matches, discount_info, float(score))
+
+
+def load_recipes(db):
+    """Read the recipes collection into a {category: [recipe, ...]} dict"""
+    recipes_data = {}
+    for recipe_doc in db.collection("recipes").stream():
+        recipe_data = recipe_doc.to_dict()
+        category = recipe_data.get("category", "uncategorized")
+        for recipe_item in recipe_data.get("recipes", []):
+            recipes_data.setdefault(category, []).append(dict(recipe_item, category=category))
+    return recipes_data
+
+
+def format_store(store_id, article_data):
+    """Format an articles/{store_id} document for matching, or None if it has no offers"""
+    article_items = article_data.get("articles", [])
+    if not article_items:
+        return None
+    return {
+        "store_name": article_data.get("store_name", store_id),
+        "offer_version": article_data.get("offer_version") or offer_version(article_items),
+        "articles": [format_article(item) for item in article_items]
+    }
+
+
+def load_stores(db):
+    """Read every store's offers, formatted for matching"""
+    stores = {}
+    for article_doc in db.collection("articles").stream():
+        article_data = article_doc.to_dict()
+        store_id = article_data.get("store_id") or article_doc.id
+        store_data = format_store(store_id, article_data)
+        if store_data:
+            stores[store_id] = store_data
+    return stores
+
+
+def precomputed_document(store_id, store_data, scorer):
+    """The precomputed_recommendations document for one store"""
+    return {
+        "store_id": store_id,
+        "store_name": store_data["store_name"],
+        "offer_version": store_data["offer_version"],
+        "profiles": scorer.score_store(store_data["articles"]),
+        "computed_at": firestore.SERVER_TIMESTAMP
+    }
+
+
+def precompute_all(db):
+    """Score every store x preference profile and write one precomputed document per store"""
+    start = time.perf_counter()
+    catalog = RecipeCatalog(load_recipes(db))
+    stores = load_stores(db)
+    print(f"Loaded {len(catalog)} recipes and {len(stores)} stores in {time.perf_counter() - start:.1f}s")
+
+    scorer = BatchScorer(RecipeRanker(catalog.recipes_data), catalog=catalog)
+    scorer.build_product_matrix(stores)
+    print(f"Matched {len(scorer.rows)} distinct products against {len(scorer.slot_pairs)} recipe ingredients")
+
+    batch = db.batch()
+    pending_writes = 0
+    for store_id, store_data in stores.items():
+        batch.set(db.collection(PRECOMPUTED_COLLECTION).document(store_id), precomputed_document(store_id, store_data, scorer))
+        pending_writes += 1
+        if pending_writes >= WRITE_BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending_writes = 0
+    if pending_writes:
+        batch.commit()
+
+    print(f"Precomputed {len(stores)} stores x {len(scorer.profiles)} profiles in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    from firebase_admin import initialize_app, credentials
+
+    cred = credentials.Certificate("/Users/buyn/Desktop/agnes_och_axel/serviceAccountKey.json")
+    try:
+        initialize_app(cred, {'storageBucket': 'hellopoor-16c13.appspot.com'})
+    except ValueError:
+        # App already initialized
+        pass
+
+    precompute_all(firestore.client())
@@ -0,0 +1,359 @@
+import collections
+import hashlib
+import re
+import zlib
+
+import numpy as np
+from firebase_admin import firestore
+
+from catalog_cache import record_store_versions
+from offer_schema import is_typed, typed_offer
+from precompute_recommendations import WRITE_BATCH_SIZE, format_store
+from product_price_index import rebuild_price_index
+from recipe_ranker import normalize_text
+from recipe_search import store_group, update_search_index
+from recommendation_cache import offer_version
+
+# product_catalog/{product_id}: {"name": ..., "normalized_name": ..., "aliases": [normalized names], "store_count": n}
+PRODUCT_CATALOG_COLLECTION = "product_catalog"
+
+# MinHash signature length, split into LSH bands of BAND_ROWS rows; names
+# sharing any band are compared. The band threshold (1 / BANDS) ** (1 / BAND_ROWS)
+# is about 0.6: a pair with 0.8 similarity is found with ~99% probability, one
+# at SIMILARITY_THRESHOLD with ~60%
+MINHASH_PERMUTATIONS = 60
+BAND_ROWS = 5
+BANDS = MINHASH_PERMUTATIONS // BAND_ROWS
+
+# Minimum Jaccard similarity of the names' character trigrams for a candidate pair
+SIMILARITY_THRESHOLD = 0.6
+
+# Words shorter than this must match exactly ("ris" and "ost" are different products)
+MIN_TYPO_WORD_LENGTH = 4
+
+# Buckets holding more names than this are skipped (very common shingles, not near-duplicates)
+MAX_BUCKET_SIZE = 50
+
+# Fixed seed, so signatures (and clusters) are the same on every run
+MINHASH_SEED = 20240601
+
+# Names whose signatures are computed at once (bounds the temporary arrays)
+SIGNATURE_CHUNK_SIZE = 4096
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+
+def product_key(name):
+    """Normalized product name with runs of whitespace collapsed, the unit that is clustered"""
+    return " ".join(normalize_text(name).split())
+
+
+def shingles(normalized_name):
+    """Character trigrams of a normalized product name (word boundaries included)"""
+    padded = f" {normalized_name} "
+    return {padded[i:i + 3] for i in range(max(len(padded) - 2, 1))}
+
+
+def _one_edit_apart(first, second):
+    """Whether two different words differ by one inserted, deleted or replaced letter"""
+    if abs(len(first) - len(second)) > 1 or max(len(first), len(second)) < MIN_TYPO_WORD_LENGTH:
+        return False
+    prefix = 0
+    while prefix < min(len(first), len(second)) and first[prefix] == second[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < min(len(first), len(second)) - prefix
+           and first[len(first) - 1 - suffix] == second[len(second) - 1 - suffix]):
+        suffix += 1
+    return prefix + suffix >= max(len(first), len(second)) - 1
+
+
+def spelling_variants(first, second):
+    """
+    Whether two normalized names are the same product spelled differently.
+
+    The names must have the same words in the same order, except for at most
+    one word with a typo (one letter off). An extra or a replaced word
+    ("färsk", a second brand, "ris" for "ost") is a different product, and
+    so is any different number (size, fat percentage).
+    """
+    first_words, second_words = first.split(), second.split()
+    if len(first_words) != len(second_words):
+        return False
+    different = [(a, b) for a, b in zip(first_words, second_words) if a != b]
+    return len(different) <= 1 and all(
+        not re.search(r'\d', a + b) and _one_edit_apart(a, b) for a, b in different
+    )
+
+
+def minhash_signatures(shingle_sets):
+    """
+    MinHash signatures of shingle sets.
+
+    Returns:
+        uint64 array of shape (len(shingle_sets), MINHASH_PERMUTATIONS)
+    """
+    rng = np.random.default_rng(MINHASH_SEED)
+    a = rng.integers(1, 1 << 31, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+    b = rng.integers(0, 1 << 31, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+    signatures = np.empty((len(shingle_sets), MINHASH_PERMUTATIONS), dtype=np.uint64)
+    for start in range(0, len(shingle_sets), SIGNATURE_CHUNK_SIZE):
+        chunk = shingle_sets[start:start + SIGNATURE_CHUNK_SIZE]
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle_set in chunk for shingle in shingle_set),
+                             dtype=np.uint64)
+        offsets = np.cumsum([0] + [len(shingle_set) for shingle_set in chunk[:-1]])
+        # (a * x + b) mod p per permutation; x < 2^32 and a < 2^31 keep the product below 2^63
+        permuted = (hashes[:, None] * a + b) % _MERSENNE_PRIME
+        signatures[start:start + len(chunk)] = np.minimum.reduceat(permuted, offsets, axis=0)
+    return signatures
+
+
+def near_duplicate_pairs(normalized_names):
+    """
+    Index pairs of names that are near-duplicates, found with MinHash LSH.
+
+    Candidate pairs share a band of their signatures; they are kept if the
+    exact Jaccard similarity of their trigrams reaches SIMILARITY_THRESHOLD
+    and they are spelling_variants of each other.
+    """
+    shingle_sets = [shingles(name) for name in normalized_names]
+    signatures = minhash_signatures(shingle_sets)
+
+    # One uint64 key per name and band (a random linear combination of the band's rows)
+    mixers = np.random.default_rng(MINHASH_SEED + 1).integers(1, 1 << 63, size=BAND_ROWS, dtype=np.uint64)
+    candidates = set()
+    for band in range(BANDS):
+        keys = signatures[:, band * BAND_ROWS:(band + 1) * BAND_ROWS] @ mixers
+        order = np.argsort(keys, kind="stable")
+        boundaries = np.flatnonzero(np.diff(keys[order])) + 1
+        for members in np.split(order, boundaries):
+            if 1 < len(members) <= MAX_BUCKET_SIZE:
+                members = members.tolist()
+                candidates.update((first, second) for i, first in enumerate(members) for second in members[i + 1:])
+
+    pairs = []
+    for first, second in candidates:
+        intersection = len(shingle_sets[first] & shingle_sets[second])
+        similarity = intersection / (len(shingle_sets[first]) + len(shingle_sets[second]) - intersection)
+        if similarity >= SIMILARITY_THRESHOLD and spelling_variants(normalized_names[first], normalized_names[second]):
+            pairs.append((first, second))
+    return pairs
+
+
+def new_product_id(normalized_name, taken=()):
+    """
+    Id of a new product, derived from its canonical normalized name.
+
+    When a split cluster's canonical name hashes to the id the other part
+    kept, a counter suffix ("-2", "-3", ...) makes it unique.
+    """
+    product_id = "p" + hashlib.sha1(normalized_name.encode("utf-8")).hexdigest()[:10]
+    candidate, suffix = product_id, 1
+    while candidate in taken:
+        suffix += 1
+        candidate = f"{product_id}-{suffix}"
+    return candidate
+
+
+class ProductCatalog:
+    """
+    Catalog of the distinct products on offer across all stores.
+
+    The same product appears in hundreds of stores' offers, sometimes spelled
+    slightly differently ("Halloumi Apetina", "Halloumi  Apetina.",
+    "Haloumi Apetina"). Names are grouped by their normalized form, and
+    normalized forms that are spelling variants (candidates from MinHash LSH
+    over character trigrams, confirmed with the exact similarity and a
+    word-by-word comparison allowing one typo) are merged with a union-find
+    into one product. The clustering errs on the side of splitting: a name
+    with an extra word or a typo in a short word stays a product of its own.
+    Every product has an id that stays the same across rebuilds: a cluster
+    keeps the id its names had in the previous catalog, and only new products
+    get a new id.
+
+    Offers carry the id (see format_article). Its only consumer so far is
+    ProductPriceIndex, which compares a product's offers across the stores
+    that spell it differently; matching, the batch scorer and search still
+    work on the offer names.
+    """
+
+    def __init__(self):
+        self.products = {}
+        self.by_name = {}
+
+    @classmethod
+    def build(cls, names, previous=None):
+        """
+        Cluster product names into a catalog.
+
+        Args:
+            names: Product names as offered, one per offer (repeats count the stores)
+            previous: Optional previous ProductCatalog whose ids are kept
+
+        Returns:
+            ProductCatalog
+        """
+        counts = collections.Counter()
+        display_names = {}
+        for name in names:
+            normalized_name = product_key(name)
+            if not normalized_name:
+                continue
+            counts[normalized_name] += 1
+            display_counts = display_names.setdefault(normalized_name, collections.Counter())
+            display_counts[name] += 1
+
+        normalized_names = sorted(counts)
+        parent = list(range(len(normalized_names)))
+
+        def find(idx):
+            while parent[idx] != idx:
+                parent[idx] = parent[parent[idx]]
+                idx = parent[idx]
+            return idx
+
+        for first, second in near_duplicate_pairs(normalized_names):
+            first_root, second_root = find(first), find(second)
+            if first_root != second_root:
+                parent[max(first_root, second_root)] = min(first_root, second_root)
+
+        clusters = collections.defaultdict(list)
+        for name_idx, normalized_name in enumerate(normalized_names):
+            clusters[find(name_idx)].append(normalized_name)
+
+        catalog = cls()
+        # Most offered products first, so they win a previous id two clusters share
+        for aliases in sorted(clusters.values(), key=lambda aliases: (-sum(counts[alias] for alias in aliases), aliases[0])):
+            canonical = min(aliases, key=lambda alias: (-counts[alias], len(alias), alias))
+            previous_ids = collections.Counter(
+                previous.by_name[alias] for alias in aliases if previous and alias in previous.by_name
+            )
+            product_id = next((product_id for product_id, _ in previous_ids.most_common() if product_id not in catalog.products),
+                              new_product_id(canonical, catalog.products))
+            catalog._add(product_id, {
+                "name": display_names[canonical].most_common(1)[0][0],
+                "normalized_name": canonical,
+                "aliases": aliases,
+                "store_count": sum(counts[alias] for alias in aliases)
+            })
+
+        print(f"Product catalog: {len(counts)} distinct names in {sum(counts.values())} offers -> {len(catalog)} products")
+        return catalog
+
+    @classmethod
+    def from_documents(cls, documents):
+        """Load a catalog from (product_id, product_catalog document) pairs"""
+        catalog = cls()
+        for product_id, document in documents:
+            catalog._add(product_id, document)
+        return catalog
+
+    def __len__(self):
+        return len(self.products)
+
+    def _add(self, product_id, product):
+        self.products[product_id] = product
+        for alias in product["aliases"]:
+            self.by_name[alias] = product_id
+
+    def product_id(self, name):
+        """Id of the product an offered name belongs to, or None if it isn't in the catalog"""
+        return self.by_name.get(product_key(name))
+
+    def documents(self):
+        """(document id, product_catalog document) for every product"""
+        return self.products.items()
+
+
+def load_product_catalog(db):
+    """The stored product catalog (empty if there is none yet)"""
+    return ProductCatalog.from_documents(
+        (doc.id, doc.to_dict()) for doc in db.collection(PRODUCT_CATALOG_COLLECTION).stream()
+    )
+
+
+def save_product_catalog(db, catalog):
+    """Write the catalog's products and delete the products that no longer exist"""
+    collection = db.collection(PRODUCT_CATALOG_COLLECTION)
+    batch = db.batch()
+    pending_writes = 0
+
+    def flush():
+        nonlocal batch, pending_writes
+        if pending_writes:
+            batch.commit()
+            batch = db.batch()
+            pending_writes = 0
+
+    for product_id, product in catalog.documents():
+        batch.set(collection.document(product_id), dict(product, updated_at=firestore.SERVER_TIMESTAMP))
+        pending_writes += 1
+        if pending_writes >= WRITE_BATCH_SIZE:
+            flush()
+
+    stale = 0
+    for doc_ref in collection.list_documents():
+        if doc_ref.id not in catalog.products:
+            batch.delete(doc_ref)
+            stale += 1
+            pending_writes += 1
+            if pending_writes >= WRITE_BATCH_SIZE:
+                flush()
+    flush()
+    print(f"Saved {len(catalog)} products ({stale} stale products removed)")
+
+
+def rebuild_product_catalog(db, bucket):
+    """
+    Rebuild the catalog from every store's offers and point the offers at it.
+
+    Offers whose product id changed are rewritten (with a new offer_version,
+    published to catalog_meta), so the articles documents uploaded before the
+    catalog existed get their ids too. The price index is then rebuilt and
+    the rewritten stores are re-indexed for search.
+    """
+    article_docs = {doc.id: doc.to_dict() for doc in db.collection("articles").stream()}
+    catalog = ProductCatalog.build(
+        (article.get("name", "") for data in article_docs.values() for article in data.get("articles", [])),
+        previous=load_product_catalog(db)
+    )
+    save_product_catalog(db, catalog)
+
+    store_versions = {}
+    search_groups = {}
+    for store_id, data in article_docs.items():
+        articles = data.get("articles", [])
+        if all(article.get("product_id") == catalog.product_id(article.get("name", "")) for article in articles):
+            continue
+        articles = [
+            dict(article if is_typed(article) else typed_offer(article), product_id=catalog.product_id(article.get("name", "")))
+            for article in articles
+        ]
+        store_versions[store_id] = offer_version(articles)
+        # One write per store: a store's articles are ~100 KB, so a batch of
+        # a few hundred stores would exceed Firestore's 10 MiB commit limit
+        update = {"articles": articles, "offer_version": store_versions[store_id]}
+        db.collection("articles").document(store_id).update(update)
+        group, value = store_group(store_id, format_store(store_id, {**data, **update}))
+        search_groups[group] = value
+
+    if store_versions:
+        record_store_versions(db, store_versions)
+        rebuild_price_index(db)
+        update_search_index(bucket, search_groups)
+    print(f"Pointed the offers of {len(store_versions)} stores at the product catalog")
+    return catalog
+
+
+if __name__ == "__main__":
+    from firebase_admin import initialize_app, credentials, storage
+
+    cred = credentials.Certificate("/Users/buyn/Desktop/agnes_och_axel/serviceAccountKey.json")
+    try:
+        initialize_app(cred, {'storageBucket': 'hellopoor-16c13.appspot.com'})
+    except ValueError:
+        # App already initialized
+        pass
+
+    rebuild_product_catalog(firestore.client(), storage.bucket())
@@ -0,0 +1,223 @@
+import bisect
+import collections
+import hashlib
+import heapq
+
+from firebase_admin import firestore
+
+from precompute_recommendations import WRITE_BATCH_SIZE, load_stores
+from recipe_ranker import build_discount_info, normalize_text
+
+# product_prices/{product_key}: {"normalized_name": ..., "offers": [offer, ...] sorted by unit price}
+PRICE_INDEX_COLLECTION = "product_prices"
+
+# Sorts after every character used in product names; prefix + PREFIX_END is
+# the upper bound of a prefix range (same convention as Firestore range queries)
+PREFIX_END = "\uf8ff"
+
+
+def product_key(normalized_name):
+    """Document id for a product (names can contain characters ids can't)"""
+    return hashlib.sha1(normalized_name.encode("utf-8")).hexdigest()[:20]
+
+
+def rank_offers(offers, limit=None):
+    """
+    Offers cheapest first by unit price, compared within a unit only.
+
+    Prices per kg, per piece and per liter can't be compared with each other,
+    so the offers are grouped by unit, the unit most of them are priced in
+    first, and sorted by unit price (ties by store id) within each group;
+    offers without a price come last.
+    """
+    offers = list(offers)
+    unit_counts = collections.Counter(offer.get("unit") for offer in offers if offer.get("unit_price") is not None)
+
+    def order(offer):
+        price = offer.get("unit_price")
+        unit = offer.get("unit")
+        return (price is None, -unit_counts[unit], unit or "", price or 0.0, offer.get("store_id", ""))
+
+    if limit is None:
+        return sorted(offers, key=order)
+    return heapq.nsmallest(limit, offers, key=order)
+
+
+class ProductPriceIndex:
+    """
+    Cross-store index of this week's offers by normalized product name.
+
+    Every product's offers are kept sorted by unit price (within a unit, see
+    rank_offers), with the cheapest offer per store also reachable by store
+    id, and the product names are
+    kept in a sorted list. Finding a product, or every product starting with
+    a prefix, is a binary search; the best offers among k of the user's
+    stores then take k dictionary lookups instead of a scan of every store's
+    articles. Names that the product catalog maps to the same product id are
+    compared together, so a product is found whatever each store calls it.
+    """
+
+    def __init__(self, stores=None):
+        """
+        Args:
+            stores: Optional {store_id: {"store_name": ..., "articles": [[name, price, discount_amount, discount_percentage], ...]}}
+        """
+        self.offers = {}
+        self._by_store = {}
+        self._product_ids = {}
+        self._aliases = {}
+        self.names = []
+        for store_id, store_data in (stores or {}).items():
+            _, discount_info, _ = build_discount_info(store_data["articles"])
+            for product_name, info in discount_info.items():
+                self._add(info["normalized_name"], {
+                    "store_id": store_id,
+                    "store_name": store_data.get("store_name", store_id),
+                    "name": product_name,
+                    "price": info["price"],
+                    "unit_price": info["unit_price_value"],
+                    "unit": info["unit"],
+                    "discount_amount": info["discount_amount"],
+                    "discount_percentage": info["discount_percentage"],
+                    "product_id": info.get("product_id")
+                })
+        self._sort()
+
+    @classmethod
+    def from_documents(cls, documents):
+        """Load an index from product_prices documents"""
+        index = cls()
+        for document in documents:
+            for offer in document.get("offers", []):
+                index._add(document["normalized_name"], offer)
+        index._sort()
+        return index
+
+    def __len__(self):
+        return len(self.offers)
+
+    def _add(self, normalized_name, offer):
+        self.offers.setdefault(normalized_name, []).append(offer)
+        if offer.get("product_id"):
+            self._product_ids[normalized_name] = offer["product_id"]
+            self._aliases.setdefault(offer["product_id"], set()).add(normalized_name)
+
+    def _sort(self):
+        for normalized_name, offers in self.offers.items():
+            offers[:] = rank_offers(offers)
+            # The first offer of a store in the product's order is its cheapest
+            by_store = self._by_store[normalized_name] = {}
+            for offer in offers:
+                by_store.setdefault(offer["store_id"], offer)
+        self.names = sorted(self.offers)
+
+    def best_offers(self, product, store_ids=None, limit=1):
+        """
+        The cheapest offers of a product by unit price, within the unit most of them use.
+
+        Args:
+            product: Product name (normalized before lookup)
+            store_ids: Optional stores to restrict the offers to
+            limit: Maximum number of offers
+        """
+        normalized_name = normalize_text(product)
+        aliases = self._aliases.get(self._product_ids.get(normalized_name), ())
+        if len(aliases) > 1:
+            return rank_offers((offer for alias in aliases for offer in self._best_offers(alias, store_ids, None)), limit)
+        return self._best_offers(normalized_name, store_ids, limit)
+
+    def _best_offers(self, normalized_name, store_ids, limit):
+        offers = self.offers.get(normalized_name, [])
+        if store_ids is None:
+            return offers[:limit]
+
+        # Units are ranked among the compared stores' offers only
+        if len(store_ids) < len(offers):
+            by_store = self._by_store[normalized_name]
+            return rank_offers((by_store[store_id] for store_id in store_ids if store_id in by_store), limit)
+
+        store_ids = set(store_ids)
+        return rank_offers((offer for offer in offers if offer["store_id"] in store_ids), limit)
+
+    def cheapest(self, product, store_ids=None):
+        """The single cheapest offer of a product, or None"""
+        offers = self.best_offers(product, store_ids)
+        return offers[0] if offers else None
+
+    def search(self, prefix, store_ids=None, limit=5):
+        """
+        Cheapest offers among all products whose normalized name starts with
+        prefix, one per product; products priced in different units are
+        grouped by unit (see rank_offers) rather than compared.
+        """
+        normalized_prefix = normalize_text(prefix)
+        if not normalized_prefix:
+            return []
+        start = bisect.bisect_left(self.names, normalized_prefix)
+        end = bisect.bisect_left(self.names, normalized_prefix + PREFIX_END, lo=start)
+        # One result per product, also when several of its names match the prefix
+        products = {self._product_ids.get(name, name): name for name in reversed(self.names[start:end])}
+        candidates = [offer for name in products.values() for offer in self.best_offers(name, store_ids)]
+        return rank_offers(candidates, limit)
+
+    def documents(self):
+        """(document id, product_prices document) for every product"""
+        for normalized_name in self.names:
+            offers = self.offers[normalized_name]
+            yield product_key(normalized_name), {
+                "normalized_name": normalized_name,
+                "offers": offers,
+                "store_ids": sorted({offer["store_id"] for offer in offers})
+            }
+
+
+def rebuild_price_index(db):
+    """Rebuild the product_prices collection from every store's current offers"""
+    index = ProductPriceIndex(load_stores(db))
+    collection = db.collection(PRICE_INDEX_COLLECTION)
+
+    written = set()
+    batch = db.batch()
+    pending_writes = 0
+
+    def flush():
+        nonlocal batch, pending_writes
+        if pending_writes:
+            batch.commit()
+            batch = db.batch()
+            pending_writes = 0
+
+    for key, document in index.documents():
+        document["updated_at"] = firestore.SERVER_TIMESTAMP
+        batch.set(collection.document(key), document)
+        written.add(key)
+        pending_writes += 1
+        if pending_writes >= WRITE_BATCH_SIZE:
+            flush()
+
+    # Products no store has on offer any more
+    stale = 0
+    for doc_ref in collection.list_documents():
+        if doc_ref.id not in written:
+            batch.delete(doc_ref)
+            stale += 1
+            pending_writes += 1
+            if pending_writes >= WRITE_BATCH_SIZE:
+                flush()
+    flush()
+
+    print(f"Indexed {len(index)} products across all stores ({stale} stale products removed)")
+    return index
+
+
+if __name__ == "__main__":
+    from firebase_admin import initialize_app, credentials
+
+    cred = credentials.Certificate("/Users/buyn/Desktop/agnes_och_axel/serviceAccountKey.json")
+    try:
+        initialize_app(cred, {'storageBucket': 'hellopoor-16c13.appspot.com'})
+    except ValueError:
+        # App already initialized
+        pass
+
+    rebuild_price_index(firestore.client())
@@ -0,0 +1,198 @@
+import json
+import os
+
+from recipe_ranker import estimate_tokens, sale_item_tokens, tokenize
+
+# Maximum prompt tokens per matching call; lowest-ranked recipes are dropped to fit
+PROMPT_TOKEN_BUDGET = int(os.getenv("RECIPE_PROMPT_TOKEN_BUDGET", "6000"))
+
+# Never trim the recipe list below this many candidates
+MIN_PROMPT_RECIPES = 5
+
+# Share of the budget the sale items may take while the recipes need the rest;
+# the sale items least related to the candidate recipes are dropped first
+SALE_ITEMS_BUDGET_SHARE = 0.5
+
+# Never trim the sale item list below this many items
+MIN_PROMPT_SALE_ITEMS = 20
+
+SYSTEM_PROMPT = "You are a culinary expert that recommends recipes based on user preferences and available ingredients. Return results in JSON format."
+
+PROMPT_HEADER = """Recommend exactly {count} recipes that best match the user's preferences and use ingredients on sale in the store.
+Match ingredients to sale items flexibly (common words, partial matches, e.g. "Tomato Sauce" ~ "Krossade Tomater", "Pasta" ~ "Spaghetti").
+
+User Preferences: {preferences}
+
+Sale items (id|name):
+"""
+
+RECIPES_HEADER = """
+Recipes (id|name|main ingredients separated by ;):
+"""
+
+PROMPT_FOOTER = """
+Return JSON using only the ids above: {"recommendations": [{"id": "r1", "sale": ["s1", "s2"]}]}
+"""
+
+
+def _clean(text):
+    """Keep the column separators out of names"""
+    return str(text).replace("|", "/").replace(";", ",").replace("\n", " ").strip()
+
+
+class MatchingPrompt:
+    """
+    A compact matching prompt plus the short-id mappings needed to decode the answer.
+
+    Sale items and recipes are written as one `id|name|...` line each instead
+    of indented JSON with repeated key names, and the LLM answers with the
+    short ids only.
+    """
+
+    def __init__(self, text, sale_ids, recipe_ids, prompt_tokens, recipe_tokens, dropped_recipes, dropped_sale_items=0):
+        self.text = text
+        self.sale_ids = sale_ids
+        self.recipe_ids = recipe_ids
+        self.prompt_tokens = prompt_tokens
+        self.recipe_tokens = recipe_tokens
+        self.dropped_recipes = dropped_recipes
+        self.dropped_sale_items = dropped_sale_items
+
+    def messages(self):
+        """Chat messages for the OpenAI request"""
+        return [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": self.text}
+        ]
+
+    def decode(self, result):
+        """Translate a short-id answer back into the usual recommendations structure"""
+        recommendations = []
+        for item in result.get("recommendations", []):
+            recipe = self.recipe_ids.get(item.get("id", ""))
+            if not recipe:
+                continue
+            recommendations.append({
+                "recipe_id": recipe.get("recipe_id", ""),
+                "recipe_name": recipe.get("recipe_name", ""),
+                "discounted_ingredients": [self.sale_ids[sale_id] for sale_id in item.get("sale", []) if sale_id in self.sale_ids]
+            })
+        return {"recommendations": recommendations}
+
+
+def rank_sale_items(sale_items, candidate_recipes):
+    """
+    Sale items ordered by how many candidate recipes share a token with them
+    (compound-word parts included), most related first; ties keep store order.
+    """
+    recipe_token_sets = [
+        {token for ingredient in recipe.get("main_ingredients", []) or [] for token in tokenize(ingredient)}
+        for recipe in candidate_recipes
+    ]
+    scored = []
+    for idx, name in enumerate(sale_items):
+        tokens = sale_item_tokens([name])
+        scored.append((-sum(1 for recipe_tokens in recipe_token_sets if not tokens.isdisjoint(recipe_tokens)), idx))
+    return [sale_items[idx] for _, idx in sorted(scored)]
+
+
+def build_matching_prompt(sale_items, candidate_recipes, user_preferences, budget=PROMPT_TOKEN_BUDGET, count=5, model="gpt-4o"):
+    """
+    Build a compact matching prompt that fits the token budget.
+
+    The recipes are reserved up to 1 - SALE_ITEMS_BUDGET_SHARE of the budget;
+    sale items that don't fit in the rest are dropped, least related to the
+    candidate recipes first, and recipes that still don't fit are dropped
+    from the bottom of the ranking.
+
+    Args:
+        sale_items: Sale item names
+        candidate_recipes: Recipes ranked best first (dicts with recipe_id, recipe_name, main_ingredients)
+        user_preferences: List of free-text preferences
+        budget: Maximum prompt tokens (system + user message)
+
+    Returns:
+        MatchingPrompt
+    """
+    recipe_lines = []
+    for idx, recipe in enumerate(candidate_recipes, 1):
+        ingredients = ";".join(_clean(ingredient) for ingredient in recipe.get("main_ingredients", []) or [])
+        recipe_lines.append(f"r{idx}|{_clean(recipe.get('recipe_name', ''))}|{ingredients}\n")
+
+    header = PROMPT_HEADER.format(count=count, preferences=json.dumps(user_preferences, ensure_ascii=False))
+    base_tokens = estimate_tokens(SYSTEM_PROMPT, model) + estimate_tokens(header + RECIPES_HEADER + PROMPT_FOOTER, model)
+    line_tokens = [estimate_tokens(line, model) for line in recipe_lines]
+
+    # Sale items in order of relevance, as many as fit next to the recipes
+    ranked_items = rank_sale_items(sale_items, candidate_recipes) if sale_items else []
+    recipe_reserve = min(sum(line_tokens), int(budget * (1 - SALE_ITEMS_BUDGET_SHARE)))
+    sale_budget = budget - base_tokens - recipe_reserve
+    kept_items = len(ranked_items)
+    used_tokens = 0
+    for idx, name in enumerate(ranked_items):
+        used_tokens += estimate_tokens(f"s{idx + 1}|{_clean(name)}\n", model)
+        if used_tokens > sale_budget:
+            kept_items = idx
+            break
+    kept_items = max(kept_items, min(MIN_PROMPT_SALE_ITEMS, len(ranked_items)))
+
+    def sale_text_for(item_count):
+        # The kept items are listed in store order
+        kept_names = set(ranked_items[:item_count])
+        item_ids = {f"s{idx}": name for idx, name in enumerate((name for name in sale_items if name in kept_names), 1)}
+        return item_ids, "".join(f"{sale_id}|{_clean(name)}\n" for sale_id, name in item_ids.items())
+
+    def trim_sale_items(item_count, sale_text, overshoot_tokens):
+        # Drop about as many of the least related items as make up the overshoot
+        tokens_per_item = estimate_tokens(sale_text, model) / max(item_count, 1)
+        return max(item_count - int(overshoot_tokens / max(tokens_per_item, 1)) - 1, MIN_PROMPT_SALE_ITEMS)
+
+    # Per-line counts are an approximation, so the sale text is re-measured as a whole
+    sale_ids, sale_text = sale_text_for(kept_items)
+    while kept_items > MIN_PROMPT_SALE_ITEMS and estimate_tokens(sale_text, model) > sale_budget:
+        kept_items = trim_sale_items(kept_items, sale_text, estimate_tokens(sale_text, model) - sale_budget)
+        sale_ids, sale_text = sale_text_for(kept_items)
+    fixed_tokens = base_tokens + estimate_tokens(sale_text, model)
+
+    # Keep the best-ranked recipes that fit, dropping from the bottom of the ranking
+    kept = len(recipe_lines)
+    used_tokens = fixed_tokens
+    for idx, tokens in enumerate(line_tokens):
+        used_tokens += tokens
+        if used_tokens > budget:
+            kept = idx
+            break
+    kept = max(kept, min(MIN_PROMPT_RECIPES, len(recipe_lines)))
+
+    # Per-line counts are an approximation, so re-measure the final prompt;
+    # the recipes were given their share, so the sale items are trimmed first
+    while True:
+        text = header + sale_text + RECIPES_HEADER + "".join(recipe_lines[:kept]) + PROMPT_FOOTER
+        prompt_tokens = estimate_tokens(SYSTEM_PROMPT, model) + estimate_tokens(text, model)
+        if prompt_tokens <= budget:
+            break
+        if kept_items > MIN_PROMPT_SALE_ITEMS:
+            kept_items = trim_sale_items(kept_items, sale_text, prompt_tokens - budget)
+            sale_ids, sale_text = sale_text_for(kept_items)
+        elif kept > MIN_PROMPT_RECIPES:
+            kept -= 1
+        else:
+            break
+
+    if prompt_tokens > budget:
+        print(f"Warning: matching prompt needs {prompt_tokens} tokens, over the budget of {budget}")
+
+    fixed_tokens = base_tokens + estimate_tokens(sale_text, model)
+    recipe_ids = {f"r{idx}": recipe for idx, recipe in enumerate(candidate_recipes[:kept], 1)}
+    return MatchingPrompt(text, sale_ids, recipe_ids, prompt_tokens, prompt_tokens - fixed_tokens,
+                          len(candidate_recipes) - kept, len(sale_items) - len(sale_ids))
+
+
+def usage_record(prompt, usage):
+    """Prompt and completion token counts to store with a matching result (usage as reported by the API, or None)"""
+    return {
+        "estimated_prompt_tokens": prompt.prompt_tokens,
+        "prompt_tokens": getattr(usage, "prompt_tokens", None),
+        "completion_tokens": getattr(usage, "completion_tokens", None),
+        "dropped_recipes": prompt.dropped_recipes
+    }
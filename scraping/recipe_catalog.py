@@ -0,0 +1,141 @@
+import difflib
+import hashlib
+
+from recipe_ranker import normalize_text
+from recipe_tags import preference_filter_tags, tag_recipe
+
+# Minimum similarity for a misspelled recipe name to still resolve
+NAME_MATCH_CUTOFF = 0.85
+
+# Hex digits of the SHA-1 in a recipe id (48 bits: a collision among 50k
+# recipes has a probability of about 1e-5, and is disambiguated anyway)
+RECIPE_ID_HEX_DIGITS = 12
+
+
+def make_recipe_id(recipe, category=""):
+    """Stable short id for a recipe, derived from its URL (or category and name if it has none)"""
+    key = recipe.get("recipe_url") or f"{category}/{recipe.get('recipe_name', '')}"
+    return "r" + hashlib.sha1(key.encode("utf-8")).hexdigest()[:RECIPE_ID_HEX_DIGITS]
+
+
+class RecipeCatalog:
+    """
+    Recipe catalog with hash indexes by id, name, URL and tag.
+
+    Every recipe gets a stable `recipe_id`, which is what the LLM is asked to
+    return, so resolving a recommendation is a dict lookup instead of a scan
+    over every category list. Recipes are tagged once here (unless the
+    scraper already stored tags), so preference filtering is an intersection
+    of tag sets rather than free text in every prompt.
+    """
+
+    def __init__(self, recipes_data):
+        self.recipes_data = {}
+        self.by_id = {}
+        self.by_name = {}
+        self.by_url = {}
+        self.by_tag = {}
+        keys_by_id = {}
+
+        for category, recipe_list in recipes_data.items():
+            self.recipes_data.setdefault(category, [])
+            for recipe in recipe_list:
+                recipe_id = recipe.get("recipe_id") or make_recipe_id(recipe, category)
+                # Listings of the same recipe share its URL (or name)
+                key = recipe.get("recipe_url") or normalize_text(recipe.get("recipe_name", ""))
+                if keys_by_id.get(recipe_id) == key:
+                    # The same recipe listed under several categories
+                    continue
+                if recipe_id in keys_by_id:
+                    # A different recipe with the same id: keep it under a suffixed id
+                    collided_id = recipe_id
+                    suffix = 2
+                    while f"{collided_id}-{suffix}" in keys_by_id and keys_by_id[f"{collided_id}-{suffix}"] != key:
+                        suffix += 1
+                    recipe_id = f"{collided_id}-{suffix}"
+                    if recipe_id in keys_by_id:
+                        # Another listing of a recipe that was already suffixed
+                        continue
+                    print(f"Recipe id {collided_id} is already used by another recipe, using {recipe_id} for '{recipe.get('recipe_name', '')}'")
+                keys_by_id[recipe_id] = key
+
+                recipe = dict(recipe, recipe_id=recipe_id, category=recipe.get("category", category))
+                recipe["tags"] = recipe.get("tags") or tag_recipe(recipe)
+                self.recipes_data[category].append(recipe)
+                self.by_id[recipe_id] = recipe
+                for tag in recipe["tags"]:
+                    self.by_tag.setdefault(tag, set()).add(recipe_id)
+
+                normalized_name = normalize_text(recipe.get("recipe_name", ""))
+                if normalized_name:
+                    self.by_name.setdefault(normalized_name, recipe)
+                if recipe.get("recipe_url"):
+                    self.by_url.setdefault(recipe["recipe_url"], recipe)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def get(self, recipe_id):
+        """Look up a recipe by id"""
+        return self.by_id.get(recipe_id)
+
+    def find_by_url(self, recipe_url):
+        """Look up a recipe by URL"""
+        return self.by_url.get(recipe_url)
+
+    def find_by_name(self, recipe_name, fuzzy=True):
+        """Look up a recipe by name, tolerating small misspellings if fuzzy is set"""
+        normalized_name = normalize_text(recipe_name)
+        recipe = self.by_name.get(normalized_name)
+        if recipe or not fuzzy or not normalized_name:
+            return recipe
+
+        close_matches = difflib.get_close_matches(normalized_name, self.by_name.keys(), n=1, cutoff=NAME_MATCH_CUTOFF)
+        if close_matches:
+            print(f"Resolved recipe name '{recipe_name}' to '{self.by_name[close_matches[0]]['recipe_name']}'")
+            return self.by_name[close_matches[0]]
+        return None
+
+    def resolve(self, recommendation):
+        """Find the catalog recipe for an LLM recommendation by id, then URL, then name"""
+        recipe = self.get(recommendation.get("recipe_id", ""))
+        if recipe:
+            return recipe
+        recipe = self.find_by_url(recommendation.get("recipe_url", ""))
+        if recipe:
+            return recipe
+        return self.find_by_name(recommendation.get("recipe_name", ""))
+
+    def ids_with_tags(self, tags):
+        """Ids of the recipes that have every one of the tags"""
+        tag_sets = sorted((self.by_tag.get(tag, set()) for tag in tags), key=len)
+        if not tag_sets:
+            return set(self.by_id)
+        return tag_sets[0].intersection(*tag_sets[1:])
+
+    def ids_for_preferences(self, user_preferences):
+        """
+        Ids of the recipes allowed by the hard-constraint preferences
+        ("Vegetarian", "Gluten-free", "Chicken"), or None if there are none
+        """
+        tags = preference_filter_tags(user_preferences)
+        if not tags:
+            return None
+        recipe_ids = self.ids_with_tags(tags)
+        print(f"Tag filter {sorted(tags)} kept {len(recipe_ids)} of {len(self)} recipes")
+        return recipe_ids
+
+    def prompt_entries(self, recipe_ids=None):
+        """Recipe entries for the matching prompt, optionally only for the given ids"""
+        return [
+            {
+                "recipe_id": recipe["recipe_id"],
+                "recipe_name": recipe.get("recipe_name", ""),
+                "main_ingredients": recipe.get("main_ingredients", [])
+            }
+            for recipe in self
+            if recipe_ids is None or recipe["recipe_id"] in recipe_ids
+        ]
@@ -1,16 +1,17 @@
 import json
 import requests
-import os
 from bs4 import BeautifulSoup
 import time
 from dotenv import load_dotenv
-from openai import OpenAI
+from recipe_catalog import make_recipe_id
+from recipe_tags import tag_recipe
+from llm_gateway import LLMGateway, ledger
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Initialize OpenAI client (through the gateway: coalescing, usage ledger, record/replay)
+client = LLMGateway(caller="recipe_detail_scraper")
 
 def extract_main_ingredients(ingredients_text):
     """
@@ -101,6 +102,9 @@ def scrape_recipe_details(recipe_url):
             "main_ingredients": main_ingredients,
             "recipe_img": image_url
         }
+        # Stable id the matchers use to refer to this recipe
+        recipe_data["recipe_id"] = make_recipe_id(recipe_data)
+        recipe_data["tags"] = tag_recipe(recipe_data)
         
         return recipe_data
     
@@ -158,4 +162,5 @@ if __name__ == "__main__":
     
     # Save results
     save_results(recipes_data)
-    print("\nRecipe detail scraping completed successfully") 
\ No newline at end of file
+    print("\nRecipe detail scraping completed successfully")
+    print(f"LLM usage: {ledger.summary()}") 
\ No newline at end of file
@@ -1,14 +1,28 @@
+import argparse
 import json
 import os
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from openai import OpenAI
+from offer_schema import offer_values
+from recipe_ranker import select_candidate_recipes
+from recommendation_cache import normalize_preferences
+from recipe_catalog import RecipeCatalog
+from prompt_builder import build_matching_prompt, usage_record
+from llm_gateway import LLMGateway, ledger
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Initialize OpenAI client (through the gateway: coalescing, usage ledger, record/replay)
+client = LLMGateway(caller="recipe_matcher")
+
+# Number of candidate recipes put in the matching prompt
+PROMPT_TOP_K = int(os.getenv("RECIPE_PROMPT_TOP_K", "50"))
+
+# Concurrent LLM calls in batch mode
+BATCH_WORKERS = int(os.getenv("RECIPE_BATCH_WORKERS", "8"))
 
 def load_data(file_path):
     """Load data from a JSON file"""
@@ -33,105 +47,108 @@ def normalize_text(text):
     text = re.sub(r'[^\w\s]', '', text)  # Remove special characters
     return text.strip()
 
-def get_recipe_recommendations(user_articles_on_sale, user_preferences, recipes_data):
-    """Use OpenAI to recommend recipes based on user preferences and sale items"""
-    # Extract article names and their discount information
+def build_store_sale_data(articles):
+    """Extract article names and their discount information for one store"""
     sale_items = []
     discount_info = {}
     normalized_to_original = {}  # Map normalized names to original names
     
-    for store_id, articles in user_articles_on_sale.items():
-        for article in articles:
-            # The first item is the product name
-            product_name = article[0]
-            normalized_name = normalize_text(product_name)
+    for article in articles:
+        # The first item is the product name
+        product_name = article[0]
+        normalized_name = normalize_text(product_name)
+        
+        # Skip empty names
+        if not normalized_name:
+            continue
             
-            # Skip empty names
-            if not normalized_name:
-                continue
-                
-            # Store mapping
-            normalized_to_original[normalized_name] = product_name
+        # Store mapping
+        normalized_to_original[normalized_name] = product_name
+        
+        # Check if we already have this product
+        if product_name not in discount_info:
+            # Extract discount information (price, amount off, percentage)
+            price = article[1] if len(article) > 1 else "N/A"
+            discount_amount = article[2] if len(article) > 2 else "N/A"
+            discount_percentage = article[3] if len(article) > 3 else "N/A"
+            
+            # Store the discount information, with its numbers parsed once per store
+            discount_info[product_name] = {
+                "price": price,
+                "discount_amount": discount_amount,
+                "discount_percentage": discount_percentage,
+                "normalized_name": normalized_name,
+                **offer_values(price, discount_amount, discount_percentage)
+            }
             
-            # Check if we already have this product
+            # Add to the sale items list
+            sale_items.append(product_name)
+    
+    return sale_items, discount_info, normalized_to_original
+
+def merge_sale_data(store_sale_data):
+    """Combine per-store sale data (in store order) into one user's sale data"""
+    sale_items = []
+    discount_info = {}
+    normalized_to_original = {}
+    
+    for store_items, store_discount_info, store_normalized_to_original in store_sale_data:
+        normalized_to_original.update(store_normalized_to_original)
+        for product_name in store_items:
             if product_name not in discount_info:
-                # Extract discount information (price, amount off, percentage)
-                price = article[1] if len(article) > 1 else "N/A"
-                discount_amount = article[2] if len(article) > 2 else "N/A"
-                discount_percentage = article[3] if len(article) > 3 else "N/A"
-                
-                # Store the discount information
-                discount_info[product_name] = {
-                    "price": price,
-                    "discount_amount": discount_amount,
-                    "discount_percentage": discount_percentage,
-                    "normalized_name": normalized_name
-                }
-                
-                # Add to the sale items list
+                discount_info[product_name] = store_discount_info[product_name]
                 sale_items.append(product_name)
     
-    # Prepare the recipes data for the OpenAI prompt
-    recipes_info = []
-    for category, recipe_list in recipes_data.items():
-        for recipe in recipe_list:
-            recipes_info.append({
-                "recipe_name": recipe["recipe_name"],
-                "main_ingredients": recipe["main_ingredients"]
-            })
-
-    # Create the prompt for OpenAI with discount information
-    prompt = f"""
-Given the following information, recommend 5 recipes that best match the user's preferences 
-and utilize ingredients that are on sale in their allowed stores.
+    return sale_items, discount_info, normalized_to_original
 
-User Preferences: {user_preferences}
-
-Items on Sale with Discount Information:
-{json.dumps(sale_items, indent=2, ensure_ascii=False)}
-
-Available Recipes:
-{json.dumps(recipes_info, indent=2, ensure_ascii=False)}
+def get_recipe_recommendations(user_articles_on_sale, user_preferences, catalog, sale_data=None, verbose=True):
+    """
+    Use OpenAI to recommend recipes based on user preferences and sale items.
+    
+    sale_data, if given, is the already merged (sale_items, discount_info,
+    normalized_to_original) for these stores, as built by batch mode.
+    """
+    if sale_data is None:
+        sale_data = merge_sale_data(build_store_sale_data(articles) for articles in user_articles_on_sale.values())
+    sale_items, discount_info, normalized_to_original = sale_data
+    
+    # Prepare the recipes data for the OpenAI prompt
+    # Hard preferences are applied with the tag index before ranking
+    allowed_ids = catalog.ids_for_preferences(user_preferences)
+    if allowed_ids is not None and not allowed_ids:
+        # No recipe satisfies every hard preference, so there is nothing to ask OpenAI
+        if verbose:
+            print(f"No recipes match the preferences {user_preferences}, not calling OpenAI")
+        return {"recommendations": [], "usage": None}, discount_info, normalized_to_original
+    recipes_info = catalog.prompt_entries(allowed_ids)
 
-For each recipe, identify which ingredients in the recipe are on sale items.
-Make sure to EXACTLY match the ingredient names to the sale items.
+    # Only the top-K recipes by sale item overlap go into the prompt
+    candidate_recipes = select_candidate_recipes(recipes_info, sale_items, PROMPT_TOP_K)
 
-Return your answer as a JSON object containing exactly 5 recipe names with a list of discounted ingredients:
-{{
-  "recommendations": [
-    {{
-      "recipe_name": "Recipe Name 1",
-      "discounted_ingredients": ["EXACTLY Item 1 from sale items", "EXACTLY Item 2 from sale items", ...]
-    }},
-    // ... repeat for all 5 recipes
-  ]
-}}
-"""
+    # Compact tabular prompt with short ids, trimmed to the per-call token budget
+    prompt = build_matching_prompt(sale_items, candidate_recipes, user_preferences)
+    tokens_per_recipe = prompt.recipe_tokens / max(len(prompt.recipe_ids), 1)
+    if verbose:
+        print(f"Top-K filter kept {len(candidate_recipes)} of {len(recipes_info)} recipes, "
+              f"saving ~{int(tokens_per_recipe * (len(recipes_info) - len(candidate_recipes)))} prompt tokens")
+        if prompt.dropped_sale_items:
+            print(f"Token budget dropped the {prompt.dropped_sale_items} sale items least related to the candidates")
 
     response = client.chat.completions.create(
         model="gpt-4o",
         response_format={"type": "json_object"},
-        messages=[
-            {"role": "system", "content": "You are a culinary expert that recommends recipes based on user preferences and available ingredients. Return results in JSON format."},
-            {"role": "user", "content": prompt}
-        ],
+        messages=prompt.messages(),
         temperature=0
     )
     
     # Parse the JSON response
     try:
-        return json.loads(response.choices[0].message.content), discount_info, normalized_to_original
+        result = prompt.decode(json.loads(response.choices[0].message.content))
+        result["usage"] = usage_record(prompt, response.usage)
+        return result, discount_info, normalized_to_original
     except Exception as e:
         print(f"Error parsing OpenAI response: {e}")
-        return {"recommendations": []}, discount_info, normalized_to_original
-
-def find_recipe_details(recipe_name, recipes_data):
-    """Find full recipe details by name"""
-    for category, recipe_list in recipes_data.items():
-        for recipe in recipe_list:
-            if recipe["recipe_name"] == recipe_name:
-                return recipe
-    return None
+        return {"recommendations": [], "usage": usage_record(prompt, response.usage)}, discount_info, normalized_to_original
 
 def find_matching_sale_item(ingredient, discount_info, normalized_to_original):
     """Find best matching sale item for an ingredient"""
@@ -154,7 +171,7 @@ def find_matching_sale_item(ingredient, discount_info, normalized_to_original):
             
     return None
 
-def process_user(user, articles_on_sale, recipes_data):
+def process_user(user, articles_on_sale, catalog):
     """Process a single user and return recommendations in the specified format"""
     print(f"\n{'='*40}")
     print(f"Processing recommendations for {user['name']}")
@@ -173,20 +190,25 @@ def process_user(user, articles_on_sale, recipes_data):
     recommendations, discount_info, normalized_to_original = get_recipe_recommendations(
         user_articles_on_sale, 
         user.get("preferences", []), 
-        recipes_data
+        catalog
     )
     
-    # Process and collect recommendations in the exact requested format
+    print(f"Token usage: {recommendations.get('usage')}")
+    
+    return format_user_recommendations(recommendations, discount_info, normalized_to_original, catalog)
+
+def format_user_recommendations(recommendations, discount_info, normalized_to_original, catalog, verbose=True):
+    """Process and collect recommendations in the exact requested format"""
     formatted_recommendations = []
     
     for rec in recommendations.get("recommendations", []):
-        recipe_name = rec.get("recipe_name", "")
         discounted_ingredients = rec.get("discounted_ingredients", [])
         
-        # Find full recipe details
-        recipe_details = find_recipe_details(recipe_name, recipes_data)
+        # Find full recipe details by id (falls back to URL and name)
+        recipe_details = catalog.resolve(rec)
         
         if recipe_details:
+            recipe_name = recipe_details.get("recipe_name", "")
             # Map ingredients to their actual sale items
             mapped_ingredients = []
             savings_info = []  # Initialize here
@@ -209,14 +231,7 @@ def process_user(user, articles_on_sale, recipes_data):
                     mapped_ingredients.append(ingredient)
             
             # Calculate total discount percentage
-            total_discount_percent = 0
-            for item in savings_info:
-                try:
-                    if isinstance(item["discount_percentage"], str) and "%" in item["discount_percentage"]:
-                        percent = float(item["discount_percentage"].replace("%", ""))
-                        total_discount_percent += percent
-                except (ValueError, TypeError):
-                    pass
+            total_discount_percent = sum(discount_info[item["ingredient"]]["discount_percent"] for item in savings_info)
             
             formatted_rec = [
                 recipe_name,
@@ -227,6 +242,9 @@ def process_user(user, articles_on_sale, recipes_data):
             ]
             formatted_recommendations.append(formatted_rec)
             
+            if not verbose:
+                continue
+            
             # Print details to console
             print(f"\n- {recipe_name}")
             print(f"  URL: {recipe_details.get('recipe_url', '')}")
@@ -239,10 +257,105 @@ def process_user(user, articles_on_sale, recipes_data):
     
     return formatted_recommendations
 
+def load_users(file_path):
+    """Yield users from a JSON array or a JSON Lines file (one user object per line)"""
+    with open(file_path, 'r', encoding='utf-8') as f:
+        first_char = f.read(1)
+        f.seek(0)
+        if first_char == "[":
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def job_key(user):
+    """Users with the same stores and preferences get the same recommendations"""
+    return (
+        tuple(sorted(set(user.get("allowed_stores", [])))),
+        tuple(normalize_preferences(user.get("preferences", [])))
+    )
+
+def run_job(store_ids, preferences, articles_on_sale, catalog, store_sale_data):
+    """Recommendations for one distinct (stores, preferences) job"""
+    sale_data = merge_sale_data(store_sale_data[store_id] for store_id in store_ids if store_id in store_sale_data)
+    user_articles_on_sale = {store_id: articles_on_sale[store_id] for store_id in store_ids if store_id in articles_on_sale}
+    recommendations, discount_info, normalized_to_original = get_recipe_recommendations(
+        user_articles_on_sale, preferences, catalog, sale_data=sale_data, verbose=False
+    )
+    return format_user_recommendations(recommendations, discount_info, normalized_to_original, catalog, verbose=False)
+
+def run_batch(users_path, articles_on_sale, catalog, output_path, workers=BATCH_WORKERS):
+    """
+    Match every user in users_path and write one JSON line per user to output_path.
+    
+    Each store's sale data is built once and shared, users with identical
+    (stores, preferences) share one job, and the distinct jobs run
+    concurrently on a thread pool.
+    """
+    start = time.perf_counter()
+    
+    # Group users into distinct jobs
+    jobs = {}
+    user_jobs = []
+    for user in load_users(users_path):
+        key = job_key(user)
+        jobs.setdefault(key, user.get("preferences", []))
+        user_jobs.append((user.get("name") or user.get("id"), key))
+    
+    # Preprocess every referenced store once
+    store_ids = {store_id for stores, _ in jobs for store_id in stores}
+    store_sale_data = {
+        store_id: build_store_sale_data(articles_on_sale[store_id])
+        for store_id in store_ids if store_id in articles_on_sale
+    }
+    print(f"{len(user_jobs)} users grouped into {len(jobs)} distinct jobs over {len(store_sale_data)} stores")
+    
+    results = {}
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_job, stores, preferences, articles_on_sale, catalog, store_sale_data): (stores, preferences_key)
+            for (stores, preferences_key), preferences in jobs.items()
+        }
+        report_every = max(1, len(futures) // 20)
+        for done, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                failed += 1
+                results[key] = []
+                print(f"Job {key} failed: {e}")
+            
+            if done % report_every == 0 or done == len(futures):
+                elapsed = time.perf_counter() - start
+                rate = done / elapsed if elapsed else 0
+                eta = (len(futures) - done) / rate if rate else 0
+                print(f"Progress: {done}/{len(futures)} jobs ({done * 100 // len(futures)}%), "
+                      f"{rate:.1f} jobs/s, ETA {eta:.0f}s, {failed} failed")
+    
+    with open(output_path, 'w', encoding='utf-8') as f:
+        for name, key in user_jobs:
+            f.write(json.dumps({"user": name, "recommendations": results[key]}, ensure_ascii=False) + "\n")
+    
+    print(f"\nRecommendations for {len(user_jobs)} users saved to {output_path} in {time.perf_counter() - start:.1f}s")
+    print(f"LLM usage: {ledger.summary()}")
+
 def main():
+    parser = argparse.ArgumentParser(description="Match recipes to articles on sale for users")
+    parser.add_argument("--users", help="Users file (JSON array or JSON Lines) to match in batch mode")
+    parser.add_argument("--output", default="user_matches.jsonl", help="Batch mode output file (JSON Lines)")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="Concurrent jobs in batch mode")
+    args = parser.parse_args()
+    
+    if args.users:
+        run_batch(args.users, load_data('articles_on_sale.txt'), RecipeCatalog(load_data('recipes.txt')), args.output, args.workers)
+        return None
+    
     # Load data
     articles_on_sale = load_data('articles_on_sale.txt')
-    recipes_data = load_data('recipes.txt')
+    catalog = RecipeCatalog(load_data('recipes.txt'))
     
     # Define users
     users = [
@@ -261,7 +374,7 @@ def main():
     # Process each user and collect results
     all_results = {}
     for user in users:
-        formatted_recs = process_user(user, articles_on_sale, recipes_data)
+        formatted_recs = process_user(user, articles_on_sale, catalog)
         all_results[user["name"]] = formatted_recs
     
     # Write structured output to file
@@ -269,6 +382,7 @@ def main():
         json.dump(all_results, f, indent=2, ensure_ascii=False)
     
     print(f"\nAll recommendations have been saved to user_matches.txt")
+    print(f"LLM usage: {ledger.summary()}")
     
     # Return the formatted recommendations
     return all_results
@@ -0,0 +1,407 @@
+import heapq
+import json
+import re
+
+from offer_schema import offer_values, parse_amount
+
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to a character estimate
+    tiktoken = None
+
+# Minimum length for the compound-word prefix/suffix lookups below, so that
+# "kycklingfilé" finds "kyckling" and "körsbärstomater" finds "tomater"
+# without short fragments like "ost" matching half the catalog
+MIN_COMPOUND_PART = 4
+
+# Keyword rules used to honour free-text user preferences locally
+MEAT_WORDS = [
+    "kött", "färs", "nötfärs", "fläsk", "bacon", "skinka", "korv", "kyckling",
+    "kalkon", "lamm", "biff", "entrecote", "oxfilé", "fläskfilé", "karré",
+    "kassler", "salami", "chorizo", "beef", "chicken", "pork", "ham",
+]
+FISH_WORDS = [
+    "lax", "torsk", "fisk", "räkor", "tonfisk", "sej", "kolja", "sill",
+    "musslor", "kräftor", "salmon", "shrimp", "tuna", "fish",
+]
+PROTEIN_WORDS = MEAT_WORDS + FISH_WORDS + [
+    "ägg", "halloumi", "tofu", "bönor", "linser", "kikärtor", "kvarg",
+    "keso", "fetaost", "quorn",
+]
+
+PREFERENCE_RULES = {
+    "vegetarian": {"exclude": MEAT_WORDS + FISH_WORDS},
+    "vegetarisk": {"exclude": MEAT_WORDS + FISH_WORDS},
+    "chicken": {"require": ["kyckling", "chicken"]},
+    "high protein": {"boost": PROTEIN_WORDS},
+    "high in protein": {"boost": PROTEIN_WORDS},
+    "italian": {"boost": ["pasta", "spaghetti", "penne", "lasagne", "risotto", "parmesan", "mozzarella", "pesto"]},
+    "asian": {"boost": ["soja", "ris", "nudlar", "ingefära", "curry", "kokosmjölk", "sesam", "wok"]},
+    "swedish": {"boost": ["potatis", "köttbullar", "lingon", "dill", "sill", "pytt"]},
+    "glutenfree": {"exclude": ["pasta", "spaghetti", "penne", "lasagne", "bröd", "mjöl", "couscous", "bulgur", "nudlar", "tortilla"]},
+}
+
+# Score multiplier applied per matched "boost" keyword
+BOOST_WEIGHT = 0.5
+
+
+def normalize_text(text):
+    """Normalize text for better matching (lowercase, remove special chars)"""
+    if not text:
+        return ""
+    text = text.lower()
+    text = re.sub(r'[^\w\s]', '', text)  # Remove special characters
+    return text.strip()
+
+
+def tokenize(text):
+    """Split text into normalized word tokens"""
+    return normalize_text(text).split()
+
+
+def estimate_tokens(text, model="gpt-4o"):
+    """Count prompt tokens with tiktoken if available, otherwise estimate ~4 chars per token"""
+    if tiktoken is not None:
+        try:
+            return len(tiktoken.encoding_for_model(model).encode(text))
+        except KeyError:
+            return len(tiktoken.get_encoding("o200k_base").encode(text))
+    return len(text) // 4
+
+
+def sale_item_tokens(sale_items):
+    """Collect the tokens of all sale items, including their compound-word parts"""
+    tokens = set()
+    for item in sale_items:
+        for token in tokenize(item):
+            tokens.add(token)
+            for i in range(MIN_COMPOUND_PART, len(token) - MIN_COMPOUND_PART + 1):
+                tokens.add(token[:i])
+                tokens.add(token[i:])
+    return tokens
+
+
+def select_candidate_recipes(recipes_info, sale_items, top_k):
+    """
+    Pick the top-K recipes to put in the LLM prompt.
+
+    Recipes are ranked by how many of their main_ingredients share a token
+    with one of the store's sale items, so the prompt stays the same size no
+    matter how large the catalog grows. Ties keep catalog order.
+    """
+    if top_k is None or len(recipes_info) <= top_k:
+        return recipes_info
+
+    tokens = sale_item_tokens(sale_items)
+    scored = []
+    for idx, recipe in enumerate(recipes_info):
+        overlap = sum(
+            1 for ingredient in recipe.get("main_ingredients", []) or []
+            if not tokens.isdisjoint(tokenize(ingredient))
+        )
+        scored.append((overlap, -idx))
+
+    top = heapq.nlargest(top_k, scored)
+    return [recipes_info[-neg_idx] for _, neg_idx in top]
+
+
+def parse_percentage(value):
+    """Parse a discount percentage such as "25%" into a float (0.0 if unknown)"""
+    return parse_amount(value)
+
+
+def build_discount_info(articles):
+    """
+    Build the sale item structures used by the matchers from a store's articles.
+
+    Args:
+        articles: List of [name, price, discount_amount, discount_percentage],
+            optionally followed by the offer's numbers (as by format_article)
+
+    Returns:
+        Tuple of (sale_items, discount_info, normalized_to_original); every
+        discount_info entry carries the OFFER_NUMBER_FIELDS
+    """
+    sale_items = []
+    discount_info = {}
+    normalized_to_original = {}
+
+    for article in articles:
+        product_name = article[0]
+        normalized_name = normalize_text(product_name)
+
+        # Skip empty names
+        if not normalized_name:
+            continue
+
+        normalized_to_original[normalized_name] = product_name
+
+        if product_name not in discount_info:
+            price = article[1] if len(article) > 1 else "N/A"
+            discount_amount = article[2] if len(article) > 2 else "N/A"
+            discount_percentage = article[3] if len(article) > 3 else "N/A"
+            discount_info[product_name] = {
+                "price": price,
+                "discount_amount": discount_amount,
+                "discount_percentage": discount_percentage,
+                "normalized_name": normalized_name,
+                # Typed offers carry their numbers; plain articles are parsed once here
+                **(article[4] if len(article) > 4 else offer_values(price, discount_amount, discount_percentage))
+            }
+            sale_items.append(product_name)
+
+    return sale_items, discount_info, normalized_to_original
+
+
+def contains_any(tokens, words):
+    """Check whether any token starts with one of the given keywords"""
+    return any(token.startswith(word) for token in tokens for word in words)
+
+
+class RecipeRanker:
+    """
+    Deterministic local recipe ranking engine.
+
+    The recipe catalog is indexed once as an inverted index from normalized
+    ingredient tokens to (recipe, ingredient) pairs. Ranking a store then only
+    visits the recipes that share a token with one of its sale items, instead
+    of handing the whole catalog to the LLM.
+    """
+
+    def __init__(self, recipes_data):
+        self.recipes = []
+        self.recipe_ids = []
+        self.ingredient_tokens = []
+        self.recipe_tokens = []
+        self.token_index = {}
+
+        for category, recipe_list in recipes_data.items():
+            for recipe in recipe_list:
+                recipe_idx = len(self.recipes)
+                self.recipes.append(recipe)
+                self.recipe_ids.append(recipe.get("recipe_id"))
+
+                ingredients = recipe.get("main_ingredients", []) or []
+                tokens_per_ingredient = [set(tokenize(ingredient)) for ingredient in ingredients]
+                self.ingredient_tokens.append(tokens_per_ingredient)
+
+                all_tokens = set(tokenize(recipe.get("recipe_name", "")))
+                for ingredient_idx, tokens in enumerate(tokens_per_ingredient):
+                    all_tokens.update(tokens)
+                    for token in tokens:
+                        self.token_index.setdefault(token, set()).add((recipe_idx, ingredient_idx))
+                self.recipe_tokens.append(all_tokens)
+
+        print(f"Recipe ranker indexed {len(self.recipes)} recipes with {len(self.token_index)} ingredient tokens")
+
+    def _lookup_token(self, token):
+        """Find (recipe, ingredient) pairs for a sale item token, including compound parts"""
+        pairs = set(self.token_index.get(token, ()))
+        # Swedish compounds: "kycklingfilé" -> "kyckling", "körsbärstomater" -> "tomater"
+        for i in range(MIN_COMPOUND_PART, len(token) - MIN_COMPOUND_PART + 1):
+            pairs.update(self.token_index.get(token[:i], ()))
+            pairs.update(self.token_index.get(token[i:], ()))
+        return pairs
+
+    def _preference_adjustment(self, recipe_idx, user_preferences, allowed_ids=None):
+        """
+        Return a score multiplier for the preferences, or None if the recipe is excluded.
+
+        allowed_ids is the catalog's ids_for_preferences set: when given, the
+        hard constraints are decided by the recipe tags instead of the keyword rules.
+        """
+        if allowed_ids is not None and self.recipe_ids[recipe_idx] not in allowed_ids:
+            return None
+        tokens = self.recipe_tokens[recipe_idx]
+        multiplier = 1.0
+
+        for preference in user_preferences or []:
+            rule = PREFERENCE_RULES.get(normalize_text(preference))
+            if not rule:
+                continue
+            if allowed_ids is None:
+                if "exclude" in rule and contains_any(tokens, rule["exclude"]):
+                    return None
+                if "require" in rule and not contains_any(tokens, rule["require"]):
+                    return None
+            if "boost" in rule and contains_any(tokens, rule["boost"]):
+                multiplier += BOOST_WEIGHT
+
+        return multiplier
+
+    def rank(self, articles, user_preferences=None, top_k=5, allowed_ids=None):
+        """
+        Rank recipes for a single store's articles on sale.
+
+        Args:
+            articles: List of [name, price, discount_amount, discount_percentage]
+            user_preferences: List of free-text preferences, e.g. ["Vegetarian"]
+            top_k: Number of recommendations to return
+            allowed_ids: Optional catalog.ids_for_preferences set; only these recipes are ranked
+
+        Returns:
+            List of recommendations in the same format as format_recommendations
+        """
+        sale_items, discount_info, _ = build_discount_info(articles)
+
+        # For every recipe ingredient keep the most discounted matching sale item
+        best_items = {}
+        for product_name in sale_items:
+            info = discount_info[product_name]
+            weight = 1.0 + info["discount_percent"] / 100
+            for token in info["normalized_name"].split():
+                for pair in self._lookup_token(token):
+                    current = best_items.get(pair)
+                    if current is None or weight > current[0]:
+                        best_items[pair] = (weight, product_name)
+
+        # Aggregate ingredient matches into recipe scores
+        matches_by_recipe = {}
+        for (recipe_idx, ingredient_idx), (weight, product_name) in best_items.items():
+            if allowed_ids is not None and self.recipe_ids[recipe_idx] not in allowed_ids:
+                continue
+            matches_by_recipe.setdefault(recipe_idx, {})[ingredient_idx] = (weight, product_name)
+
+        scored = []
+        for recipe_idx, matches in matches_by_recipe.items():
+            multiplier = self._preference_adjustment(recipe_idx, user_preferences, allowed_ids)
+            if multiplier is None:
+                continue
+            score = sum(weight for weight, _ in matches.values()) * multiplier
+            coverage = len(matches) / max(len(self.ingredient_tokens[recipe_idx]), 1)
+            scored.append((score, coverage, -recipe_idx, recipe_idx))
+
+        top = heapq.nlargest(top_k, scored)
+        return [self._format(recipe_idx, matches_by_recipe[recipe_idx], discount_info, score)
+                for score, _, _, recipe_idx in top]
+
+    def _format(self, recipe_idx, matches, discount_info, score):
+        """Build a recommendation with savings_info for a ranked recipe"""
+        recipe = self.recipes[recipe_idx]
+        mapped_ingredients = []
+        savings_info = []
+
+        for ingredient_idx in sorted(matches):
+            product_name = matches[ingredient_idx][1]
+            if product_name in mapped_ingredients:
+                continue
+            info = discount_info[product_name]
+            mapped_ingredients.append(product_name)
+            savings_info.append({
+                "ingredient": product_name,
+                "price": info["price"],
+                "discount_amount": info["discount_amount"],
+                "discount_percentage": info["discount_percentage"]
+            })
+
+        return {
+            "recipe_id": recipe.get("recipe_id", ""),
+            "recipe_name": recipe.get("recipe_name", ""),
+            "recipe_url": recipe.get("recipe_url", ""),
+            "recipe_img": recipe.get("recipe_img", ""),
+            "discounted_ingredients": mapped_ingredients,
+            "savings_info": savings_info,
+            "score": round(score, 3)
+        }
+
+
+def add_cheapest_offers(recommendations, price_index, store_ids=None):
+    """Annotate every savings_info entry with the product's cheapest offer among the stores"""
+    for recommendation in recommendations:
+        for savings in recommendation["savings_info"]:
+            offer = price_index.cheapest(savings["ingredient"], store_ids)
+            if offer:
+                savings["cheapest_offer"] = {
+                    "store_id": offer["store_id"],
+                    "store_name": offer["store_name"],
+                    "price": offer["price"],
+                    "unit_price": offer["unit_price"],
+                    "unit": offer["unit"]
+                }
+    return recommendations
+
+
+def build_rerank_messages(candidates, user_preferences, top_k=5):
+    """Chat messages asking the LLM to re-order and explain the local candidates"""
+    candidate_info = [
+        {"recipe_id": rec["recipe_id"], "recipe_name": rec["recipe_name"], "discounted_ingredients": rec["discounted_ingredients"]}
+        for rec in candidates
+    ]
+
+    prompt = f"""
+The following recipes have already been selected because they use ingredients on sale.
+Re-order them so the {top_k} that best match the user's preferences come first, and give
+a one-sentence explanation for each. Identify recipes by their recipe_id exactly as given.
+
+User Preferences: {user_preferences}
+
+Candidates:
+{json.dumps(candidate_info, ensure_ascii=False)}
+
+Return your answer as a JSON object:
+{{
+  "recommendations": [
+    {{"recipe_id": "recipe_id of Recipe 1", "explanation": "Why this recipe fits"}}
+  ]
+}}
+"""
+    return [
+        {"role": "system", "content": "You are a culinary expert that recommends recipes based on user preferences and available ingredients. Return results in JSON format."},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def apply_rerank(candidates, content, top_k=5):
+    """Re-order the candidates by the LLM answer; candidates it left out keep their local order"""
+    result = json.loads(content)
+
+    by_id = {rec["recipe_id"]: rec for rec in candidates}
+    reranked = []
+    for item in result.get("recommendations", []):
+        rec = by_id.pop(item.get("recipe_id", ""), None)
+        if rec:
+            reranked.append(dict(rec, explanation=item.get("explanation", "")))
+
+    reranked.extend(by_id.values())
+    return reranked[:top_k]
+
+
+def rerank_with_llm(candidates, user_preferences, client, top_k=5, model="gpt-4o"):
+    """
+    Ask the LLM to re-order locally ranked candidates and explain each pick.
+
+    Only the short candidate list is sent, never the full catalog. On any
+    error the local order is kept.
+    """
+    if not candidates:
+        return candidates
+
+    try:
+        response = client.chat.completions.create(
+            model=model,
+            response_format={"type": "json_object"},
+            messages=build_rerank_messages(candidates, user_preferences, top_k),
+            temperature=0
+        )
+        return apply_rerank(candidates, response.choices[0].message.content, top_k)
+    except Exception as e:
+        print(f"Error re-ranking with OpenAI, keeping local order: {e}")
+        return candidates[:top_k]
+
+
+async def rerank_with_llm_async(candidates, user_preferences, client, top_k=5, model="gpt-4o"):
+    """rerank_with_llm for an AsyncOpenAI client"""
+    if not candidates:
+        return candidates
+
+    try:
+        response = await client.chat.completions.create(
+            model=model,
+            response_format={"type": "json_object"},
+            messages=build_rerank_messages(candidates, user_preferences, top_k),
+            temperature=0
+        )
+        return apply_rerank(candidates, response.choices[0].message.content, top_k)
+    except Exception as e:
+        print(f"Error re-ranking with OpenAI, keeping local order: {e}")
+        return candidates[:top_k]
@@ -0,0 +1,488 @@
+import array
+import bisect
+import gzip
+import hashlib
+import heapq
+import json
+import math
+import random
+import time
+
+from firebase_admin import firestore
+from google.api_core.exceptions import FailedPrecondition, NotFound, PreconditionFailed
+
+from precompute_recommendations import format_store
+from product_price_index import PREFIX_END
+from recipe_catalog import make_recipe_id
+from recipe_ranker import MIN_COMPOUND_PART, build_discount_info, parse_percentage, tokenize
+
+# Cloud Storage object holding the serialized index
+SEARCH_INDEX_BLOB = "search/search_index.json.gz"
+
+# Type-ahead prefixes shorter than this only match whole terms
+MIN_PREFIX_LENGTH = 2
+
+# Maximum number of index terms a type-ahead prefix expands to (shortest first)
+PREFIX_EXPANSIONS = 64
+
+# Relevance of a match by field: product/ingredient, recipe name, compound part
+FIELD_WEIGHTS = (1.0, 3.0, 0.5)
+BODY_FIELD, NAME_FIELD, COMPOUND_FIELD = 0, 1, 2
+
+# How much the discount lifts a result: score = relevance * (1 + DISCOUNT_WEIGHT * discount)
+DISCOUNT_WEIGHT = 1.0
+
+# Candidates per requested result that are re-ranked by discount
+RERANK_FACTOR = 5
+
+# Compact the index (drop deleted documents) once this share of it is deleted
+COMPACT_RATIO = 0.25
+
+# Attempts at a conditional snapshot update before giving up
+UPDATE_ATTEMPTS = 5
+
+# search_index_pending/{doc_id}: recipes documents changed since the last
+# scheduled index update (one snapshot rewrite for all of them)
+PENDING_COLLECTION = "search_index_pending"
+
+# Swedish inflection endings, longest first: "tomater" -> "tomat", "gurkor" -> "gurk",
+# "kycklingarna" -> "kyckling"
+SWEDISH_SUFFIXES = ("arnas", "ernas", "ornas", "arna", "erna", "orna", "ande", "ende", "aste",
+                    "are", "ast", "het", "ar", "er", "or", "en", "et", "na", "a", "e")
+MIN_STEM_LENGTH = 3
+
+# Queries typed without Swedish letters still match: "kottbullar" -> "köttbullar"
+FOLD_TABLE = str.maketrans("åäöéèüáà", "aaoeeuaa")
+
+
+def stem(term):
+    """Strip one Swedish inflection ending, keeping at least MIN_STEM_LENGTH characters"""
+    for suffix in SWEDISH_SUFFIXES:
+        if term.endswith(suffix) and len(term) - len(suffix) >= MIN_STEM_LENGTH:
+            return term[:-len(suffix)]
+    return term
+
+
+def analyze(text):
+    """Index terms of a text: normalized, folded and stemmed tokens"""
+    return [stem(token.translate(FOLD_TABLE)) for token in tokenize(text)]
+
+
+def content_version(value):
+    """Content hash of a group's source data; unchanged data is not re-indexed"""
+    payload = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def recipe_entries(recipes):
+    """Search entries (document, name text, body texts) for a recipes document's recipe list"""
+    entries = []
+    for recipe in recipes:
+        category = recipe.get("category", "")
+        entries.append(({
+            "type": "recipe",
+            "id": recipe.get("recipe_id") or make_recipe_id(recipe, category),
+            "title": recipe.get("recipe_name", ""),
+            "category": category,
+            "recipe_url": recipe.get("recipe_url", ""),
+            "recipe_img": recipe.get("recipe_img", ""),
+        }, recipe.get("recipe_name", ""), recipe.get("main_ingredients", []) or []))
+    return entries
+
+
+def offer_entries(store_id, store_data):
+    """Search entries for one store's offers (formatted as by format_store)"""
+    _, discount_info, _ = build_discount_info(store_data["articles"])
+    return [({
+        "type": "offer",
+        "id": f"{store_id}/{product_name}",
+        "title": product_name,
+        "store_id": store_id,
+        "store_name": store_data.get("store_name", store_id),
+        "price": info["price"],
+        "discount_amount": info["discount_amount"],
+        "discount_percentage": info["discount_percentage"],
+        "discount_percent": info["discount_percent"],
+    }, "", [product_name]) for product_name, info in discount_info.items()]
+
+
+class SearchIndex:
+    """
+    Inverted index over recipes and current offers for search and type-ahead.
+
+    Documents are added in groups (one recipes document or one store's
+    offers), and a changed group is replaced as a whole: its old documents
+    become tombstones that queries skip, until the index is compacted. Each
+    posting packs the document number and the field it was found in into one
+    integer of a compact array, and the terms are kept sorted so a type-ahead
+    prefix is a binary search.
+
+    Results are ranked by tf-idf style relevance lifted by discount: an
+    offer's discount percentage, or for a recipe the share of its
+    ingredients that are currently on offer somewhere.
+    """
+
+    def __init__(self):
+        self.docs = []
+        self.postings = {}
+        self.terms = []
+        self.groups = {}
+        self.deleted = set()
+        self.offer_terms = {}
+        self._terms_dirty = False
+
+    def __len__(self):
+        return len(self.docs) - len(self.deleted)
+
+    def replace_groups(self, groups):
+        """
+        Replace the documents of changed groups.
+
+        Args:
+            groups: {group: (version, entries)}; groups whose version is
+                unchanged are skipped, entries=None removes the group
+
+        Returns:
+            Number of groups that changed
+        """
+        changed = {}
+        for group, (version, entries) in groups.items():
+            if entries is None and group in self.groups:
+                changed[group] = (version, None)
+            elif entries is not None and self.groups.get(group, {}).get("version") != version:
+                changed[group] = (version, entries)
+        for group in changed:
+            for doc_id in self.groups.pop(group, {}).get("docs", []):
+                self._delete(doc_id)
+
+        # Analyze everything first so compounds can link to terms of any new document
+        analyzed = {}
+        vocabulary = set(self.postings)
+        for group, (version, entries) in changed.items():
+            if entries is None:
+                continue
+            analyzed[group] = [(doc, analyze(name), [term for text in body for term in analyze(text)])
+                               for doc, name, body in entries]
+            for _, name_terms, body_terms in analyzed[group]:
+                vocabulary.update(name_terms)
+                vocabulary.update(body_terms)
+
+        for group, docs in analyzed.items():
+            doc_ids = [self._add(doc, name_terms, body_terms, vocabulary) for doc, name_terms, body_terms in docs]
+            self.groups[group] = {"version": changed[group][0], "docs": doc_ids}
+
+        if self._terms_dirty:
+            self.terms = sorted(self.postings)
+            self._terms_dirty = False
+        if self.deleted and len(self.deleted) > COMPACT_RATIO * len(self.docs):
+            self.compact()
+        return len(changed)
+
+    def _add(self, doc, name_terms, body_terms, vocabulary):
+        doc_id = len(self.docs)
+        fields = {}
+        for term in body_terms:
+            fields.setdefault(term, BODY_FIELD)
+        for term in name_terms:
+            fields[term] = NAME_FIELD
+        for term in list(fields):
+            for part in self._compound_parts(term, vocabulary):
+                fields.setdefault(part, COMPOUND_FIELD)
+
+        for term, field in fields.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = array.array("I")
+                self._terms_dirty = True
+            postings.append(doc_id << 2 | field)
+
+        doc = dict(doc, terms=sorted(fields) if doc["type"] == "offer" else sorted(set(body_terms)))
+        if doc["type"] == "offer":
+            for term in doc["terms"]:
+                self.offer_terms[term] = self.offer_terms.get(term, 0) + 1
+        self.docs.append(doc)
+        return doc_id
+
+    @staticmethod
+    def _compound_parts(term, vocabulary):
+        """Longest known head and tail of a Swedish compound: "korsbarstomat" -> "tomat" """
+        parts = []
+        for i in range(MIN_COMPOUND_PART, len(term) - MIN_COMPOUND_PART + 1):
+            if term[i:] in vocabulary:
+                parts.append(term[i:])
+                break
+        for i in range(len(term) - MIN_COMPOUND_PART, MIN_COMPOUND_PART - 1, -1):
+            if term[:i] in vocabulary:
+                parts.append(term[:i])
+                break
+        return parts
+
+    def _delete(self, doc_id):
+        self.deleted.add(doc_id)
+        doc = self.docs[doc_id]
+        if doc["type"] == "offer":
+            for term in doc["terms"]:
+                count = self.offer_terms.get(term, 0) - 1
+                if count > 0:
+                    self.offer_terms[term] = count
+                else:
+                    self.offer_terms.pop(term, None)
+
+    def compact(self):
+        """Drop deleted documents, renumbering the rest and filtering the postings"""
+        renumbered = {}
+        docs = []
+        for doc_id, doc in enumerate(self.docs):
+            if doc_id not in self.deleted:
+                renumbered[doc_id] = len(docs)
+                docs.append(doc)
+
+        postings = {}
+        for term, values in self.postings.items():
+            kept = array.array("I", (renumbered[value >> 2] << 2 | value & 3 for value in values if value >> 2 in renumbered))
+            if kept:
+                postings[term] = kept
+
+        for group in self.groups.values():
+            group["docs"] = [renumbered[doc_id] for doc_id in group["docs"]]
+        print(f"Compacted search index from {len(self.docs)} to {len(docs)} documents")
+        self.docs = docs
+        self.postings = postings
+        self.terms = sorted(postings)
+        self.deleted = set()
+
+    def _expand(self, prefix):
+        """Index terms starting with prefix, at most PREFIX_EXPANSIONS of the shortest"""
+        start = bisect.bisect_left(self.terms, prefix)
+        end = bisect.bisect_left(self.terms, prefix + PREFIX_END, lo=start)
+        if end - start <= PREFIX_EXPANSIONS:
+            return self.terms[start:end]
+        return heapq.nsmallest(PREFIX_EXPANSIONS, self.terms[start:end], key=len)
+
+    def _term_scores(self, terms, live_count):
+        """Best field-weighted idf per document over a query token's alternative terms"""
+        scores = {}
+        for term in terms:
+            postings = self.postings.get(term)
+            if postings and self.deleted:
+                # Tombstoned documents neither match nor count towards the idf
+                postings = [value for value in postings if value >> 2 not in self.deleted]
+            if not postings:
+                continue
+            idf = math.log(1 + live_count / len(postings))
+            for value in postings:
+                doc_id = value >> 2
+                score = FIELD_WEIGHTS[value & 3] * idf
+                if score > scores.get(doc_id, 0.0):
+                    scores[doc_id] = score
+        return scores
+
+    def _discount(self, doc):
+        if doc["type"] == "offer":
+            # Snapshots written before offers carried numbers only have the display string
+            percent = doc["discount_percent"] if "discount_percent" in doc else parse_percentage(doc["discount_percentage"])
+            return percent / 100
+        terms = doc["terms"]
+        return sum(1 for term in terms if term in self.offer_terms) / len(terms) if terms else 0.0
+
+    def search(self, query, kind=None, store_ids=None, limit=10, prefix=True):
+        """
+        Search recipes and offers.
+
+        Args:
+            query: Free text; every word must match (the last one as a prefix when prefix is set)
+            kind: "recipe" or "offer" to search only one type
+            store_ids: Optional stores to restrict offers to
+            limit: Maximum number of results
+            prefix: Treat the last word as a type-ahead prefix
+
+        Returns:
+            List of result documents with a score, best first
+        """
+        tokens = analyze(query)
+        if not tokens:
+            return []
+
+        live_count = max(len(self), 1)
+        token_scores = []
+        for position, token in enumerate(tokens):
+            terms = [token]
+            if prefix and position == len(tokens) - 1 and len(token) >= MIN_PREFIX_LENGTH:
+                terms = self._expand(token) or terms
+            token_scores.append(self._term_scores(terms, live_count))
+
+        # Every query word must match, starting from the rarest
+        token_scores.sort(key=len)
+        store_ids = set(store_ids) if store_ids else None
+        relevance = {}
+        for doc_id, score in token_scores[0].items():
+            if doc_id in self.deleted:
+                continue
+            doc = self.docs[doc_id]
+            if kind and doc["type"] != kind:
+                continue
+            if store_ids and doc["type"] == "offer" and doc["store_id"] not in store_ids:
+                continue
+            total = score
+            for scores in token_scores[1:]:
+                other = scores.get(doc_id)
+                if other is None:
+                    break
+                total += other
+            else:
+                relevance[doc_id] = total
+
+        candidates = heapq.nlargest(limit * RERANK_FACTOR, relevance.items(), key=lambda item: (item[1], -item[0]))
+        ranked = heapq.nlargest(limit, (
+            (score * (1 + DISCOUNT_WEIGHT * self._discount(self.docs[doc_id])), -doc_id)
+            for doc_id, score in candidates
+        ))
+        results = []
+        for score, neg_doc_id in ranked:
+            result = {key: value for key, value in self.docs[-neg_doc_id].items() if key != "terms"}
+            result["score"] = round(score, 3)
+            results.append(result)
+        return results
+
+    def to_bytes(self):
+        """Serialized gzipped snapshot"""
+        return gzip.compress(json.dumps({
+            "docs": self.docs,
+            "postings": {term: values.tolist() for term, values in self.postings.items()},
+            "groups": self.groups,
+            "deleted": sorted(self.deleted),
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @classmethod
+    def from_bytes(cls, data):
+        snapshot = json.loads(gzip.decompress(data).decode("utf-8"))
+        index = cls()
+        index.docs = snapshot["docs"]
+        index.postings = {term: array.array("I", values) for term, values in snapshot["postings"].items()}
+        index.terms = sorted(index.postings)
+        index.groups = snapshot["groups"]
+        index.deleted = set(snapshot["deleted"])
+        for doc_id, doc in enumerate(index.docs):
+            if doc["type"] == "offer" and doc_id not in index.deleted:
+                for term in doc["terms"]:
+                    index.offer_terms[term] = index.offer_terms.get(term, 0) + 1
+        return index
+
+
+def load_search_index(bucket):
+    """The stored index and its object generation, or an empty index and generation 0"""
+    blob = bucket.blob(SEARCH_INDEX_BLOB)
+    try:
+        data = blob.download_as_bytes()
+    except NotFound:
+        return SearchIndex(), 0
+    return SearchIndex.from_bytes(data), blob.generation
+
+
+def update_search_index(bucket, groups):
+    """
+    Apply group changes to the stored index.
+
+    The snapshot is only written if nobody else wrote it since it was read
+    (generation precondition); on a conflict the update is re-applied to
+    the newer snapshot.
+    """
+    for attempt in range(UPDATE_ATTEMPTS):
+        start = time.perf_counter()
+        index, generation = load_search_index(bucket)
+        changed = index.replace_groups(groups)
+        if not changed:
+            return index
+        try:
+            bucket.blob(SEARCH_INDEX_BLOB).upload_from_string(
+                index.to_bytes(), content_type="application/gzip", if_generation_match=generation
+            )
+        except PreconditionFailed:
+            print(f"Search index changed concurrently, retrying update ({attempt + 1}/{UPDATE_ATTEMPTS})")
+            time.sleep(random.uniform(0, 1) * (attempt + 1))
+            continue
+        print(f"Updated {changed} search groups in {time.perf_counter() - start:.1f}s ({len(index)} documents)")
+        return index
+    raise RuntimeError(f"Search index update failed after {UPDATE_ATTEMPTS} conflicting writes")
+
+
+def store_group(store_id, store_data):
+    """(group, (version, entries)) for a store's offers; store_data None removes the store"""
+    if store_data is None:
+        return f"articles/{store_id}", (None, None)
+    return f"articles/{store_id}", (store_data["offer_version"], offer_entries(store_id, store_data))
+
+
+def recipes_group(doc_id, recipes_doc):
+    """(group, (version, entries)) for a recipes document; None removes it"""
+    if recipes_doc is None:
+        return f"recipes/{doc_id}", (None, None)
+    category = recipes_doc.get("category", "uncategorized")
+    recipes = [dict(recipe, category=category) for recipe in recipes_doc.get("recipes", [])]
+    return f"recipes/{doc_id}", (content_version(recipes), recipe_entries(recipes))
+
+
+def queue_recipes_update(db, doc_id):
+    """Mark a recipes document for re-indexing by the next apply_queued_updates"""
+    db.collection(PENDING_COLLECTION).document(doc_id).set({"queued_at": firestore.SERVER_TIMESTAMP})
+
+
+def apply_queued_updates(db, bucket):
+    """
+    Re-index every queued recipes document with a single snapshot update.
+
+    The recipes documents are read as they are now, so a document written
+    several times since the last run is indexed once. A document queued
+    again while this ran stays queued for the next run.
+    """
+    pending = list(db.collection(PENDING_COLLECTION).stream())
+    if not pending:
+        print("No queued search index updates")
+        return None
+
+    refs = [db.collection("recipes").document(doc.id) for doc in pending]
+    index = update_search_index(bucket, dict(
+        recipes_group(recipe_doc.id, recipe_doc.to_dict() if recipe_doc.exists else None)
+        for recipe_doc in db.get_all(refs)
+    ))
+
+    requeued = 0
+    for doc in pending:
+        try:
+            doc.reference.delete(option=db.write_option(last_update_time=doc.update_time))
+        except FailedPrecondition:
+            requeued += 1
+    print(f"Applied {len(pending)} queued recipes documents to the search index ({requeued} queued again meanwhile)")
+    return index
+
+
+def rebuild_search_index(db, bucket):
+    """Index every recipes document and store from scratch"""
+    groups = {}
+    for recipe_doc in db.collection("recipes").stream():
+        group, value = recipes_group(recipe_doc.id, recipe_doc.to_dict())
+        groups[group] = value
+    for article_doc in db.collection("articles").stream():
+        article_data = article_doc.to_dict()
+        store_id = article_data.get("store_id") or article_doc.id
+        group, value = store_group(store_id, format_store(store_id, article_data))
+        groups[group] = value
+
+    index = SearchIndex()
+    index.replace_groups(groups)
+    bucket.blob(SEARCH_INDEX_BLOB).upload_from_string(index.to_bytes(), content_type="application/gzip")
+    print(f"Rebuilt search index with {len(index)} documents and {len(index.postings)} terms")
+    return index
+
+
+if __name__ == "__main__":
+    from firebase_admin import credentials, firestore, initialize_app, storage
+
+    cred = credentials.Certificate("/Users/buyn/Desktop/agnes_och_axel/serviceAccountKey.json")
+    try:
+        initialize_app(cred, {'storageBucket': 'hellopoor-16c13.appspot.com'})
+    except ValueError:
+        # App already initialized
+        pass
+
+    rebuild_search_index(firestore.client(), storage.bucket())
@@ -0,0 +1,51 @@
+from recipe_ranker import PREFERENCE_RULES, contains_any, normalize_text, tokenize
+
+# Controlled tag vocabulary, each defined by the ranker's rule for that preference
+TAG_RULES = {
+    "vegetarian": PREFERENCE_RULES["vegetarian"],
+    "gluten-free": PREFERENCE_RULES["glutenfree"],
+    "chicken": PREFERENCE_RULES["chicken"],
+    "high-protein": PREFERENCE_RULES["high protein"],
+    "italian": PREFERENCE_RULES["italian"],
+    "asian": PREFERENCE_RULES["asian"],
+    "swedish": PREFERENCE_RULES["swedish"],
+}
+
+# Free-text preferences (normalized) that map to a tag
+PREFERENCE_TAGS = {
+    "vegetarian": "vegetarian",
+    "vegetarisk": "vegetarian",
+    "glutenfree": "gluten-free",
+    "chicken": "chicken",
+    "high protein": "high-protein",
+    "high in protein": "high-protein",
+    "italian": "italian",
+    "asian": "asian",
+    "swedish": "swedish",
+}
+
+# Tags that are hard constraints (a recipe without them can't be recommended);
+# the others only describe a style and are left to ranking
+FILTER_TAGS = {tag for tag, rule in TAG_RULES.items() if "exclude" in rule or "require" in rule}
+
+
+def tag_recipe(recipe):
+    """Tags from the controlled vocabulary for a recipe, based on its name and main ingredients"""
+    tokens = set(tokenize(recipe.get("recipe_name", "")))
+    for ingredient in recipe.get("main_ingredients", []) or []:
+        tokens.update(tokenize(ingredient))
+
+    tags = []
+    for tag, rule in TAG_RULES.items():
+        if "exclude" in rule:
+            if not contains_any(tokens, rule["exclude"]):
+                tags.append(tag)
+        elif contains_any(tokens, rule.get("require", rule.get("boost", []))):
+            tags.append(tag)
+    return tags
+
+
+def preference_filter_tags(user_preferences):
+    """The hard-constraint tags a recipe needs for these preferences"""
+    tags = {PREFERENCE_TAGS.get(normalize_text(preference)) for preference in user_preferences or []}
+    return tags & FILTER_TAGS
@@ -0,0 +1,122 @@
+import collections
+import datetime
+import hashlib
+import json
+import os
+import time
+
+from recipe_ranker import normalize_text
+
+# Firestore collection backing the shared cache tier
+CACHE_COLLECTION = "recommendation_cache"
+
+# Entries expire after this long even if no offers changed
+CACHE_TTL_SEC = float(os.getenv("RECIPE_CACHE_TTL_SEC", str(24 * 3600)))
+
+# Maximum entries kept in the in-instance tier (least recently used are evicted)
+CACHE_MAX_ENTRIES = int(os.getenv("RECIPE_CACHE_MAX_ENTRIES", "256"))
+
+
+def offer_version(articles):
+    """Content hash of a store's offers; changes whenever any offer changes"""
+    payload = json.dumps(articles, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:12]
+
+
+def normalize_preferences(preferences):
+    """Order- and case-insensitive preference set ("Vegetarian", "vegetarian " -> ["vegetarian"])"""
+    return sorted({normalize_text(preference) for preference in preferences or [] if normalize_text(preference)})
+
+
+def cache_key(store_versions, preferences, mode="", recipes_version=None):
+    """
+    Cache key for a recommendation result.
+
+    Args:
+        store_versions: {store_id: offer_version} for every store in the result
+        preferences: The user's preferences
+        mode: Matching mode, so results of different engines don't mix
+        recipes_version: Version of the recipe catalog (catalog_meta's
+            recipes_version), so added or edited recipes are served right away
+
+    Returns:
+        Hex key; any store's offers or the recipe catalog changing yields a new key
+    """
+    payload = json.dumps({
+        "stores": sorted(store_versions.items()),
+        "preferences": normalize_preferences(preferences),
+        "mode": mode,
+        "recipes_version": recipes_version
+    }, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class RecommendationCache:
+    """
+    Two-tier cache of per-store recommendations.
+
+    The in-instance tier is an LRU dict bounded by CACHE_MAX_ENTRIES; the
+    shared tier is the `recommendation_cache` Firestore collection, so warm
+    results survive cold starts and are shared between instances. Entries
+    expire after the TTL, and since the key contains every store's offer
+    version and the recipe catalog's version, a new upload of any member
+    store's offers or a recipe change misses the cache.
+
+    The instance tier is only used from the function's event loop thread, so
+    it needs no lock.
+    """
+
+    def __init__(self, collection=CACHE_COLLECTION, ttl=CACHE_TTL_SEC, max_entries=CACHE_MAX_ENTRIES):
+        self.collection = collection
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def get_local(self, key):
+        """Look up the in-instance tier"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put_local(self, key, value, expires_at=None):
+        """Store in the in-instance tier, evicting the least recently used entries"""
+        self._entries[key] = (expires_at or time.time() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, db, key):
+        """Look up both tiers; a shared-tier hit is copied into the instance tier"""
+        value = self.get_local(key)
+        if value is not None:
+            return value
+
+        doc = await db.collection(self.collection).document(key).get()
+        if not doc.exists:
+            return None
+        data = doc.to_dict()
+        expires_at = data.get("expires_at")
+        if expires_at is None or expires_at.timestamp() <= time.time():
+            return None
+
+        value = data.get("store_recommendations")
+        self.put_local(key, value, expires_at.timestamp())
+        return value
+
+    async def put(self, db, key, value, store_versions, preferences):
+        """Store a result in both tiers"""
+        expires_at = time.time() + self.ttl
+        self.put_local(key, value, expires_at)
+        await db.collection(self.collection).document(key).set({
+            "store_recommendations": value,
+            "offer_versions": store_versions,
+            "preferences": normalize_preferences(preferences),
+            # A Firestore TTL policy on this field deletes expired entries
+            "expires_at": datetime.datetime.fromtimestamp(expires_at, tz=datetime.timezone.utc)
+        })
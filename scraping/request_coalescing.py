@@ -0,0 +1,212 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from google.cloud.firestore_v1.async_transaction import async_transactional
+
+from recommendation_cache import normalize_preferences
+
+# recipe_match_locks/{idempotency key}: the request that is computing (or just
+# computed) the recommendations for a user, store set and preferences
+LOCKS_COLLECTION = "recipe_match_locks"
+
+# How long a running request holds its lock; the lock of a request whose
+# instance died is taken over after this (longer than the request deadline)
+LOCK_LEASE_SEC = float(os.getenv("RECIPE_LOCK_LEASE_SEC", "180"))
+
+# How long a finished result is handed to duplicates (reloads, retries)
+RESULT_REUSE_SEC = float(os.getenv("RECIPE_RESULT_REUSE_SEC", "60"))
+
+# Polling of a duplicate waiting for another instance, doubling up to the maximum
+POLL_INTERVAL_SEC = 0.5
+MAX_POLL_INTERVAL_SEC = 4.0
+
+
+def idempotency_key(user_ref, store_ids, preferences, mode=""):
+    """
+    Key shared by duplicate recipe match requests.
+
+    Args:
+        user_ref: The user's id
+        store_ids: The user's allowed stores (order doesn't matter), so a
+            request after a store change never gets the old stores' result
+        preferences: The user's preferences (order and case don't matter)
+        mode: Matching mode and request kind, so different result shapes don't mix
+
+    Returns:
+        Hex key, used as the lock document id
+    """
+    payload = json.dumps({
+        "user": user_ref,
+        "stores": sorted(store_ids or []),
+        "preferences": normalize_preferences(preferences),
+        "mode": mode
+    }, ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def _expires_in(seconds):
+    return datetime.datetime.fromtimestamp(time.time() + seconds, tz=datetime.timezone.utc)
+
+
+def _standing(lock):
+    """Whether a lock still holds: running within its lease, or done within the reuse window"""
+    if not lock or lock.get("status") not in ("running", "done"):
+        return False
+    expires_at = lock.get("expires_at")
+    return expires_at is not None and expires_at.timestamp() > time.time()
+
+
+@async_transactional
+async def _claim(transaction, lock_ref, owner, fields):
+    snapshot = await lock_ref.get(transaction=transaction)
+    lock = snapshot.to_dict() if snapshot.exists else None
+    if _standing(lock):
+        return False, lock
+
+    lock = {
+        "status": "running",
+        "owner": owner,
+        # A Firestore TTL policy on this field deletes expired locks
+        "expires_at": _expires_in(LOCK_LEASE_SEC),
+        **fields
+    }
+    transaction.set(lock_ref, lock)
+    return True, lock
+
+
+class RequestCoalescer:
+    """
+    Single-flight execution of duplicate recipe match requests.
+
+    The first request for an idempotency key claims recipe_match_locks/{key}
+    in a transaction and computes the result. Duplicates arriving while it
+    runs wait for it and get the same result, and duplicates arriving up to
+    RESULT_REUSE_SEC after it finished get it too, so double-clicks, reloads
+    and retries cost neither LLM calls nor another recipe_matches document.
+    The lock document only holds the id of the stored result (results can
+    approach Firestore's 1 MiB document limit), which duplicates on other
+    instances load. Duplicates on the same instance share the owner's future
+    and don't touch the lock document at all.
+
+    A lock whose owner died is taken over once its lease runs out, and
+    failed requests release their lock so that a retry runs again. The
+    in-flight futures are only used from the function's event loop thread,
+    so they need no lock.
+    """
+
+    def __init__(self, collection=LOCKS_COLLECTION):
+        self.collection = collection
+        # Identifies this instance as the owner of the locks it claims
+        self.owner = uuid.uuid4().hex
+        self._in_flight = {}
+
+    def _ref(self, db, key):
+        return db.collection(self.collection).document(key)
+
+    async def claim(self, db, key, fields=None):
+        """
+        Claim a key unless another request holds it.
+
+        Returns:
+            (True, the new lock) if this request now computes the result,
+            otherwise (False, the standing lock)
+        """
+        return await _claim(db.transaction(), self._ref(db, key), self.owner, fields or {})
+
+    async def complete(self, db, key, fields=None):
+        """Mark a claimed key done; the lock's fields are handed to duplicates for RESULT_REUSE_SEC"""
+        await self._ref(db, key).set({
+            "status": "done",
+            "expires_at": _expires_in(RESULT_REUSE_SEC),
+            **(fields or {})
+        }, merge=True)
+
+    async def release(self, db, key):
+        """Give up a claimed key so that the next request computes it again"""
+        await self._ref(db, key).delete()
+
+    async def wait(self, db, key):
+        """Poll a running lock until it is done; None if it was released or its lease ran out"""
+        interval = POLL_INTERVAL_SEC
+        while True:
+            await asyncio.sleep(interval)
+            snapshot = await self._ref(db, key).get()
+            lock = snapshot.to_dict() if snapshot.exists else None
+            if not _standing(lock):
+                return None
+            if lock["status"] == "done":
+                return lock
+            interval = min(interval * 2, MAX_POLL_INTERVAL_SEC)
+
+    async def run(self, db, key, compute, load):
+        """
+        Result of compute() for a key, computed once for all concurrent duplicates.
+
+        Args:
+            db: Async Firestore client
+            key: Idempotency key of the request
+            compute: Coroutine function producing (result dict, id of the
+                stored result); results with an "error" are returned but not
+                shared
+            load: Coroutine function loading a stored result by its id, or
+                None if it no longer exists
+
+        Returns:
+            The result of this or the duplicate request that computed it
+        """
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            print(f"Joining the running request {key[:12]} on this instance")
+            return await asyncio.shield(in_flight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await self._run_once(db, key, compute, load)
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception retrieved when no duplicate joined
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+
+    async def _run_once(self, db, key, compute, load):
+        while True:
+            owned, lock = await self.claim(db, key)
+            if owned:
+                break
+            if lock["status"] != "done":
+                print(f"Waiting for the running request {key[:12]}")
+                lock = await self.wait(db, key)
+                if lock is None:
+                    # Released or abandoned: claim it ourselves
+                    continue
+
+            result = await load(lock["result_id"]) if lock.get("result_id") else None
+            if result is not None:
+                print(f"Reusing the result of request {key[:12]}")
+                return result
+            # The stored result is gone; compute it again without sharing it
+            result, _ = await compute()
+            return result
+
+        try:
+            result, result_id = await compute()
+        except BaseException:
+            await self.release(db, key)
+            raise
+
+        if "error" in result:
+            await self.release(db, key)
+        else:
+            await self.complete(db, key, {"result_id": result_id})
+        return result
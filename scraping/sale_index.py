@@ -0,0 +1,123 @@
+import bisect
+
+from recipe_ranker import normalize_text
+
+# Same thresholds as find_matching_sale_item in the Cloud Function
+CONTAINMENT_WEIGHT = 100
+WORD_OVERLAP_WEIGHT = 90
+MIN_MATCH_SCORE = 50
+
+
+class SaleItemIndex:
+    """
+    Index over one store's discount_info for ingredient -> sale item lookups.
+
+    Built once per store, it answers best-match queries with the same scoring
+    rules as the linear find_matching_sale_item scan, but only scores the sale
+    items that can actually reach the match threshold:
+
+    - products containing the ingredient come from a prefix search over the
+      sorted suffixes of every product name (a suffix array standing in for a
+      prefix trie, at a fraction of a dict-of-dicts trie's memory)
+    - products contained in the ingredient come from a hash lookup of the
+      ingredient's substrings
+    - products sharing a word come from a token inverted index
+
+    Ties are resolved like the linear scan: the first product in discount_info
+    order wins.
+    """
+
+    def __init__(self, discount_info):
+        self.products = []
+        self.normalized = []
+        self.word_counts = []
+        self.by_normalized = {}
+        self.word_index = {}
+        suffixes = []
+
+        for product_name, info in discount_info.items():
+            normalized_product = info.get("normalized_name") or normalize_text(product_name)
+            if not normalized_product:
+                continue
+
+            idx = len(self.products)
+            self.products.append(product_name)
+            self.normalized.append(normalized_product)
+            self.word_counts.append(len(set(normalized_product.split())))
+            self.by_normalized.setdefault(normalized_product, []).append(idx)
+
+            for word in set(normalized_product.split()):
+                self.word_index.setdefault(word, []).append(idx)
+            for start in range(len(normalized_product)):
+                suffixes.append((normalized_product[start:], idx))
+
+        suffixes.sort()
+        self.suffix_keys = [suffix for suffix, _ in suffixes]
+        self.suffix_ids = [idx for _, idx in suffixes]
+        self.exact = set(discount_info)
+
+    def __len__(self):
+        return len(self.products)
+
+    def _containment_scores(self, normalized_ingredient, scores):
+        """Score products containing, or contained in, the ingredient above the threshold"""
+        length = len(normalized_ingredient)
+
+        # Products containing the ingredient: prefix search over the sorted suffixes.
+        # Containment scores len(ingredient) / len(product) * 100, so longer products can't pass
+        lo = bisect.bisect_left(self.suffix_keys, normalized_ingredient)
+        hi = bisect.bisect_left(self.suffix_keys, normalized_ingredient + "\U0010ffff", lo)
+        for idx in self.suffix_ids[lo:hi]:
+            product_length = len(self.normalized[idx])
+            if product_length < 2 * length:
+                scores[idx] = length / product_length * CONTAINMENT_WEIGHT
+
+        # Products contained in the ingredient: hash lookup of its longer substrings
+        for size in range(length // 2 + 1, length + 1):
+            score = size / length * CONTAINMENT_WEIGHT
+            for start in range(length - size + 1):
+                for idx in self.by_normalized.get(normalized_ingredient[start:start + size], ()):
+                    scores.setdefault(idx, score)
+
+    def _word_scores(self, normalized_ingredient, scores):
+        """Score products sharing words with the ingredient via the token inverted index"""
+        words = set(normalized_ingredient.split())
+        common_counts = {}
+        for word in words:
+            for idx in self.word_index.get(word, ()):
+                common_counts[idx] = common_counts.get(idx, 0) + 1
+
+        for idx, common in common_counts.items():
+            score = common / max(len(words), self.word_counts[idx]) * WORD_OVERLAP_WEIGHT
+            if score > scores.get(idx, 0):
+                scores[idx] = score
+
+    def best_match_with_score(self, ingredient):
+        """Return (product_name, score) for the best matching sale item, or (None, 0)"""
+        if ingredient in self.exact:
+            return ingredient, CONTAINMENT_WEIGHT
+
+        normalized_ingredient = normalize_text(ingredient)
+        if not normalized_ingredient:
+            return None, 0
+
+        # Only products that can score above the threshold are visited; their
+        # scores are exact, so the winner is the same as with a full scan
+        scores = {}
+        self._containment_scores(normalized_ingredient, scores)
+        self._word_scores(normalized_ingredient, scores)
+
+        best_idx = None
+        best_score = 0
+        for idx, score in scores.items():
+            if score > best_score or (score == best_score and best_idx is not None and idx < best_idx):
+                best_idx = idx
+                best_score = score
+
+        if best_score > MIN_MATCH_SCORE:
+            return self.products[best_idx], best_score
+        return None, 0
+
+    def best_match(self, ingredient):
+        """Return the best matching sale item name for an ingredient, or None"""
+        return self.best_match_with_score(ingredient)[0]
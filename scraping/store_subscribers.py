@@ -0,0 +1,145 @@
+from firebase_admin import firestore
+from google.cloud.firestore_v1 import FieldPath
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from precompute_recommendations import (
+    PRECOMPUTED_COLLECTION, PREFERENCE_PROFILES, BatchScorer, format_store, load_recipes,
+    precomputed_document, profile_key
+)
+from recipe_catalog import RecipeCatalog
+from recipe_ranker import RecipeRanker
+
+# store_subscribers/{store_id}: {"store_id": ..., "subscribers": {user_id: [preference, ...]}}
+SUBSCRIBERS_COLLECTION = "store_subscribers"
+
+# Matching mode of the views that are refreshed with the local engine's results;
+# views another engine produced are left for the user's next request
+REFRESHED_MODE = "local"
+
+
+def update_subscriptions(db, user_id, before, after):
+    """
+    Keep the store -> users reverse index in sync with one user document change.
+
+    Args:
+        before: The user document before the change ({} if it was created)
+        after: The user document after the change ({} if it was deleted)
+    """
+    old_stores = set(before.get("allowed_stores", []))
+    new_stores = set(after.get("allowed_stores", []))
+    preferences = after.get("preferences", [])
+    preferences_changed = before.get("preferences", []) != preferences
+
+    batch = db.batch()
+    writes = 0
+    for store_id in old_stores - new_stores:
+        batch.set(db.collection(SUBSCRIBERS_COLLECTION).document(store_id), {
+            "subscribers": {user_id: firestore.DELETE_FIELD}
+        }, merge=True)
+        writes += 1
+    for store_id in new_stores if preferences_changed else new_stores - old_stores:
+        batch.set(db.collection(SUBSCRIBERS_COLLECTION).document(store_id), {
+            "store_id": store_id,
+            "subscribers": {user_id: preferences}
+        }, merge=True)
+        writes += 1
+
+    if writes:
+        batch.commit()
+        print(f"Updated {writes} store subscriptions for user {user_id}")
+
+
+def refresh_store(db, store_id, article_data):
+    """
+    Recompute one store after its offers changed.
+
+    Only the changed store is scored (once per distinct preference profile of
+    its subscribers) and only its subscribers' latest recipe_matches
+    documents are updated, so the work follows what changed rather than the
+    number of users.
+    """
+    store_data = format_store(store_id, article_data)
+    subscribers_doc = db.collection(SUBSCRIBERS_COLLECTION).document(store_id).get()
+    subscribers = subscribers_doc.to_dict().get("subscribers", {}) if subscribers_doc.exists else {}
+
+    if store_data is None:
+        print(f"Store {store_id} has no offers, removing it from {len(subscribers)} user views")
+        db.collection(PRECOMPUTED_COLLECTION).document(store_id).delete()
+        update_user_views(db, store_id, {user_id: None for user_id in subscribers})
+        return
+
+    # The nightly profiles plus any preference combination a subscriber uses
+    profiles = {profile_key(preferences): preferences for preferences in PREFERENCE_PROFILES}
+    for preferences in subscribers.values():
+        profiles.setdefault(profile_key(preferences), preferences)
+
+    catalog = RecipeCatalog(load_recipes(db))
+    scorer = BatchScorer(RecipeRanker(catalog.recipes_data), list(profiles.values()), catalog)
+    scorer.build_product_matrix({store_id: store_data})
+    document = precomputed_document(store_id, store_data, scorer)
+    db.collection(PRECOMPUTED_COLLECTION).document(store_id).set(document)
+    print(f"Recomputed store {store_id} for {len(profiles)} preference profiles")
+
+    update_user_views(db, store_id, {
+        user_id: {"store_name": store_data["store_name"], "recommendations": document["profiles"][profile_key(preferences)]}
+        for user_id, preferences in subscribers.items()
+    })
+
+
+def update_user_views(db, store_id, store_results):
+    """
+    Replace one store's entry in each user's latest recipe_matches document.
+
+    Only views generated in REFRESHED_MODE (their matching_mode field) get
+    new recommendations, so an LLM user's view is never replaced by the
+    local engine's results; a dropped store is removed from every view.
+
+    Args:
+        store_results: {user_id: store recommendation, or None to drop the store}
+    """
+    updated = 0
+    other_mode = 0
+    for user_id, store_result in store_results.items():
+        latest = (
+            db.collection("recipe_matches")
+            .where(filter=FieldFilter("user_id", "==", user_id))
+            .order_by("timestamp", direction=firestore.Query.DESCENDING)
+            .limit(1)
+            .get()
+        )
+        if not latest:
+            # Never generated: the user gets fresh results on their next visit
+            continue
+
+        field = FieldPath("store_recommendations", store_id).to_api_repr()
+        if store_result is None:
+            # A store without offers is dropped from every view
+            value = firestore.DELETE_FIELD
+        elif latest[0].to_dict().get("matching_mode") != REFRESHED_MODE:
+            other_mode += 1
+            continue
+        elif store_result["recommendations"]:
+            value = store_result
+        else:
+            value = firestore.DELETE_FIELD
+        latest[0].reference.update({field: value, "timestamp": firestore.SERVER_TIMESTAMP})
+        updated += 1
+
+    print(f"Refreshed store {store_id} in {updated} of {len(store_results)} subscriber views "
+          f"({other_mode} views from another matching mode left as they are)")
+
+
+if __name__ == "__main__":
+    # Backfill the reverse index for users registered before it existed
+    from firebase_admin import initialize_app, credentials
+
+    cred = credentials.Certificate("/Users/buyn/Desktop/agnes_och_axel/serviceAccountKey.json")
+    try:
+        initialize_app(cred, {'storageBucket': 'hellopoor-16c13.appspot.com'})
+    except ValueError:
+        # App already initialized
+        pass
+
+    db = firestore.client()
+    for user_doc in db.collection("users").stream():
+        update_subscriptions(db, user_doc.id, {}, user_doc.to_dict())
@@ -3,7 +3,8 @@ import json
 import re
 from dotenv import load_dotenv
 from firebase_admin import initialize_app, firestore, credentials
-from openai import OpenAI
+from llm_gateway import LLMGateway, gateway_available, ledger
+from recipe_ranker import select_candidate_recipes, estimate_tokens
 
 # Load environment variables
 load_dotenv()
@@ -19,6 +20,9 @@ except ValueError:
 # Get Firestore client
 db = firestore.client()
 
+# Number of candidate recipes put in the matching prompt
+PROMPT_TOP_K = int(os.getenv("RECIPE_PROMPT_TOP_K", "50"))
+
 def normalize_text(text):
     """Normalize text for better matching (lowercase, remove special chars)"""
     if not text:
@@ -74,6 +78,13 @@ def get_recipe_recommendations(user_articles_on_sale, user_preferences, recipes_
                 "main_ingredients": recipe.get("main_ingredients", [])
             })
 
+    # Only the top-K recipes by sale item overlap go into the prompt
+    candidate_recipes = select_candidate_recipes(recipes_info, sale_items, PROMPT_TOP_K)
+    candidate_tokens = estimate_tokens(json.dumps(candidate_recipes, indent=2, ensure_ascii=False))
+    full_tokens = candidate_tokens * len(recipes_info) // max(len(candidate_recipes), 1)
+    print(f"Top-K filter kept {len(candidate_recipes)} of {len(recipes_info)} recipes, "
+          f"saving ~{full_tokens - candidate_tokens} prompt tokens")
+
     # Create the prompt for OpenAI with discount information
     prompt = f"""
 Given the following information, recommend 5 recipes that best match the user's preferences 
@@ -85,7 +96,7 @@ Items on Sale with Discount Information:
 {json.dumps(sale_items, indent=2, ensure_ascii=False)}
 
 Available Recipes:
-{json.dumps(recipes_info[:100], indent=2, ensure_ascii=False)}
+{json.dumps(candidate_recipes, indent=2, ensure_ascii=False)}
 
 For each recipe, identify which ingredients in the recipe are on sale items.
 Make sure to EXACTLY match the ingredient names to the sale items.
@@ -210,12 +221,11 @@ def test_recipe_matcher():
     print(f"Food preferences: {sample_preferences}")
     
     # Initialize OpenAI client
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
+    if not gateway_available():
         print("Error: OpenAI API key not found in environment variables")
         return
     
-    client = OpenAI(api_key=api_key)
+    client = LLMGateway(caller="test_recipe_function")
     
     # Get user data from Firestore
     user_doc = db.collection("users").document(sample_user_id).get()
@@ -343,6 +353,8 @@ def test_recipe_matcher():
     else:
         print("No recommendations found.")
     
+    print(f"\nLLM usage: {ledger.summary()}")
+    
     # Return the formatted recommendations (could be stored or used elsewhere)
     return formatted_recommendations
 
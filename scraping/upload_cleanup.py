@@ -1,6 +1,11 @@
 import json
-from firebase_admin import initialize_app, firestore
+from firebase_admin import initialize_app, firestore, storage
 from firebase_admin import credentials
+from recommendation_cache import offer_version
+from catalog_cache import record_store_versions
+from precompute_recommendations import format_store
+from product_price_index import rebuild_price_index
+from recipe_search import store_group, update_search_index
 
 def clean_articles_in_firebase():
     """
@@ -25,6 +30,8 @@ def clean_articles_in_firebase():
     total_documents = 0
     documents_modified = 0
     total_items_removed = 0
+    store_versions = {}
+    search_groups = {}
     
     # Fetch all documents from the articles collection
     articles_ref = db.collection("articles")
@@ -60,7 +67,12 @@ def clean_articles_in_firebase():
         if removed_count > 0:
             # Update the document in Firestore
             doc_ref = articles_ref.document(store_id)
-            doc_ref.update({"articles": filtered_articles})
+            store_versions[store_id] = offer_version(filtered_articles)
+            doc_ref.update({"articles": filtered_articles, "offer_version": store_versions[store_id]})
+            group, value = store_group(store_id, format_store(
+                store_id, dict(data, articles=filtered_articles, offer_version=store_versions[store_id])
+            ))
+            search_groups[group] = value
             
             documents_modified += 1
             total_items_removed += removed_count
@@ -72,6 +84,13 @@ def clean_articles_in_firebase():
                 if article.get("name") in items_to_remove:
                     print(f"  - Removed: {article.get('name')} (Price: {article.get('price')})")
     
+    # Cached recommendations and offers of the modified stores are now stale,
+    # and the removed items must leave the price and search indexes
+    if store_versions:
+        record_store_versions(db, store_versions)
+        rebuild_price_index(db)
+        update_search_index(storage.bucket(), search_groups)
+    
     # Print summary
     print("\nCleanup Summary:")
     print(f"Total documents scanned: {total_documents}")
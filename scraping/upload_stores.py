@@ -1,7 +1,14 @@
 import json
 import uuid
-from firebase_admin import initialize_app, firestore
+from firebase_admin import initialize_app, firestore, storage
 from firebase_admin import credentials
+from recommendation_cache import offer_version
+from offer_schema import typed_offer
+from product_price_index import rebuild_price_index
+from precompute_recommendations import format_store
+from recipe_search import store_group, update_search_index
+from catalog_cache import record_store_versions
+from product_catalog import ProductCatalog, load_product_catalog, save_product_catalog
 
 def upload_stores_to_firebase():
     """Upload store data from results.txt to Firebase"""
@@ -74,33 +81,61 @@ def upload_articles_to_firebase():
         print(f"Warning: Could not load store names from results.txt: {e}")
         store_names = {}
     
+    # Cluster this week's product names across all stores; known products keep their ids
+    product_catalog = ProductCatalog.build(
+        (article["name"] for articles in articles_data.values() for article in articles),
+        previous=load_product_catalog(db)
+    )
+    
     # Upload each store's articles to Firestore
+    search_groups = {}
+    store_versions = {}
     for store_id, articles in articles_data.items():
         # Convert articles to the required format
         formatted_articles = []
         for article in articles:
-            formatted_article = {
+            # Display strings for the app, plus the numbers matching reads
+            formatted_article = typed_offer({
                 "name": article["name"],
                 "price": article["price"],
                 "discount_amount": article["discount_amount"],
-                "discount_percentage": article["discount_percentage"]
-            }
+                "discount_percentage": article["discount_percentage"],
+                "product_id": product_catalog.product_id(article["name"])
+            })
             formatted_articles.append(formatted_article)
         
         # Create data object with articles array and store_id
         data = {
             "articles": formatted_articles,
             "store_id": store_id,
-            "store_name": store_names.get(store_id, store_id)  # Use store name if available, otherwise use store_id
+            "store_name": store_names.get(store_id, store_id),  # Use store name if available, otherwise use store_id
+            # Changes whenever the offers change, invalidating cached recommendations
+            "offer_version": offer_version(formatted_articles)
         }
         
         # Add to Firestore using store_id as the document ID
         doc_ref = db.collection("articles").document(store_id)
         doc_ref.set(data)
         
+        group, value = store_group(store_id, format_store(store_id, data))
+        search_groups[group] = value
+        store_versions[store_id] = data["offer_version"]
+        
         print(f"Uploaded {len(formatted_articles)} articles for store {store_id}")
     
     print("All articles uploaded successfully")
+    
+    # Every distinct product once, with the names stores offer it under
+    save_product_catalog(db, product_catalog)
+    
+    # Warm function instances drop their cached offers of these stores
+    record_store_versions(db, store_versions)
+    
+    # Rebuild the cross-store cheapest-offer index from the new offers
+    rebuild_price_index(db)
+    
+    # Re-index the stores whose offers changed in the search index
+    update_search_index(storage.bucket(), search_groups)
 
 if __name__ == "__main__":
     upload_stores_to_firebase()